@@ -4,6 +4,7 @@ import streamlit as st
 
 from k2_oai.dashboard import pages
 from k2_oai.dashboard.components import login
+from k2_oai.dropbox import LOCAL_STORAGE_ROOT
 
 
 def run():
@@ -15,6 +16,9 @@ def run():
     )
 
     st_oauth_text_boxes = st.empty()
+    if LOCAL_STORAGE_ROOT is not None:
+        # the files are read from a local folder: there is no need to log in
+        st.session_state["access_token"] = None
     if "access_token" not in st.session_state:
         if "DROPBOX_ACCESS_TOKEN" in os.environ:
             st.session_state["access_token"] = os.environ.get("DROPBOX_ACCESS_TOKEN")
@@ -12,25 +12,24 @@ def _load_random_photo(roofs_list):
     st.session_state["roof_id"] = np.random.choice(roofs_list)
 
 
-def _change_roof_id(how: str, roofs_list):
-    # note: np.where returns a tuple, in this case ([array],).
-    # use the double indexing like [0][0]!
-    current_index: int = np.where(roofs_list == st.session_state["roof_id"])[0][0]
+def _change_roof_id(how: str, metadata):
+    # the position of the roof is a hash lookup, not a scan of all the roofs
+    current_index: int = metadata.position(st.session_state["roof_id"])
 
     if how == "next":
         # otherwise is out of index
-        if current_index < len(roofs_list) - 1:
-            st.session_state["roof_id"] = roofs_list[current_index + 1]
+        if current_index < len(metadata) - 1:
+            st.session_state["roof_id"] = metadata.roof_ids[current_index + 1]
     elif how == "previous":
         if current_index > 0:
-            st.session_state["roof_id"] = roofs_list[current_index - 1]
+            st.session_state["roof_id"] = metadata.roof_ids[current_index - 1]
     else:
         raise ValueError(f"Invalid `how`: {how}. Must be `next` or `previous`.")
 
 
 def choose_roof_id(metadata, remaining_roofs):
 
-    roofs_list = metadata.roof_id.unique()
+    roofs_list = metadata.roof_ids
 
     st.markdown(
         f"""
@@ -58,7 +57,7 @@ def choose_roof_id(metadata, remaining_roofs):
         help="Load the photo before this one. "
         "If nothing happens, this is the first photo.",
         on_click=_change_roof_id,
-        args=("previous", roofs_list),
+        args=("previous", metadata),
     )
 
     st_rand.button(
@@ -73,7 +72,7 @@ def choose_roof_id(metadata, remaining_roofs):
         help="Load the photo right after this one. "
         "If nothing happens, this is the last photo.",
         on_click=_change_roof_id,
-        args=("next", roofs_list),
+        args=("next", metadata),
     )
 
     return chosen_roof_id
@@ -6,12 +6,14 @@ from __future__ import annotations
 
 from typing import Any
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from numpy import ndarray
 from pandas import DataFrame, Series
 
 from k2_oai.dashboard import utils
+from k2_oai.data.store import MetadataStore
 from k2_oai.dropbox import (
     DROPBOX_HYPERPARAM_ANNOTATIONS_PATH,
     DROPBOX_LABEL_ANNOTATIONS_PATH,
@@ -35,7 +37,8 @@ def configure_data(
     key_annotations_only: str,
     geo_metadata: bool = False,
     only_folders: bool = True,
-) -> tuple[DataFrame, DataFrame, Series]:
+    key_skip_near_duplicates: str = "skip_near_duplicates",
+) -> tuple[MetadataStore, DataFrame, ndarray]:
     """
     1. Load metadata
     2. allow to drop duplicates
@@ -73,9 +76,8 @@ def configure_data(
             .drop_duplicates(subset=["roof_id", "annotation_time"], keep="last")
         )
 
-    remaining_roofs = obstacles_metadata.roof_id.loc[
-        lambda df: ~df.isin(all_annotations.roof_id.values)
-    ].unique()
+    is_annotated = pd.Series(obstacles_metadata.roof_ids).isin(all_annotations.roof_id)
+    remaining_roofs = obstacles_metadata.roof_ids[~is_annotated.to_numpy()]
 
     # filter only annotated photos
     if st.checkbox("Only show well-labelled roofs", key=key_annotations_only):
@@ -84,11 +86,12 @@ def configure_data(
             lambda df: df["is_perfectly_labelled"] == 1
         ]
 
-        obstacles_metadata = obstacles_metadata.loc[
-            lambda df: df.roof_id.isin(well_labelled_roofs.roof_id.values)
-        ]
+        # cached: the same store at every rerun, with its cached duplicates and cube
+        obstacles_metadata = utils.st_subset_metadata(
+            obstacles_metadata, np.unique(well_labelled_roofs.roof_id.dropna())
+        )
 
-        if obstacles_metadata.empty:
+        if len(obstacles_metadata) == 0:
             st.error(
                 "No photos have been annotated in this session, "
                 "or no photo in this folder were annotated. "
@@ -97,9 +100,22 @@ def configure_data(
             )
             st.stop()
 
-        remaining_roofs = obstacles_metadata.roof_id.loc[
-            lambda df: df.isin(all_annotations.roof_id.values)
+        remaining_roofs = obstacles_metadata.roof_ids
+
+    # the same physical roof, labelled in other photos, is only annotated once
+    if st.checkbox(
+        "Skip near-duplicate roofs",
+        key=key_skip_near_duplicates,
+        help="Only show one of the roofs that are the same roof in different photos",
+    ):
+        canonical_roof_ids = obstacles_metadata.roof_ids[
+            obstacles_metadata.canonical_roof_ids == obstacles_metadata.roof_ids
         ]
+        # also hides the duplicates from the roof selector and its buttons
+        obstacles_metadata = utils.st_subset_metadata(
+            obstacles_metadata, canonical_roof_ids
+        )
+        remaining_roofs = remaining_roofs[np.isin(remaining_roofs, canonical_roof_ids)]
 
     return obstacles_metadata, all_annotations, remaining_roofs
 
@@ -109,7 +125,7 @@ def choose_folder_to_load_metadata(
     key_drop_duplicates: str,
     geo_metadata: bool = False,
     only_folders: bool = True,
-) -> tuple[DataFrame, DataFrame]:
+) -> tuple[MetadataStore, DataFrame]:
 
     st.markdown("## :open_file_folder: Photos Folder")
 
@@ -140,10 +156,10 @@ def choose_folder_to_load_metadata(
 
 
 def choose_to_drop_duplicates(
-    obstacles_metadata: DataFrame,
+    obstacles_metadata: MetadataStore,
     photo_list: Series | ndarray,
     key_drop_duplicates: str,
-) -> DataFrame:
+) -> MetadataStore:
     st.checkbox("Drop duplicate roofs", key=key_drop_duplicates)
 
     view_duplicates_count(
@@ -152,27 +168,19 @@ def choose_to_drop_duplicates(
     )
 
     if st.session_state[key_drop_duplicates]:
-        obstacles_metadata = obstacles_metadata.drop_duplicates(
-            subset=["imageURL", "pixelCoordinates_obstacle"]
-        )
+        obstacles_metadata = obstacles_metadata.drop_duplicates()
 
     return obstacles_metadata
 
 
 def view_duplicates_count(
-    obstacles_metadata: DataFrame,
+    obstacles_metadata: MetadataStore,
     photo_list: Series | ndarray,
 ):
-    total_obst = obstacles_metadata.pixelCoordinates_obstacle.notna().shape[0]
-    unique_obst = obstacles_metadata.drop_duplicates(
-        subset=["imageURL", "pixelCoordinates_obstacle"]
-    ).shape[0]
+    is_duplicate_roof, is_duplicate_obstacle = obstacles_metadata.find_duplicates()
 
-    roofs_metadata = obstacles_metadata.drop_duplicates(subset="roof_id")
-    total_roofs = roofs_metadata.pixelCoordinates_roof.notna().shape[0]
-    unique_roofs = roofs_metadata.drop_duplicates(
-        subset=["imageURL", "pixelCoordinates_roof"]
-    ).shape[0]
+    total_obst, duplicate_obst = len(is_duplicate_obstacle), is_duplicate_obstacle.sum()
+    total_roofs, duplicate_roofs = len(is_duplicate_roof), is_duplicate_roof.sum()
 
     st.info(
         f"""
@@ -186,11 +194,11 @@ def view_duplicates_count(
 
     st.warning(
         f"""
-        Duplicate roofs: {total_roofs - unique_roofs}
-        ({(total_roofs - unique_roofs) / total_roofs * 100:.2f}%)
+        Duplicate roofs: {duplicate_roofs}
+        ({duplicate_roofs / total_roofs * 100:.2f}%)
 
-        Duplicate obstacles: {total_obst - unique_obst}
-        ({(total_obst - unique_obst) / total_obst * 100:.2f}%)
+        Duplicate obstacles: {duplicate_obst}
+        ({duplicate_obst / total_obst * 100:.2f}%)
         """
     )
 
@@ -232,7 +240,7 @@ def write_and_save_annotations(
     annotations_savefile: str,
     roof_id: int,
     photos_folder: str,
-    metadata: DataFrame,
+    metadata: MetadataStore,
     key_annotations_cache: str,
     mode: str,
 ):
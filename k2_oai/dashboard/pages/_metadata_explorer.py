@@ -7,6 +7,7 @@ import altair as alt
 import numpy as np
 import streamlit as st
 
+from k2_oai.dashboard import utils
 from k2_oai.dashboard.components import sidebar
 
 __all__ = ["metadata_explorer_page"]
@@ -41,10 +42,21 @@ def metadata_explorer_page(
             only_folders=only_folders,
         )
 
-        roofs_metadata = obstacles_metadata.drop_duplicates(subset="roof_id")
+        # every chart is a slice of the cube, which does not scale with the roofs
+        annotations_file = st.session_state[key_annotations_file]
+        metadata_cube = utils.st_get_metadata_cube(
+            obstacles_metadata,
+            utils.st_load_annotations(annotations_file) if annotations_file else None,
+            st.session_state[key_annotations_cache],
+        )
 
         chosen_folder = st.session_state[key_photos_folder]
 
+        st.info(
+            f"Annotated roofs: {metadata_cube.num_annotated} of "
+            f"{len(obstacles_metadata)}"
+        )
+
     # +---------------+
     # | Zoom Levels   |
     # +---------------+
@@ -72,12 +84,10 @@ def metadata_explorer_page(
         )
 
     zoom_levels_by_continent = (
-        roofs_metadata.groupby(["continent", "zoom"])
-        .size()
-        .reset_index()
+        metadata_cube.slice(["continent", "zoom"])
         .rename(
             columns={
-                0: "Number of Roofs",
+                "roofs": "Number of Roofs",
                 "zoom": "Zoom Level",
                 "continent": "Continent",
             }
@@ -141,12 +151,10 @@ def metadata_explorer_page(
     st.subheader("Zoom Level Distribution by Country")
 
     zoom_levels_by_country = (
-        roofs_metadata.groupby(["continent", "name", "zoom"])
-        .size()
-        .reset_index()
+        metadata_cube.slice(["continent", "name", "zoom"])
         .rename(
             columns={
-                0: "Number of Roofs",
+                "roofs": "Number of Roofs",
                 "name": "Country",
                 "zoom": "Zoom Level",
                 "continent": "Continent",
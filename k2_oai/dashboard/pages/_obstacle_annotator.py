@@ -180,9 +180,8 @@ def obstacle_annotator_page(
     # +----------------+
 
     with st.expander(f"Roof {chosen_roof_id} metadata:"):
-        st.dataframe(
-            obstacles_metadata.loc[obstacles_metadata.roof_id == chosen_roof_id]
-        )
+        st.dataframe(obstacles_metadata.get_roof(chosen_roof_id))
+        st.dataframe(obstacles_metadata.get_obstacles(chosen_roof_id))
 
     with st.expander("View the annotations:", expanded=True):
         st.dataframe(all_annotations)
@@ -44,6 +44,12 @@ def obstacle_detection_page(
 
         chosen_roof_id = buttons.choose_roof_id(obstacles_metadata, remaining_roofs)
 
+        photo, roof, labelled_photo, _labelled_roof = utils.st_load_photo_and_roof(
+            int(chosen_roof_id), obstacles_metadata, chosen_folder
+        )
+
+        suggested = utils.st_suggest_hyperparameters(roof)
+
         # +-------------------+
         # | labelling actions |
         # +-------------------+
@@ -61,17 +67,23 @@ def obstacle_detection_page(
         chosen_sigma = st.slider(
             "Filtering sigma (positive, odd integer):",
             min_value=1,
+            max_value=max(100, suggested["sigma"]),
+            value=suggested["sigma"],
             step=2,
         )
 
+        filtering_methods = ("Bilateral", "Gaussian")
         chosen_filtering_method = st.radio(
             "Choose filtering method:",
-            options=("Bilateral", "Gaussian"),
+            options=filtering_methods,
+            index=filtering_methods.index(suggested["filtering_method"]),
         )
 
+        binarisation_methods = ("Simple", "Adaptive", "Composite")
         chosen_binarisation_method = st.radio(
             "Select the desired binarisation method",
-            options=("Simple", "Adaptive", "Composite"),
+            options=binarisation_methods,
+            index=binarisation_methods.index(suggested["binarization_method"]),
         )
 
         if chosen_binarisation_method == "Adaptive":
@@ -82,6 +94,7 @@ def obstacle_detection_page(
                 """,
                 min_value=-1,
                 max_value=255,
+                value=-1 if suggested["blocksize"] is None else suggested["blocksize"],
                 step=2,
             )
             chosen_tolerance = None
@@ -93,6 +106,7 @@ def obstacle_detection_page(
                 """,
                 min_value=-1,
                 max_value=255,
+                value=-1 if suggested["tolerance"] is None else suggested["tolerance"],
             )
             chosen_blocksize = None
         else:
@@ -127,10 +141,6 @@ def obstacle_detection_page(
     # | Roof & Color Histograms |
     # +-------------------------+
 
-    photo, roof, labelled_photo, _labelled_roof = utils.st_load_photo_and_roof(
-        int(chosen_roof_id), obstacles_metadata, chosen_folder
-    )
-
     (
         obstacle_blobs,
         roof_with_bboxes,
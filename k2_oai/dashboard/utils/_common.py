@@ -2,13 +2,15 @@
 Common functions (e.g. not related to load data from Dropbox).
 """
 
+from __future__ import annotations
+
 from datetime import datetime
 
 import pandas as pd
 import streamlit as st
 from numpy import ndarray
-from pandas import DataFrame
 
+from k2_oai.data.store import MetadataStore, require_metadata_store
 from k2_oai.obstacle_detection import (
     binarization_step,
     detect_obstacles,
@@ -80,10 +82,10 @@ def annotate_labels(
     session_state_key: str,
     roof_id: int,
     photos_folder: str,
-    metadata: DataFrame,
+    metadata: MetadataStore,
     mode: str,
 ):
-    image_url = metadata.loc[metadata["roof_id"] == roof_id, "imageURL"].values[0]
+    image_url = require_metadata_store(metadata).get_image_url(roof_id)
 
     timestamp = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
 
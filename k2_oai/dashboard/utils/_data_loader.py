@@ -7,35 +7,65 @@ from __future__ import annotations
 import os
 
 import streamlit as st
+from dropbox.exceptions import ApiError
 
 from k2_oai import dropbox as dbx
 from k2_oai.data import load
-from k2_oai.dropbox import DROPBOX_RAW_PHOTOS_ROOT
+from k2_oai.data.cube import MetadataCube
+from k2_oai.data.store import MetadataStore, require_metadata_store
+from k2_oai.dropbox import (
+    DROPBOX_HYPERPARAM_ANNOTATIONS_PATH,
+    DROPBOX_LABEL_ANNOTATIONS_PATH,
+    DROPBOX_RAW_PHOTOS_ROOT,
+)
+from k2_oai.hyperparameter_prediction import (
+    DEFAULT_HYPERPARAMETERS,
+    compute_roof_features,
+)
 from k2_oai.utils import (
+    PREVIEW_SCALE,
     draw_labels_on_cropped_roof,
     draw_labels_on_photo,
     rotate_and_crop_roof,
+    scale_coordinates,
 )
 
 __all__ = [
+    "WATCHED_FOLDERS",
     "st_dropbox_connect",
+    "st_folder_watcher",
     "st_listdir",
     "st_listdir_no_cache",
     "st_load_dataframe",
     "st_load_metadata",
     "st_load_geo_metadata",
     "st_load_annotations",
+    "st_load_photo_catalog",
+    "st_load_hyperparameters_predictor",
+    "st_suggest_hyperparameters",
     "st_load_photo_list",
     "st_load_photo_list_and_metadata",
+    "st_subset_metadata",
+    "st_get_metadata_cube",
     "st_load_photo",
     "st_load_photo_from_roof_id",
     "st_load_photo_and_roof",
     "st_save_annotations",
 ]
 
+# the folders whose listings and files are cached until they change
+WATCHED_FOLDERS = (
+    DROPBOX_RAW_PHOTOS_ROOT,
+    DROPBOX_LABEL_ANNOTATIONS_PATH,
+    DROPBOX_HYPERPARAM_ANNOTATIONS_PATH,
+)
+
 
 @st.cache(allow_output_mutation=True)
 def st_dropbox_connect():
+    # e.g. an offline container with a local mirror of the Dropbox folders
+    if dbx.LOCAL_STORAGE_ROOT is not None:
+        return dbx.LocalBackend(dbx.LOCAL_STORAGE_ROOT)
     if "DROPBOX_ACCESS_TOKEN" in os.environ:
         return dbx.dropbox_connect_access_token_only(st.session_state["access_token"])
     return dbx.dropbox_connect(
@@ -43,12 +73,31 @@ def st_dropbox_connect():
     )
 
 
+@st.cache(allow_output_mutation=True)
+def st_folder_watcher():
+    """Watches `WATCHED_FOLDERS` in the background for the whole session (see
+    `FolderWatcher`). The functions below key their cache by the version of the
+    folders: reruns reuse the cached data, with no Dropbox calls, until the folders
+    change."""
+    dbx_app = st_dropbox_connect()
+    return dbx.FolderWatcher(dbx_app, WATCHED_FOLDERS).start()
+
+
+def _st_folder_version(path):
+    # None if the folder is not watched: its data is cached until the app restarts
+    return st_folder_watcher().version(path)
+
+
 @st.cache
-def st_listdir(path):
+def _st_listdir(path, folder_version):
     dbx_app = st_dropbox_connect()
     return dbx.dropbox_listdir(path, dbx_app)
 
 
+def st_listdir(path):
+    return _st_listdir(path, _st_folder_version(path))
+
+
 def st_listdir_no_cache(path):
     """No cache version of st_listdir. It's meant to be used in streamlit components
     where you want to reload the list of files. In this case, the list will be sensitive
@@ -56,6 +105,9 @@ def st_listdir_no_cache(path):
     this would only have been possible after refreshing the cache (i.e. by re-running
     the whole application).
 
+    The listings of the `WATCHED_FOLDERS` are cached anyway, until Dropbox notifies a
+    change in the folder.
+
     Parameters
     ----------
     path
@@ -66,36 +118,82 @@ def st_listdir_no_cache(path):
     DataFrame
         DataFrame containing the list of files in the folder and some metadata.
     """
+    if st_folder_watcher().is_watching(path):
+        return st_listdir(path)
+
     dbx_app = st_dropbox_connect()
     return dbx.dropbox_listdir(path, dbx_app)
 
 
 @st.cache
-def st_load_dataframe(filename, dropbox_path):
+def _st_load_dataframe(filename, dropbox_path, folder_version):
     dbx_app = st_dropbox_connect()
     return load.dbx_load_dataframe(filename, dropbox_path, dbx_app)
 
 
-@st.cache
+def st_load_dataframe(filename, dropbox_path):
+    return _st_load_dataframe(filename, dropbox_path, _st_folder_version(dropbox_path))
+
+
+# the metadata is a `MetadataStore`, which is never modified: do not hash it at reruns
+@st.cache(allow_output_mutation=True)
 def st_load_metadata():
     dbx_app = st_dropbox_connect()
     return load.dbx_load_metadata(dbx_app)
 
 
-@st.cache
+@st.cache(allow_output_mutation=True)
 def st_load_geo_metadata():
     dbx_app = st_dropbox_connect()
     return load.dbx_load_geo_metadata(dbx_app)
 
 
 @st.cache(allow_output_mutation=True)
-def st_load_annotations(filename):
+def _st_load_annotations(filename, folder_version):
     dbx_app = st_dropbox_connect()
     return load.dbx_load_label_annotations(filename, dbx_app)
 
 
+def st_load_annotations(filename):
+    return _st_load_annotations(
+        filename, _st_folder_version(DROPBOX_LABEL_ANNOTATIONS_PATH)
+    )
+
+
 @st.cache(allow_output_mutation=True)
-def st_load_photo_list(photos_folder):
+def st_load_hyperparameters_predictor():
+    dbx_app = st_dropbox_connect()
+    try:
+        return load.dbx_load_hyperparameters_predictor(dbx_app)
+    except ApiError:
+        # no predictor was trained yet
+        return None
+
+
+def st_suggest_hyperparameters(roof):
+    """Suggests the hyperparameters of the obstacle detection pipeline for the roof,
+    to pre-fill the dashboard widgets. If no predictor is available, returns the
+    default values of the widgets.
+
+    Parameters
+    ----------
+    roof
+        The cropped roof.
+
+    Returns
+    -------
+    dict
+        The suggested hyperparameters, with the same keys of the annotations.
+    """
+    predictor = st_load_hyperparameters_predictor()
+
+    if predictor is None:
+        return dict(DEFAULT_HYPERPARAMETERS)
+    return predictor.predict(compute_roof_features(roof))
+
+
+@st.cache(allow_output_mutation=True)
+def _st_load_photo_list(photos_folder, folder_version):
 
     root_folder = DROPBOX_RAW_PHOTOS_ROOT
     photos_folder_contents = st_listdir(root_folder).item_name.values
@@ -109,101 +207,242 @@ def st_load_photo_list(photos_folder):
         return st_listdir(path=photos_path)[["item_name"]]
 
 
-@st.cache
+def st_load_photo_list(photos_folder):
+    return _st_load_photo_list(
+        photos_folder, _st_folder_version(DROPBOX_RAW_PHOTOS_ROOT)
+    )
+
+
+@st.cache(allow_output_mutation=True)
 def st_load_photo_list_and_metadata(
     photos_folder: str | None = None,
     geo_metadata: bool = False,
 ):
-    if geo_metadata:
-        obstacle_metadata = st_load_geo_metadata()
-    else:
-        obstacle_metadata = st_load_metadata()
+    """Loads the metadata of the photos in the folder, indexed by roof (see
+    `MetadataStore`), and the list of photos. The store is built once per folder,
+    and it must not be modified.
 
+    Only the partition of the metadata with the folder is downloaded, and only the
+    rows of the photos in the folder are read (see `dbx_load_metadata`)."""
     if photos_folder is None:
-        return obstacle_metadata, obstacle_metadata.imageURL.unique()
+        if geo_metadata:
+            metadata_store = st_load_geo_metadata()
+        else:
+            metadata_store = st_load_metadata()
+        return metadata_store, metadata_store.roofs.imageURL.unique()
 
     photos_list = st_load_photo_list(photos_folder)
 
-    available_metadata = obstacle_metadata.loc[
-        lambda df: df.imageURL.isin(photos_list.item_name)
-    ]
+    dbx_app = st_dropbox_connect()
+    load_metadata = (
+        load.dbx_load_geo_metadata if geo_metadata else load.dbx_load_metadata
+    )
+    metadata_store = load_metadata(
+        dbx_app, photos_folder=photos_folder, image_urls=photos_list.item_name
+    )
+
+    return metadata_store, photos_list
 
-    return available_metadata, photos_list
+
+# subsets are keyed by the identity of the store, which is cached itself: the same
+# subset is the same store at every rerun, with its cached properties
+@st.cache(allow_output_mutation=True, hash_funcs={MetadataStore: id})
+def st_subset_metadata(metadata, roof_ids):
+    """Returns a store with only the given roofs (see `MetadataStore.subset`), built
+    once per store and set of roofs.
+
+    Parameters
+    ----------
+    metadata : MetadataStore
+        The store, as returned by `st_load_photo_list_and_metadata`.
+    roof_ids : ndarray
+        The sorted, unique identifiers of the roofs to keep.
+
+    Returns
+    -------
+    MetadataStore
+        The subset of the store. It must not be modified.
+    """
+    return metadata.subset(roof_ids)
+
+
+def st_get_metadata_cube(
+    metadata, loaded_annotations, cached_annotations, key="metadata_cube"
+):
+    """Returns the counts of roofs by folder, annotation status, continent, country and
+    zoom level (see `MetadataCube`). The cube is kept in the session state and built
+    once per metadata and loaded annotations: at reruns, only the annotations added to
+    the session since the previous run are applied.
+
+    Parameters
+    ----------
+    metadata
+        The metadata, as returned by `st_load_photo_list_and_metadata`.
+    loaded_annotations
+        The annotations loaded from a checkpoint, as returned by `st_load_annotations`,
+        or None.
+    cached_annotations
+        The annotations of the session.
+    key
+        The key of the cube in the session state.
+
+    Returns
+    -------
+    MetadataCube
+        The counts of roofs.
+    """
+    cube, cube_annotations = st.session_state.get(key, (None, None))
+
+    if (
+        cube is None
+        or cube.metadata is not metadata
+        or cube_annotations is not loaded_annotations
+    ):
+        cube = MetadataCube(metadata)
+        if loaded_annotations is not None:
+            cube.update_annotations(loaded_annotations.roof_id.dropna())
+        st.session_state[key] = (cube, loaded_annotations)
+
+    return cube.add_annotations(cached_annotations)
+
+
+@st.cache(allow_output_mutation=True)
+def st_load_photo_catalog():
+    dbx_app = st_dropbox_connect()
+    try:
+        return load.dbx_load_photo_catalog(dbx_app)
+    except ApiError:
+        # the catalog was not created yet: every copy of a photo is loaded on its own
+        return None
+
+
+def _resolve_photo(photo_name, folder_name):
+    dropbox_path = f"{DROPBOX_RAW_PHOTOS_ROOT}/{folder_name}/{photo_name}"
+    catalog = st_load_photo_catalog()
+
+    # photos that are not in the catalog are keyed by their path
+    if catalog is None or dropbox_path not in catalog:
+        return dropbox_path, dropbox_path
+    return catalog.resolve(dropbox_path)
 
 
 @st.cache(allow_output_mutation=True)
+def _st_load_photo_by_content(
+    content_hash,
+    dropbox_path,
+    bgr_only=False,
+    greyscale_only=False,
+    scale=1,
+):
+    # the cache is keyed by the content: copies of a photo are only loaded once
+    dbx_app = st_dropbox_connect()
+    dropbox_folder, photo_name = dropbox_path.rsplit("/", maxsplit=1)
+
+    return load.dbx_load_photo(
+        photo_name,
+        dropbox_folder,
+        dbx_app,
+        bgr_only,
+        greyscale_only,
+        # photos that are not in the catalog are keyed by their path, not their hash
+        content_hash=None if content_hash == dropbox_path else content_hash,
+        scale=scale,
+    )
+
+
 def st_load_photo(
     photo_name,
     folder_name,
     greyscale_only: bool = False,
+    scale: int = 1,
 ):
-    dbx_app = st_dropbox_connect()
-    dbx_path = f"{DROPBOX_RAW_PHOTOS_ROOT}/{folder_name}"
-    return load.dbx_load_photo(
-        photo_name, dbx_path, dbx_app, greyscale_only=greyscale_only
+    """Loads a photo, e.g. reduced by `scale` for a preview (see `dbx_load_photo`)."""
+    content_hash, dropbox_path = _resolve_photo(photo_name, folder_name)
+    return _st_load_photo_by_content(
+        content_hash, dropbox_path, greyscale_only=greyscale_only, scale=scale
+    )
+
+
+def _st_load_photo_by_name(
+    photo_name,
+    chosen_folder,
+    bgr_only=False,
+    greyscale_only=False,
+    scale=1,
+):
+    content_hash, dropbox_path = _resolve_photo(photo_name, chosen_folder)
+    return _st_load_photo_by_content(
+        content_hash, dropbox_path, bgr_only, greyscale_only, scale
     )
 
 
-@st.cache(allow_output_mutation=True)
 def st_load_photo_from_roof_id(
     roof_id,
     metadata,
     chosen_folder,
     bgr_only=False,
     greyscale_only=False,
+    scale=1,
 ):
-    dbx_app = st_dropbox_connect()
-    dbx_path = f"{DROPBOX_RAW_PHOTOS_ROOT}/{chosen_folder}"
+    # cache by photo, not by metadata: hashing the metadata would scan all of it
+    photo_name = require_metadata_store(metadata).get_image_url(roof_id)
 
-    return load.dbx_load_photos_from_roof_id(
-        roof_id, metadata, dbx_path, dbx_app, bgr_only, greyscale_only
+    return _st_load_photo_by_name(
+        photo_name, chosen_folder, bgr_only, greyscale_only, scale
     )
 
 
-def get_coordinates_from_roof_id(roof_id, photos_metadata) -> tuple[str, list[str]]:
-
-    roof_px_coordinates = photos_metadata.loc[
-        photos_metadata.roof_id == roof_id, "pixelCoordinates_roof"
-    ].iloc[0]
-
-    obstacles_px_coordinates = [
-        coord
-        for coord in photos_metadata.loc[
-            photos_metadata.roof_id == roof_id, "pixelCoordinates_obstacle"
-        ].values
-    ]
-
-    return roof_px_coordinates, obstacles_px_coordinates
-
-
 def st_load_photo_and_roof(
     roof_id,
     photos_metadata,
     chosen_folder,
     as_greyscale: bool = False,
+    scale: int = 1,
+    preview_scale: int = PREVIEW_SCALE,
 ):
-    roof_px_coord, obstacles_px_coord = get_coordinates_from_roof_id(
-        roof_id, photos_metadata
-    )
+    """Loads the photo of a roof and crops the roof, with and without labels.
+
+    The whole photo is only shown as a preview: it is decoded reduced by
+    `preview_scale`, while the roof is cropped from the photo reduced by `scale`.
+    """
+    photos_metadata = require_metadata_store(photos_metadata)
+    roof_px_coord, obstacles_px_coord = photos_metadata.get_coordinates(roof_id)
+    roof_geometry = photos_metadata.get_geometry(roof_id)
 
-    if as_greyscale:
+    def load_photo(photo_scale):
         photo = st_load_photo_from_roof_id(
-            roof_id, photos_metadata, chosen_folder, greyscale_only=True
+            roof_id,
+            photos_metadata,
+            chosen_folder,
+            bgr_only=not as_greyscale,
+            greyscale_only=as_greyscale,
+            scale=photo_scale,
         )
-    else:
-        photo = st_load_photo_from_roof_id(
-            roof_id, photos_metadata, chosen_folder, bgr_only=True
+        if photo_scale == 1:
+            return photo, roof_px_coord, obstacles_px_coord, roof_geometry
+        # the precomputed geometry is in the coordinates of the full-size photo
+        return (
+            photo,
+            scale_coordinates(roof_px_coord, photo_scale),
+            scale_coordinates(obstacles_px_coord, photo_scale),
+            None,
         )
 
-    labelled_photo = draw_labels_on_photo(photo, roof_px_coord, obstacles_px_coord)
+    photo, preview_roof_coord, preview_obstacles_coord, _ = load_photo(preview_scale)
+    labelled_photo = draw_labels_on_photo(
+        photo, preview_roof_coord, preview_obstacles_coord
+    )
     # labelled_photo = experimental_draw_labels(
     #     photo,
     #     roof_px_coord,
     #     obstacles_px_coord
     # )
 
-    roof = rotate_and_crop_roof(photo, roof_px_coord)
-    labelled_roof = draw_labels_on_cropped_roof(roof, roof_px_coord, obstacles_px_coord)
+    roof_photo, roof_px_coord, obstacles_px_coord, roof_geometry = load_photo(scale)
+    roof = rotate_and_crop_roof(roof_photo, roof_px_coord, roof_geometry)
+    labelled_roof = draw_labels_on_cropped_roof(
+        roof, roof_px_coord, obstacles_px_coord, roof_geometry
+    )
 
     return photo, roof, labelled_photo, labelled_roof
 
@@ -217,4 +456,11 @@ def st_save_annotations(data_to_upload, filename, destination_folder):
 
     data_to_upload.to_csv(file_to_upload, index=False)
 
+    watcher = st_folder_watcher()
+    folder_version = watcher.version(destination_folder)
+
     dbx.dropbox_upload_file_to(dbx_app, file_to_upload, destination_path)
+
+    # wait for the notification, so that the next rerun lists the new checkpoint
+    if folder_version is not None:
+        watcher.wait_for_change(destination_folder, folder_version, timeout=10)
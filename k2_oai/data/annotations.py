@@ -0,0 +1,149 @@
+"""
+Consolidated snapshot of the label annotations checkpoints saved by the dashboard.
+
+The snapshot has the latest annotation of every roof, sorted by `roof_id`. It is a
+.parquet file that also records, in its schema metadata, the checkpoints merged into
+it with their Dropbox content hash: consolidating the annotations again only downloads
+the checkpoints that are new or changed since then, and merges them into the snapshot
+(see `merge_label_annotations`). Checkpoints that were deleted, and annotations removed
+from a checkpoint, are only dropped when the snapshot is rebuilt from scratch.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import BinaryIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+__all__ = [
+    "LABEL_ANNOTATIONS_SNAPSHOT",
+    "merge_label_annotations",
+    "read_label_annotations_snapshot",
+    "write_label_annotations_snapshot",
+]
+
+LABEL_ANNOTATIONS_SNAPSHOT = "obstacles-labels_annotations.parquet"
+
+# the key of the merged checkpoints in the schema metadata of the snapshot
+_CHECKPOINTS_KEY = b"k2_oai.checkpoints"
+
+
+def _latest_annotations(annotations: DataFrame) -> DataFrame:
+    # the latest annotation of each roof, sorted by roof: on ties, the last one
+    return (
+        annotations.dropna(subset=["roof_id"])
+        .sort_values(["roof_id", "annotation_time"], kind="stable")
+        .drop_duplicates(subset="roof_id", keep="last")
+    )
+
+
+def merge_label_annotations(
+    snapshot: DataFrame | None, checkpoints: DataFrame
+) -> DataFrame:
+    """Merges new checkpoints into the snapshot, keeping the latest annotation of each
+    roof by `annotation_time`.
+
+    The snapshot is not sorted again: only the latest annotations of the checkpoints
+    are sorted by `roof_id`, and then interleaved with the snapshot as in the merge
+    step of a merge sort.
+
+    Parameters
+    ----------
+    snapshot : DataFrame or None
+        The snapshot, with one row per roof sorted by `roof_id`. If None, the
+        snapshot is built from the checkpoints only.
+    checkpoints : DataFrame
+        The annotations of the new checkpoints, concatenated in the order they were
+        saved: the last one wins over annotations with the same `annotation_time`,
+        also over the snapshot.
+
+    Returns
+    -------
+    DataFrame
+        The new snapshot, with one row per roof sorted by `roof_id`.
+    """
+    latest = _latest_annotations(checkpoints)
+    if snapshot is None or snapshot.empty:
+        return latest.reset_index(drop=True)
+
+    snapshot_ids = snapshot.roof_id.to_numpy()
+    snapshot_times = snapshot.annotation_time.fillna("").to_numpy(dtype=str)
+    latest_ids = latest.roof_id.to_numpy()
+    latest_times = latest.annotation_time.fillna("").to_numpy(dtype=str)
+
+    # the roofs annotated in both: the annotation of the snapshot is replaced, unless
+    # it is more recent
+    positions = np.searchsorted(snapshot_ids, latest_ids)
+    found = np.minimum(positions, len(snapshot_ids) - 1)
+    is_in_snapshot = snapshot_ids[found] == latest_ids
+    is_newer = ~is_in_snapshot | (latest_times >= snapshot_times[found])
+
+    is_kept = np.ones(len(snapshot), dtype=bool)
+    is_kept[positions[is_in_snapshot & is_newer]] = False
+    snapshot = snapshot.loc[is_kept]
+    latest = latest.loc[is_newer]
+
+    # the position of every row in the merged snapshot: the roofs are distinct
+    snapshot_ids = snapshot_ids[is_kept]
+    latest_ids = latest_ids[is_newer]
+    order = np.empty(len(snapshot_ids) + len(latest_ids), dtype=np.int64)
+    order[
+        np.arange(len(snapshot_ids)) + np.searchsorted(latest_ids, snapshot_ids)
+    ] = np.arange(len(snapshot_ids))
+    order[
+        np.arange(len(latest_ids)) + np.searchsorted(snapshot_ids, latest_ids)
+    ] = np.arange(len(snapshot_ids), len(order))
+
+    return (
+        pd.concat([snapshot, latest], ignore_index=True)
+        .take(order)
+        .reset_index(drop=True)
+    )
+
+
+def read_label_annotations_snapshot(file) -> tuple[DataFrame, dict[str, str]]:
+    """Reads the snapshot and the checkpoints merged into it.
+
+    Parameters
+    ----------
+    file : str or BinaryIO
+        The local path of the snapshot, or the file itself.
+
+    Returns
+    -------
+    tuple[DataFrame, dict[str, str]]
+        The snapshot, and the name and content hash of each checkpoint merged into it.
+    """
+    table = pq.read_table(file)
+    metadata = table.schema.metadata or {}
+    checkpoints = json.loads(metadata.get(_CHECKPOINTS_KEY, b"{}"))
+    return table.to_pandas(), checkpoints
+
+
+def write_label_annotations_snapshot(
+    snapshot: DataFrame, checkpoints: dict[str, str], file: str | BinaryIO
+):
+    """Writes the snapshot, recording the checkpoints merged into it.
+
+    Parameters
+    ----------
+    snapshot : DataFrame
+        The snapshot, as returned by `merge_label_annotations`.
+    checkpoints : dict[str, str]
+        The name and content hash of each checkpoint merged into the snapshot.
+    file : str or BinaryIO
+        The local path of the snapshot, or a file to write it to, e.g. a `BytesIO`.
+    """
+    table = pa.Table.from_pandas(snapshot, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            _CHECKPOINTS_KEY: json.dumps(checkpoints, sort_keys=True).encode(),
+        }
+    )
+    pq.write_table(table, file)
@@ -0,0 +1,115 @@
+"""
+Catalog of the satellite photos in all the folders of `DROPBOX_RAW_PHOTOS_ROOT`, keyed
+by their Dropbox content hash.
+
+The same photo can be uploaded to more than one folder (e.g. ingest slices and API
+uploads). The catalog maps the path of every photo to the hash of its content and
+every hash to a single canonical path, so that copies of a photo are downloaded,
+cached and processed only once.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable
+
+import pandas as pd
+from pandas import DataFrame
+
+__all__ = [
+    "PHOTO_CATALOG_FILE",
+    "build_photo_catalog",
+    "PhotoCatalog",
+]
+
+PHOTO_CATALOG_FILE = "photos_catalog.parquet"
+
+
+def build_photo_catalog(listings: Iterable[tuple[str, DataFrame]]) -> DataFrame:
+    """Builds the catalog from the listings of the photos folders.
+
+    Parameters
+    ----------
+    listings : Iterable[tuple[str, DataFrame]]
+        The name of each photos folder and its contents, as returned by
+        `dropbox_listdir`.
+
+    Returns
+    -------
+    DataFrame
+        One row per photo, with the `photos_folder`, the `item_name`, the
+        `item_abs_path`, the `item_content_hash`, the `item_size` and the
+        `canonical_path`, i.e. the first path (in alphabetical order) with the same
+        content.
+    """
+    columns = ["item_name", "item_abs_path", "item_content_hash", "item_size"]
+
+    catalog = pd.concat(
+        [
+            contents.loc[contents.item_type == "file", columns].assign(
+                photos_folder=photos_folder
+            )
+            for photos_folder, contents in listings
+            if len(contents) > 0
+        ]
+        or [DataFrame(columns=columns + ["photos_folder"])],
+        ignore_index=True,
+    ).sort_values("item_abs_path", ignore_index=True)
+
+    canonical_path = catalog.groupby("item_content_hash").item_abs_path.transform(
+        "first"
+    )
+
+    return catalog.assign(canonical_path=canonical_path)[
+        ["photos_folder", *columns, "canonical_path"]
+    ]
+
+
+class PhotoCatalog:
+    """Looks up the content hash and the canonical path of the photos.
+
+    Parameters
+    ----------
+    catalog : DataFrame
+        The catalog, as returned by `build_photo_catalog`.
+    """
+
+    def __init__(self, catalog: DataFrame):
+        self.catalog = catalog
+        # Dropbox paths are case-insensitive
+        self._photos = {
+            path.lower(): (content_hash, canonical_path)
+            for path, content_hash, canonical_path in zip(
+                catalog.item_abs_path,
+                catalog.item_content_hash,
+                catalog.canonical_path,
+            )
+        }
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def __contains__(self, dropbox_path: str) -> bool:
+        return dropbox_path.lower() in self._photos
+
+    @property
+    def num_unique_photos(self) -> int:
+        """The number of distinct photos, i.e. of canonical paths."""
+        return self.catalog.item_content_hash.nunique()
+
+    def resolve(self, dropbox_path: str) -> tuple[str, str]:
+        """Returns the content hash and the canonical path of the photo.
+
+        Parameters
+        ----------
+        dropbox_path : str
+            The Dropbox path of the photo.
+
+        Returns
+        -------
+        tuple[str, str]
+            The content hash of the photo and the Dropbox path of its canonical copy.
+        """
+        try:
+            return self._photos[dropbox_path.lower()]
+        except KeyError:
+            raise KeyError(f"Photo {dropbox_path} is not in the catalog.") from None
@@ -2,22 +2,71 @@
 Functions to manipulate the raw data.
 """
 
+from __future__ import annotations
+
+import time
+from datetime import datetime
+from io import BytesIO
+from typing import Sequence
+
 import geopandas
+import numpy as np
 import pandas as pd
 
 from k2_oai import dropbox as dbx
-from k2_oai.data.load import dbx_load_dataframe, dbx_load_metadata
+from k2_oai.data.catalog import PHOTO_CATALOG_FILE, PhotoCatalog, build_photo_catalog
+from k2_oai.data.load import (
+    GEO_METADATA_FILE,
+    METADATA_FILE,
+    dbx_load_dataframe,
+    dbx_load_dataframes,
+    dbx_load_metadata,
+    dbx_load_photo,
+    dbx_load_photo_list,
+    dbx_load_photos,
+    dbx_read_label_annotations,
+    metadata_partition_path,
+)
+from k2_oai.data.spatial import hilbert_key
+from k2_oai.data.store import MetadataStore, apply_metadata_schema, as_metadata_store
+from k2_oai.dropbox import (
+    DROPBOX_HYPERPARAM_ANNOTATIONS_PATH,
+    DROPBOX_MODELS_PATH,
+    DROPBOX_PHOTOS_METADATA_PATH,
+    DROPBOX_RAW_PHOTOS_ROOT,
+)
+from k2_oai.hyperparameter_prediction import (
+    HyperparametersPredictor,
+    compute_roof_features,
+)
+from k2_oai.hyperparameter_tuning import make_tuning_sample, tune_hyperparameters
+from k2_oai.utils import rotate_and_crop_roof
 
 __all__ = [
     "dbx_create_geo_metadata",
+    "dbx_create_metadata_partitions",
+    "dbx_create_photo_catalog",
+    "dbx_create_hyperparameter_annotations",
+    "dbx_create_hyperparameters_predictor",
 ]
 
 
 def dbx_create_geo_metadata(dropbox_app):
+    """Creates the geo metadata, i.e. the obstacles metadata with the roofs as points.
+    The roofs are sorted along a Hilbert curve (see `hilbert_key`), so that the roofs
+    of the same region are stored close to each other."""
+    # keep the coordinates as strings, so that the metadata can be written to file
     metadata = (
-        dbx_load_metadata(dropbox_app=dropbox_app)
+        dbx_load_dataframe(
+            METADATA_FILE,
+            dropbox_path=DROPBOX_PHOTOS_METADATA_PATH,
+            dropbox_app=dropbox_app,
+        )
+        .pipe(apply_metadata_schema)
         .dropna(subset=["center_lng", "center_lat"])
         .rename(columns={"center_lng": "lon", "center_lat": "lat"})
+        .assign(hilbert_key=lambda df: hilbert_key(df.lat, df.lon))
+        .sort_values(["hilbert_key", "roof_id"], kind="stable", ignore_index=True)
     )
 
     return geopandas.GeoDataFrame(
@@ -27,20 +76,358 @@ def dbx_create_geo_metadata(dropbox_app):
     )
 
 
-def dbx_concat_label_annotations(dropbox_app):
-    files = dbx.dropbox_listdir("/k2/metadata/label_annotations", dropbox_app).item_name
-    checkpoints = [
-        dbx_load_dataframe(file, "/k2/metadata/label_annotations", dropbox_app)
-        for file in files
-        if "-checkpoint-" in file
+def dbx_create_metadata_partitions(
+    dropbox_app, filename: str = METADATA_FILE, row_group_size: int = 10_000
+) -> list[str]:
+    """Splits a metadata file into one file per photos folder, so that the dashboard
+    only downloads the metadata of the folder it shows (see `dbx_load_metadata`).
+
+    Each partition is sorted by `imageURL` and written in small row groups, so that
+    filters on the photos skip most of the file. The photos of a folder are listed as
+    in the dashboard (see `dbx_load_photo_list`).
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    filename : str (default: METADATA_FILE)
+        The metadata file to partition, e.g. `METADATA_FILE` or `GEO_METADATA_FILE`.
+    row_group_size : int (default: 10_000)
+        The number of rows of each row group of the partitions.
+
+    Returns
+    -------
+    list[str]
+        The photos folders that were partitioned.
+    """
+    if filename not in (METADATA_FILE, GEO_METADATA_FILE):
+        raise ValueError(f"Unknown metadata file: {filename}")
+
+    metadata = dbx_load_dataframe(
+        filename, DROPBOX_PHOTOS_METADATA_PATH, dropbox_app
+    ).sort_values("imageURL", kind="stable", ignore_index=True)
+
+    root_contents = dbx.dropbox_listdir(DROPBOX_RAW_PHOTOS_ROOT, dropbox_app)
+    photos_folders = [
+        item for item in root_contents.item_name if not item.endswith(".csv")
     ]
 
+    for photos_folder in photos_folders:
+        photos_list = dbx_load_photo_list(photos_folder, dropbox_app)
+        partition, partitions_path = metadata_partition_path(filename, photos_folder)
+
+        with BytesIO() as buffer:
+            metadata.loc[metadata.imageURL.isin(photos_list.item_name)].to_parquet(
+                buffer, index=False, row_group_size=row_group_size
+            )
+            dbx.as_storage_backend(dropbox_app).upload(
+                buffer.getvalue(),
+                f"{partitions_path}/{partition}",
+            )
+
+    return photos_folders
+
+
+def dbx_create_photo_catalog(dropbox_app) -> PhotoCatalog:
+    """Lists the photos in all the folders of `DROPBOX_RAW_PHOTOS_ROOT` and uploads the
+    catalog of their content hashes (see `build_photo_catalog`).
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+
+    Returns
+    -------
+    PhotoCatalog
+        The catalog of the photos.
+    """
+    root_contents = dbx.dropbox_listdir(DROPBOX_RAW_PHOTOS_ROOT, dropbox_app)
+    photos_folders = root_contents.loc[lambda df: df.item_type == "folder"].item_name
+
+    catalog = build_photo_catalog(
+        (
+            photos_folder,
+            dbx.dropbox_listdir(
+                f"{DROPBOX_RAW_PHOTOS_ROOT}/{photos_folder}", dropbox_app
+            ),
+        )
+        for photos_folder in photos_folders
+    )
+
+    with BytesIO() as buffer:
+        catalog.to_parquet(buffer, index=False)
+        dbx.as_storage_backend(dropbox_app).upload(
+            buffer.getvalue(),
+            f"{DROPBOX_PHOTOS_METADATA_PATH}/{PHOTO_CATALOG_FILE}",
+        )
+
+    return PhotoCatalog(catalog)
+
+
+def dbx_concat_label_annotations(dropbox_app):
+    """Returns the latest label annotation of every roof, merging the new checkpoints
+    into the snapshot in memory (see `dbx_read_label_annotations`)."""
     return (
-        pd.concat(checkpoints)
-        .sort_values(["roof_id", "annotation_time"])
-        .drop_duplicates(subset="roof_id", keep="last")
+        dbx_read_label_annotations(dropbox_app)
         .rename(columns={"annotation": "is_trainable"})
         .assign(
             photos_folder=lambda df: df.photos_folder.str.replace("-api_upload", "")
         )
     )
+
+
+class _TuningSamples(Sequence):
+    """The tuning samples of some roofs, loaded on demand: successive halving only
+    needs the roofs of its last rung, which may be a few of them."""
+
+    def __init__(
+        self,
+        roof_ids: list[int],
+        metadata: MetadataStore,
+        dropbox_folder: str,
+        dropbox_app,
+        catalog: PhotoCatalog | None = None,
+    ):
+        self._roof_ids = roof_ids
+        self._metadata = metadata
+        self._dropbox_folder = dropbox_folder
+        self._dropbox_app = dropbox_app
+        self._catalog = catalog
+        self._samples = {}
+
+    def __len__(self):
+        return len(self._roof_ids)
+
+    def __getitem__(self, index):
+        roof_id = self._roof_ids[index]
+
+        if roof_id not in self._samples:
+            photo = dbx_load_photo(
+                self._metadata.get_image_url(roof_id),
+                self._dropbox_folder,
+                self._dropbox_app,
+                bgr_only=True,
+                catalog=self._catalog,
+            )
+            roof_px_coord, obstacles_px_coord = self._metadata.get_coordinates(roof_id)
+            # keep the cropped roof, not the photo
+            self._samples[roof_id] = make_tuning_sample(
+                photo,
+                roof_px_coord,
+                obstacles_px_coord,
+                self._metadata.get_geometry(roof_id),
+            )
+
+        return self._samples[roof_id]
+
+
+def dbx_create_hyperparameter_annotations(
+    metadata,
+    photos_folder,
+    dropbox_app,
+    strata: list[str] | None = None,
+    max_evaluations: int | None = None,
+    time_budget: float | None = None,
+    candidates=None,
+    filename: str = "autotuned_hyperparameters.csv",
+    skip_near_duplicates: bool = False,
+    catalog: PhotoCatalog | None = None,
+    max_samples: int | None = 27,
+    random_state: int | None = None,
+):
+    """Tunes the hyperparameters of the obstacle detection pipeline for every roof in
+    `metadata`, or for every stratum of roofs, and uploads them to Dropbox with the
+    same schema as the hyperparameters annotations of the dashboard.
+
+    Parameters
+    ----------
+    metadata : DataFrame or MetadataStore
+        The obstacles metadata of the roofs to tune, whose photos are in
+        `photos_folder`.
+    photos_folder : str
+        The folder in `DROPBOX_RAW_PHOTOS_ROOT` where the photos are stored.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    strata : list[str] or None (default: None)
+        The columns defining the strata, e.g. `["zoom", "continent"]`. The roofs in
+        the same stratum share the same hyperparameters. If None, tunes every roof
+        on its own.
+    max_evaluations : int or None (default: None)
+        The budget of evaluations, per roof or per stratum.
+    time_budget : float or None (default: None)
+        The budget of wall-clock time in seconds, per roof or per stratum, including
+        the time to load the photos.
+    candidates : list[dict] or None (default: None)
+        The candidates hyperparameters. If None, uses the default grid.
+    filename : str (default: "autotuned_hyperparameters.csv")
+        The name of the file to upload, prepended with a timestamp.
+    skip_near_duplicates : bool (default: False)
+        Whether to only tune the canonical roofs, skipping the other labels of the
+        same physical roofs (see `MetadataStore.find_near_duplicates`).
+    catalog : PhotoCatalog or None (default: None)
+        If not None, downloads the canonical copy of each photo (see
+        `dbx_create_photo_catalog`).
+    max_samples : int or None (default: 27)
+        The maximum number of roofs of each stratum the hyperparameters are tuned on,
+        drawn at random. The photos are loaded one at a time, as successive halving
+        needs them. If None, tunes on all the roofs of each stratum.
+    random_state : int or None (default: None)
+        The seed used to draw the roofs of each stratum.
+
+    Returns
+    -------
+    DataFrame
+        The hyperparameters annotations, for all the roofs of each stratum.
+    """
+    dropbox_folder = f"{DROPBOX_RAW_PHOTOS_ROOT}/{photos_folder}"
+    metadata = as_metadata_store(metadata)
+    roofs_metadata = metadata.roofs
+
+    if skip_near_duplicates:
+        roofs_metadata = roofs_metadata.loc[
+            metadata.canonical_roof_ids == metadata.roof_ids
+        ]
+
+    annotations = []
+
+    for _, stratum in roofs_metadata.groupby(
+        strata or "roof_id", dropna=False, observed=True
+    ):
+
+        # the time budget includes loading the photos
+        start_time = time.monotonic()
+
+        if max_samples is not None and len(stratum) > max_samples:
+            sampled_roof_ids = stratum.roof_id.sample(
+                n=max_samples, random_state=random_state
+            )
+        else:
+            sampled_roof_ids = stratum.roof_id.sample(frac=1, random_state=random_state)
+
+        best_candidate, _ = tune_hyperparameters(
+            _TuningSamples(
+                sampled_roof_ids.tolist(),
+                metadata,
+                dropbox_folder,
+                dropbox_app,
+                catalog,
+            ),
+            candidates=candidates,
+            max_evaluations=max_evaluations,
+            time_budget=time_budget,
+            start_time=start_time,
+        )
+
+        timestamp = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
+        annotations += [
+            {
+                "roof_id": roof_id,
+                "annotation_time": timestamp,
+                "imageURL": image_url,
+                "photos_folder": photos_folder,
+                **best_candidate,
+                "boundary_type": "Bounding Box",
+            }
+            for roof_id, image_url in zip(stratum.roof_id, stratum.imageURL)
+        ]
+
+    hyperparameter_annotations = (
+        pd.DataFrame(annotations)
+        .astype({"roof_id": int, "sigma": int, "blocksize": float, "tolerance": float})
+        .sort_values("roof_id")
+        .reset_index(drop=True)
+    )
+
+    savefile = f"{datetime.now().strftime('%Y_%m_%d-%H_%M_%S')}-{filename}"
+    hyperparameter_annotations.to_csv(savefile, index=False)
+
+    dbx.dropbox_upload_file_to(
+        dropbox_app,
+        savefile,
+        f"{DROPBOX_HYPERPARAM_ANNOTATIONS_PATH}/{savefile}",
+        remove_original=True,
+    )
+
+    return hyperparameter_annotations
+
+
+def dbx_create_hyperparameters_predictor(
+    dropbox_app,
+    n_neighbors: int = 5,
+    filename: str = "hyperparameters_predictor.npz",
+    catalog: PhotoCatalog | None = None,
+):
+    """Trains the hyperparameters predictor on all the hyperparameters annotations
+    in `DROPBOX_HYPERPARAM_ANNOTATIONS_PATH` and uploads it to `DROPBOX_MODELS_PATH`.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    n_neighbors : int (default: 5)
+        The number of neighbours used by the predictor.
+    filename : str (default: "hyperparameters_predictor.npz")
+        The name of the file to upload.
+    catalog : PhotoCatalog or None (default: None)
+        If not None, downloads the canonical copy of each photo (see
+        `dbx_create_photo_catalog`).
+
+    Returns
+    -------
+    HyperparametersPredictor
+        The trained predictor.
+    """
+    files = dbx.dropbox_listdir(DROPBOX_HYPERPARAM_ANNOTATIONS_PATH, dropbox_app)
+    metadata = dbx_load_metadata(dropbox_app=dropbox_app)
+
+    annotations = (
+        pd.concat(
+            dbx_load_dataframes(
+                [file for file in files.item_name if file.endswith(".csv")],
+                DROPBOX_HYPERPARAM_ANNOTATIONS_PATH,
+                dropbox_app,
+            ),
+            ignore_index=True,
+        )
+        .sort_values(["roof_id", "annotation_time"])
+        .drop_duplicates(subset="roof_id", keep="last")
+        .loc[lambda df: df.roof_id.isin(metadata.roof_ids)]
+        .reset_index(drop=True)
+    )
+
+    # the annotated roofs of each photo: photos are loaded concurrently, and only the
+    # features of their roofs are kept
+    roofs_by_photo = annotations.groupby(
+        DROPBOX_RAW_PHOTOS_ROOT
+        + "/"
+        + annotations.photos_folder.astype(str)
+        + "/"
+        + annotations.imageURL.astype(str)
+    ).roof_id.apply(list)
+
+    features = {}
+    for dropbox_path, photo in dbx_load_photos(
+        roofs_by_photo.index, dropbox_app, bgr_only=True, catalog=catalog
+    ):
+        # full-size photos, as at inference: the features depend on the scale
+        for roof_id in roofs_by_photo[dropbox_path]:
+            roof_px_coord, _ = metadata.get_coordinates(roof_id)
+            roof_geometry = metadata.get_geometry(roof_id)
+            features[roof_id] = compute_roof_features(
+                rotate_and_crop_roof(photo, roof_px_coord, roof_geometry)
+            )
+
+    predictor = HyperparametersPredictor(n_neighbors).fit(
+        np.stack([features[roof_id] for roof_id in annotations.roof_id]), annotations
+    )
+
+    # the predictor is overwritten at every training
+    with BytesIO() as buffer:
+        predictor.save(buffer)
+        dbx.as_storage_backend(dropbox_app).upload(
+            buffer.getvalue(),
+            f"{DROPBOX_MODELS_PATH}/{filename}",
+        )
+
+    return predictor
@@ -0,0 +1,195 @@
+"""
+Pre-aggregated counts of roofs (a "cube") by photos folder, annotation status,
+continent, country and zoom level, to draw the charts of the metadata explorer.
+
+The cube is built once per `MetadataStore`, and it only has one cell per distinct
+combination of the dimensions: its size, and the time to slice it, do not depend on the
+number of roofs. When annotations change, only the cells of the roofs whose status
+changed are updated.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Iterable
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from k2_oai.data.store import MetadataStore
+
+__all__ = [
+    "CUBE_DIMENSIONS",
+    "MetadataCube",
+]
+
+# the dimensions of the cube, if they are columns of the roofs metadata. The annotation
+# status is an additional dimension, `is_annotated`.
+CUBE_DIMENSIONS = ("photos_folder", "continent", "name", "zoom")
+
+
+class MetadataCube:
+    """Number of roofs by the `CUBE_DIMENSIONS` and by annotation status.
+
+    Parameters
+    ----------
+    metadata : MetadataStore
+        The metadata of the roofs.
+    annotated_roof_ids : Iterable or None (default: None)
+        The roofs that are annotated.
+
+    Attributes
+    ----------
+    metadata : MetadataStore
+        The metadata the cube was built from.
+    dimensions : list[str]
+        The dimensions of the cube, i.e. the `CUBE_DIMENSIONS` in the metadata.
+    """
+
+    def __init__(
+        self, metadata: MetadataStore, annotated_roof_ids: Iterable | None = None
+    ):
+        self.metadata = metadata
+        self.dimensions = [
+            column for column in CUBE_DIMENSIONS if column in metadata.roofs.columns
+        ]
+        if not self.dimensions:
+            raise ValueError("The metadata has none of the `CUBE_DIMENSIONS`.")
+
+        # the cell of each roof, regardless of its annotation status
+        groups = metadata.roofs.groupby(
+            self.dimensions, observed=True, dropna=False, sort=True
+        )
+        self._roof_cells = groups.ngroup().to_numpy()
+        self._cells = groups.size().index.to_frame(index=False)
+
+        self._is_annotated = np.zeros(len(metadata), dtype=bool)
+        self._counts = np.zeros((len(self._cells), 2), dtype=np.int64)
+        np.add.at(self._counts, (self._roof_cells, 0), 1)
+
+        # the number of rows and the latest time of the annotations added so far
+        self._num_added = 0
+        self._latest_added = ""
+
+        if annotated_roof_ids is not None:
+            self.update_annotations(annotated_roof_ids)
+
+    def update_annotations(
+        self, roof_ids: Iterable, is_annotated: bool = True
+    ) -> MetadataCube:
+        """Marks the roofs as annotated (or not annotated) and updates their cells.
+        Roofs that are not in the metadata, or that already have the status, are
+        ignored.
+
+        Parameters
+        ----------
+        roof_ids : Iterable
+            The roofs whose annotation status changed.
+        is_annotated : bool (default: True)
+            The new annotation status of the roofs.
+
+        Returns
+        -------
+        MetadataCube
+            The cube itself, updated in place.
+        """
+        positions = np.fromiter(
+            (
+                self.metadata.position(roof_id)
+                for roof_id in set(roof_ids)
+                if roof_id in self.metadata
+            ),
+            dtype=np.intp,
+        )
+        positions = positions[self._is_annotated[positions] != is_annotated]
+
+        cells = self._roof_cells[positions]
+        np.add.at(self._counts, (cells, int(not is_annotated)), -1)
+        np.add.at(self._counts, (cells, int(is_annotated)), 1)
+        self._is_annotated[positions] = is_annotated
+
+        return self
+
+    def add_annotations(self, annotations: DataFrame) -> MetadataCube:
+        """Marks as annotated the roofs of the rows added to `annotations` since the
+        previous call, e.g. the annotations of the session.
+
+        Rows are only ever added to `annotations`, or replaced by a newer annotation of
+        the same roof: nothing is done if the number of rows did not change, and
+        otherwise only the rows not older than the latest one already added are
+        updated.
+
+        Parameters
+        ----------
+        annotations : DataFrame
+            The annotations, with the `roof_id` and `annotation_time` columns.
+
+        Returns
+        -------
+        MetadataCube
+            The cube itself, updated in place.
+        """
+        if len(annotations) == self._num_added:
+            return self
+
+        annotation_times = annotations.annotation_time.fillna("").astype(str)
+        is_new = (annotation_times >= self._latest_added).to_numpy()
+
+        self._num_added = len(annotations)
+        self._latest_added = annotation_times.max()
+        return self.update_annotations(annotations.roof_id[is_new].dropna())
+
+    @property
+    def num_annotated(self) -> int:
+        """The number of annotated roofs."""
+        return int(self._counts[:, 1].sum())
+
+    def slice(
+        self, by: list[str], is_annotated: bool | None = None, **filters: Any
+    ) -> DataFrame:
+        """Counts the roofs by some of the dimensions.
+
+        Parameters
+        ----------
+        by : list[str]
+            The dimensions to group by.
+        is_annotated : bool or None (default: None)
+            If not None, only counts the roofs with this annotation status.
+        **filters
+            Only counts the roofs with these values of the dimensions, e.g.
+            `continent="Europe"`.
+
+        Returns
+        -------
+        DataFrame
+            The dimensions in `by` and the number of roofs, in the `roofs` column.
+            Combinations with no roofs are dropped.
+        """
+        if is_annotated is None:
+            counts = self._counts.sum(axis=1)
+        else:
+            counts = self._counts[:, int(is_annotated)]
+
+        is_selected = counts > 0
+        for dimension, value in filters.items():
+            is_selected &= (self._cells[dimension] == value).to_numpy()
+
+        return (
+            self._cells.loc[is_selected, by]
+            .assign(roofs=counts[is_selected])
+            .groupby(by, observed=True, sort=True)
+            .roofs.sum()
+            .reset_index()
+        )
+
+    def to_frame(self) -> DataFrame:
+        """Returns all the non-empty cells of the cube, with the `is_annotated`
+        dimension and the number of roofs."""
+        cells = pd.concat(
+            [
+                self._cells.assign(is_annotated=False),
+                self._cells.assign(is_annotated=True),
+            ],
+            ignore_index=True,
+        )
+        return cells.assign(roofs=self._counts.T.ravel()).loc[lambda df: df.roofs > 0]
@@ -0,0 +1,391 @@
+"""
+Finds near-duplicate roofs, i.e. the same physical roof labelled in more than one photo
+or with slightly shifted coordinates, which exact duplicates (see
+`MetadataStore.find_duplicates`) cannot catch.
+
+The roofs are projected to Web Mercator (see `photo_pixels_to_web_mercator`) and
+bucketed in a grid of cells: only roofs in the same or in neighbouring cells, whose
+bounding boxes intersect, are compared, so that the number of comparisons grows with
+the number of roofs, not with its square. Two roofs are duplicates if their polygons
+overlap enough (see `polygons_overlap`): bounding boxes are not enough, since the boxes
+of rotated or L-shaped neighbouring roofs overlap even if the roofs do not.
+
+Duplicates are grouped around seed roofs, in the order of the roofs: a roof is a seed
+unless it overlaps an earlier seed, and its canonical roof is the first seed it
+overlaps. Every roof overlaps its canonical roof directly, so a row of neighbouring
+roofs that overlap each other a little never collapses onto a single roof.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+
+from k2_oai.data.spatial import PHOTO_SIZE, photo_pixels_to_web_mercator
+
+__all__ = [
+    "roofs_web_mercator_polygons",
+    "polygons_overlap",
+    "find_near_duplicates",
+]
+
+# the distance, relative to the length of an edge, within which a point is on the edge
+_BOUNDARY_TOLERANCE = 1e-9
+
+
+def roofs_web_mercator_polygons(
+    vertices: ndarray,
+    offsets: ndarray,
+    center_lat,
+    center_lng,
+    zoom,
+    photo_size=PHOTO_SIZE,
+) -> ndarray:
+    """Projects the polygons of the roofs to Web Mercator.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) vertices of the roofs, in the pixel coordinates of their photo.
+    offsets : ndarray
+        The (R + 1) offsets of the roofs (see `k2_oai.utils._geometry`).
+    center_lat, center_lng, zoom : ArrayLike
+        The (R,) centres and zoom levels of the photos of the roofs.
+    photo_size : tuple[int, int] (default: PHOTO_SIZE)
+        The size of the photos, in pixels, as (width, height).
+
+    Returns
+    -------
+    ndarray
+        The (N, 2) vertices, in metres of the projection, with the same offsets. The
+        vertices of roofs with no location are missing.
+    """
+    num_vertices = np.diff(offsets)
+
+    x, y = photo_pixels_to_web_mercator(
+        vertices[:, 0],
+        vertices[:, 1],
+        np.repeat(np.asarray(center_lat, dtype=np.float64), num_vertices),
+        np.repeat(np.asarray(center_lng, dtype=np.float64), num_vertices),
+        np.repeat(np.asarray(zoom, dtype=np.float64), num_vertices),
+        photo_size,
+    )
+    return np.column_stack([x, y])
+
+
+def _ragged_arange(counts: ndarray) -> ndarray:
+    # 0, 1, ..., count - 1 for every count, concatenated
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(starts.size) - starts
+
+
+def _cross(a: ndarray, b: ndarray) -> ndarray:
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+
+def _polygon_edges(
+    vertices: ndarray, offsets: ndarray, polygons: ndarray
+) -> tuple[ndarray, ndarray, ndarray]:
+    # the edges of the polygons, as (start, end), with their offsets
+    num_vertices = np.diff(offsets)[polygons]
+    edge_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum(num_vertices, out=edge_offsets[1:])
+
+    first_vertices = np.repeat(offsets[polygons], num_vertices)
+    local_index = _ragged_arange(num_vertices)
+    next_index = (local_index + 1) % np.repeat(num_vertices, num_vertices)
+
+    return (
+        vertices[first_vertices + local_index],
+        vertices[first_vertices + next_index],
+        edge_offsets,
+    )
+
+
+def _boundary_inside(
+    starts: ndarray,
+    ends: ndarray,
+    edge_pairs: ndarray,
+    signs: ndarray,
+    clip_starts: ndarray,
+    clip_ends: ndarray,
+    clip_offsets: ndarray,
+    clip_signs: ndarray,
+    keep_shared: bool,
+) -> ndarray:
+    # the integral of `x dy - y dx` / 2 along the parts of the edges inside the other
+    # polygon of their pair, oriented counterclockwise (Green's theorem): with the
+    # parts of the edges of the other polygon inside the first, it is the area of the
+    # intersection. Parts on the boundary of both polygons, with the same direction,
+    # are only counted once, when `keep_shared` is True.
+    num_pairs = len(signs)
+    directions = ends - starts
+
+    # 1. split every edge where it crosses the edges of the other polygon
+    counts = np.diff(clip_offsets)[edge_pairs]
+    edges = np.repeat(np.arange(len(starts)), counts)
+    clip_edges = np.repeat(clip_offsets[edge_pairs], counts) + _ragged_arange(counts)
+
+    clip_directions = clip_ends[clip_edges] - clip_starts[clip_edges]
+    offsets = clip_starts[clip_edges] - starts[edges]
+    denominators = _cross(directions[edges], clip_directions)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = _cross(offsets, clip_directions) / denominators
+        u = _cross(offsets, directions[edges]) / denominators
+    crosses = (denominators != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+
+    break_edges = np.concatenate(
+        [np.arange(len(starts)), np.arange(len(starts)), edges[crosses]]
+    )
+    break_t = np.concatenate([np.zeros(len(starts)), np.ones(len(starts)), t[crosses]])
+    order = np.lexsort((break_t, break_edges))
+    break_edges, break_t = break_edges[order], break_t[order]
+
+    is_part = break_edges[:-1] == break_edges[1:]
+    part_edges = break_edges[:-1][is_part]
+    part_starts = (
+        starts[part_edges] + break_t[:-1][is_part, None] * directions[part_edges]
+    )
+    part_ends = starts[part_edges] + break_t[1:][is_part, None] * directions[part_edges]
+    midpoints = (part_starts + part_ends) / 2
+    part_pairs = edge_pairs[part_edges]
+
+    # 2. the parts do not cross the other polygon: they are inside if their midpoint
+    # is, by the crossing number of a ray to the right
+    counts = np.diff(clip_offsets)[part_pairs]
+    parts = np.repeat(np.arange(len(part_edges)), counts)
+    clip_edges = np.repeat(clip_offsets[part_pairs], counts) + _ragged_arange(counts)
+
+    a, b, points = clip_starts[clip_edges], clip_ends[clip_edges], midpoints[parts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_crossing = a[:, 0] + (points[:, 1] - a[:, 1]) * (b[:, 0] - a[:, 0]) / (
+            b[:, 1] - a[:, 1]
+        )
+    crossings = ((a[:, 1] > points[:, 1]) != (b[:, 1] > points[:, 1])) & (
+        points[:, 0] < x_crossing
+    )
+    is_inside = np.bincount(parts, crossings, minlength=len(part_edges)) % 2 == 1
+
+    # midpoints on an edge of the other polygon
+    clip_directions = b - a
+    lengths = (clip_directions**2).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        projections = np.clip(
+            ((points - a) * clip_directions).sum(axis=1) / lengths, 0, 1
+        )
+    distances = ((a + projections[:, None] * clip_directions - points) ** 2).sum(axis=1)
+    is_on_edge = (lengths > 0) & (distances <= _BOUNDARY_TOLERANCE**2 * lengths)
+    is_same_direction = (
+        (directions[part_edges][parts] * clip_directions).sum(axis=1)
+        * signs[part_pairs][parts]
+        * clip_signs[part_pairs][parts]
+    ) > 0
+
+    is_on_boundary = np.bincount(parts, is_on_edge, minlength=len(part_edges)) > 0
+    is_shared = (
+        np.bincount(parts, is_on_edge & is_same_direction, minlength=len(part_edges))
+        > 0
+    )
+    is_counted = (is_inside & ~is_on_boundary) | (keep_shared & is_shared)
+
+    return np.bincount(
+        part_pairs[is_counted],
+        signs[part_pairs[is_counted]]
+        * _cross(part_starts[is_counted], part_ends[is_counted])
+        / 2,
+        minlength=num_pairs,
+    )
+
+
+def polygons_overlap(
+    vertices: ndarray, offsets: ndarray, first: ndarray, second: ndarray
+) -> ndarray:
+    """Computes the intersection over union of pairs of polygons, e.g. roofs.
+
+    The polygons are not necessarily convex, but they must be simple, i.e. their
+    edges must not cross each other. All the pairs are computed at once, with no
+    Python object per polygon.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) vertices of the polygons.
+    offsets : ndarray
+        The (M + 1) offsets of the polygons (see `k2_oai.utils._geometry`).
+    first, second : ArrayLike
+        The (P,) indices of the polygons of each pair.
+
+    Returns
+    -------
+    ndarray
+        The (P,) intersections over union, in [0, 1].
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    first = np.asarray(first, dtype=np.intp)
+    second = np.asarray(second, dtype=np.intp)
+    num_pairs = len(first)
+
+    first_starts, first_ends, first_offsets = _polygon_edges(vertices, offsets, first)
+    second_starts, second_ends, second_offsets = _polygon_edges(
+        vertices, offsets, second
+    )
+    first_pairs = np.repeat(np.arange(num_pairs), np.diff(first_offsets))
+    second_pairs = np.repeat(np.arange(num_pairs), np.diff(second_offsets))
+
+    # move each pair close to the origin, so that the products of coordinates (e.g.
+    # in metres of the projection) do not lose precision
+    origins = vertices[np.minimum(offsets[first], len(vertices) - 1)]
+    first_starts = first_starts - origins[first_pairs]
+    first_ends = first_ends - origins[first_pairs]
+    second_starts = second_starts - origins[second_pairs]
+    second_ends = second_ends - origins[second_pairs]
+
+    # the shoelace formula: the sign tells the orientation of the polygon
+    first_areas = (
+        np.bincount(first_pairs, _cross(first_starts, first_ends), minlength=num_pairs)
+        / 2
+    )
+    second_areas = (
+        np.bincount(
+            second_pairs, _cross(second_starts, second_ends), minlength=num_pairs
+        )
+        / 2
+    )
+    first_signs, second_signs = np.sign(first_areas), np.sign(second_areas)
+
+    intersection = _boundary_inside(
+        first_starts,
+        first_ends,
+        first_pairs,
+        first_signs,
+        second_starts,
+        second_ends,
+        second_offsets,
+        second_signs,
+        keep_shared=True,
+    ) + _boundary_inside(
+        second_starts,
+        second_ends,
+        second_pairs,
+        second_signs,
+        first_starts,
+        first_ends,
+        first_offsets,
+        first_signs,
+        keep_shared=False,
+    )
+    intersection = np.clip(intersection, 0, None).astype(np.float64)
+    union = np.abs(first_areas) + np.abs(second_areas) - intersection
+
+    return np.clip(
+        np.divide(
+            intersection, union, out=np.zeros_like(intersection), where=union > 0
+        ),
+        0,
+        1,
+    )
+
+
+def _candidate_pairs(centers: ndarray, cell_size: float) -> tuple[ndarray, ndarray]:
+    cells = pd.DataFrame(
+        np.floor(centers / cell_size).astype(np.int64), columns=["cell_x", "cell_y"]
+    ).assign(roof=np.arange(len(centers)))
+
+    neighbours = pd.concat(
+        [
+            cells.assign(cell_x=cells.cell_x + dx, cell_y=cells.cell_y + dy)
+            for dx in (-1, 0, 1)
+            for dy in (-1, 0, 1)
+        ],
+        ignore_index=True,
+    )
+    pairs = cells.merge(neighbours, on=["cell_x", "cell_y"], suffixes=("", "_other"))
+    pairs = pairs.loc[pairs.roof < pairs.roof_other]
+
+    return pairs.roof.to_numpy(), pairs.roof_other.to_numpy()
+
+
+def _seed_roofs(num_roofs: int, first: ndarray, second: ndarray) -> ndarray:
+    # greedy grouping in the order of the roofs, with `first < second` in every
+    # pair: a roof is a seed unless it overlaps an earlier seed. The seeds are found
+    # by fixed-point iteration: each one fixes the roofs that only depend on earlier
+    # ones, so it takes as many iterations as the longest chain of overlaps
+    is_seed = np.ones(num_roofs, dtype=bool)
+    while True:
+        overlaps_seed = np.zeros(num_roofs, dtype=bool)
+        overlaps_seed[second[is_seed[first]]] = True
+        if np.array_equal(is_seed, ~overlaps_seed):
+            break
+        is_seed = ~overlaps_seed
+
+    # the canonical roof of every roof is the first seed it overlaps directly
+    canonical = np.arange(num_roofs)
+    from_seed = is_seed[first]
+    np.minimum.at(canonical, second[from_seed], first[from_seed])
+    return canonical
+
+
+def find_near_duplicates(
+    vertices: ndarray,
+    offsets: ndarray,
+    cell_size: float = 50.0,
+    min_overlap: float = 0.5,
+) -> ndarray:
+    """Groups the roofs whose polygons overlap around seed roofs (see the module
+    docstring).
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) vertices of the roofs, e.g. as returned by
+        `roofs_web_mercator_polygons`. Roofs with missing vertices are never
+        duplicates.
+    offsets : ndarray
+        The (R + 1) offsets of the roofs.
+    cell_size : float (default: 50.0)
+        The size of the cells of the grid, in the units of `vertices`. Roofs whose
+        centres are farther than a cell apart are never compared, so it should be
+        larger than the shift between duplicates.
+    min_overlap : float (default: 0.5)
+        The minimum intersection over union of the polygons of two duplicates.
+
+    Returns
+    -------
+    ndarray
+        The (R,) index of the canonical roof of each roof, i.e. the seed of its
+        group. Roofs with no duplicates are their own canonical roof.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    num_vertices = np.diff(offsets)
+    num_roofs = len(num_vertices)
+
+    boxes = np.full((num_roofs, 4), np.nan)
+    has_vertices = num_vertices > 0
+    starts = offsets[:-1][has_vertices]
+    boxes[has_vertices, :2] = np.minimum.reduceat(vertices, starts, axis=0)
+    boxes[has_vertices, 2:] = np.maximum.reduceat(vertices, starts, axis=0)
+
+    positions = np.flatnonzero(np.isfinite(boxes).all(axis=1) & (num_vertices >= 3))
+    located_boxes = boxes[positions]
+
+    first, second = _candidate_pairs(
+        (located_boxes[:, :2] + located_boxes[:, 2:]) / 2, cell_size
+    )
+    # the polygons of roofs whose boxes do not intersect cannot overlap
+    boxes_intersect = (
+        np.minimum(located_boxes[first, 2:], located_boxes[second, 2:])
+        > np.maximum(located_boxes[first, :2], located_boxes[second, :2])
+    ).all(axis=1)
+    first, second = first[boxes_intersect], second[boxes_intersect]
+
+    is_duplicate = (
+        polygons_overlap(vertices, offsets, positions[first], positions[second])
+        >= min_overlap
+    )
+
+    seeds = _seed_roofs(len(positions), first[is_duplicate], second[is_duplicate])
+
+    canonical = np.arange(num_roofs)
+    canonical[positions] = positions[seeds]
+    return canonical
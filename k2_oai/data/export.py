@@ -0,0 +1,401 @@
+"""
+Exports the detected obstacles to geographic coordinates, as GeoParquet files.
+
+The obstacles detected by `obstacle_detection_pipeline` are in the pixel coordinates
+of the cropped roofs. All the obstacles are mapped at once, as a ragged array (see
+`k2_oai.utils._geometry`): to the pixel coordinates of the satellite photos (inverting
+the crop of each roof), then to Web Mercator, from the centre and the zoom level of
+the photos, and finally to WGS84.
+
+The geometries are encoded as WKB directly from the arrays, with no Python object per
+obstacle, and written with pyarrow following the GeoParquet specification[1].
+
+References
+----------
+.. [1] https://geoparquet.org/releases/v1.0.0/
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Iterable, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from numpy import ndarray
+
+from k2_oai.data.spatial import (
+    PHOTO_SIZE,
+    ground_resolution,
+    photo_pixels_to_web_mercator,
+    web_mercator_to_lat_lng,
+)
+from k2_oai.data.store import MetadataStore
+from k2_oai.utils import crop_transforms_from_geometry, invert_affine_transforms
+
+__all__ = [
+    "stack_detected_obstacles",
+    "obstacles_to_photo_pixels",
+    "obstacles_to_wgs84",
+    "polygons_area",
+    "polygons_to_wkb",
+    "write_obstacles_geoparquet",
+]
+
+
+def stack_detected_obstacles(
+    roof_ids: Sequence, detections: Iterable[list]
+) -> tuple[ndarray, ndarray, ndarray]:
+    """Stacks the obstacles detected on many roofs into a ragged array.
+
+    Parameters
+    ----------
+    roof_ids : Sequence
+        The roofs the obstacles were detected on.
+    detections : Iterable[list]
+        For each roof, the obstacles returned by `obstacle_detection_pipeline`: either
+        bounding boxes, as (top-left, bottom-right) points, or polygons, as
+        (n, 1, 2) contours.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray, ndarray]
+        The roof of each obstacle, the (N, 2) vertices (float64) and the (M + 1)
+        offsets of the obstacles, in the coordinates of the cropped roofs. Boxes are
+        converted to polygons with 4 vertices.
+    """
+    obstacle_roof_ids, polygons = [], []
+
+    for roof_id, obstacles in zip(roof_ids, detections):
+        for obstacle in obstacles:
+            polygon = np.asarray(obstacle, dtype=np.float64).reshape(-1, 2)
+            if len(polygon) == 2:
+                (left, top), (right, bottom) = polygon
+                polygon = np.array(
+                    [[left, top], [right, top], [right, bottom], [left, bottom]]
+                )
+            obstacle_roof_ids.append(roof_id)
+            polygons.append(polygon)
+
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum([len(polygon) for polygon in polygons], out=offsets[1:])
+
+    if not polygons:
+        return np.asarray(obstacle_roof_ids), np.empty((0, 2)), offsets
+    return np.asarray(obstacle_roof_ids), np.concatenate(polygons), offsets
+
+
+def obstacles_to_photo_pixels(
+    metadata: MetadataStore, obstacle_roof_ids, vertices: ndarray, offsets: ndarray
+) -> ndarray:
+    """Maps obstacles from the coordinates of the cropped roofs to the coordinates of
+    the satellite photos, i.e. inverts the crop of their roofs.
+
+    Parameters
+    ----------
+    metadata : MetadataStore
+        The metadata of the roofs, with their geometry.
+    obstacle_roof_ids : ArrayLike
+        The (M,) roof of each obstacle.
+    vertices : ndarray
+        The (N, 2) vertices of the obstacles, in the coordinates of the cropped roofs.
+    offsets : ndarray
+        The (M + 1) offsets of the obstacles.
+
+    Returns
+    -------
+    ndarray
+        The (N, 2) vertices (float64), in the pixel coordinates of the photos.
+    """
+    return _obstacles_to_photo_pixels(
+        metadata, _roof_positions(metadata, obstacle_roof_ids), vertices, offsets
+    )
+
+
+def _obstacles_to_photo_pixels(
+    metadata: MetadataStore, positions: ndarray, vertices: ndarray, offsets: ndarray
+) -> ndarray:
+    transforms, _ = crop_transforms_from_geometry(metadata.roofs.iloc[positions])
+    inverse_transforms = np.repeat(
+        invert_affine_transforms(transforms), np.diff(offsets), axis=0
+    )
+
+    return (
+        np.einsum("nij,nj->ni", inverse_transforms[:, :, :2], vertices)
+        + inverse_transforms[:, :, 2]
+    )
+
+
+def _roof_positions(metadata: MetadataStore, roof_ids) -> ndarray:
+    # the position of each roof in the metadata, whose roofs are sorted by id
+    roof_ids = np.asarray(roof_ids)
+    positions = np.searchsorted(metadata.roof_ids, roof_ids)
+
+    is_found = positions < len(metadata.roof_ids)
+    is_found[is_found] = metadata.roof_ids[positions[is_found]] == roof_ids[is_found]
+    if not is_found.all():
+        raise KeyError(f"Roof {roof_ids[~is_found][0]} is not in the metadata.")
+
+    return positions
+
+
+def obstacles_to_wgs84(
+    metadata: MetadataStore,
+    obstacle_roof_ids,
+    vertices: ndarray,
+    offsets: ndarray,
+    photo_size=PHOTO_SIZE,
+) -> ndarray:
+    """Maps obstacles from the coordinates of the cropped roofs to WGS84.
+
+    Parameters
+    ----------
+    metadata : MetadataStore
+        The metadata of the roofs, with their geometry, the centres and the zoom
+        levels of their photos.
+    obstacle_roof_ids : ArrayLike
+        The (M,) roof of each obstacle.
+    vertices : ndarray
+        The (N, 2) vertices of the obstacles, in the coordinates of the cropped roofs.
+    offsets : ndarray
+        The (M + 1) offsets of the obstacles.
+    photo_size : tuple[int, int] (default: PHOTO_SIZE)
+        The size of the photos, in pixels, as (width, height).
+
+    Returns
+    -------
+    ndarray
+        The (N, 2) vertices, as (longitude, latitude) in degrees.
+    """
+    return _obstacles_to_wgs84(
+        metadata,
+        _roof_positions(metadata, obstacle_roof_ids),
+        vertices,
+        offsets,
+        photo_size,
+    )
+
+
+def _obstacles_to_wgs84(
+    metadata: MetadataStore,
+    positions: ndarray,
+    vertices: ndarray,
+    offsets: ndarray,
+    photo_size=PHOTO_SIZE,
+) -> ndarray:
+    pixels = _obstacles_to_photo_pixels(metadata, positions, vertices, offsets)
+
+    vertex_positions = np.repeat(positions, np.diff(offsets))
+    center_lat, center_lng = (
+        location.to_numpy(dtype=np.float64)[vertex_positions]
+        for location in metadata._locations()
+    )
+    zoom = metadata.roofs.zoom.to_numpy(dtype=np.float64)[vertex_positions]
+
+    lat, lng = web_mercator_to_lat_lng(
+        *photo_pixels_to_web_mercator(
+            pixels[:, 0], pixels[:, 1], center_lat, center_lng, zoom, photo_size
+        )
+    )
+    return np.column_stack([lng, lat])
+
+
+def polygons_area(vertices: ndarray, offsets: ndarray) -> ndarray:
+    """Computes the area of many polygons at once, with the shoelace formula.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) vertices of the polygons.
+    offsets : ndarray
+        The (M + 1) offsets of the polygons.
+
+    Returns
+    -------
+    ndarray
+        The (M,) areas, in the squared units of the vertices.
+    """
+    num_vertices = np.diff(offsets)
+    is_empty = num_vertices == 0
+    # the next vertex of each vertex, wrapping around to the first of its polygon
+    next_vertex = np.arange(len(vertices)) + 1
+    next_vertex[offsets[1:][~is_empty] - 1] = offsets[:-1][~is_empty]
+
+    cross = (
+        vertices[:, 0] * vertices[next_vertex, 1]
+        - vertices[next_vertex, 0] * vertices[:, 1]
+    )
+    areas = np.bincount(
+        np.repeat(np.arange(len(num_vertices)), num_vertices),
+        weights=cross,
+        minlength=len(num_vertices),
+    )
+
+    return np.abs(areas) / 2
+
+
+def polygons_to_wkb(vertices: ndarray, offsets: ndarray) -> pa.BinaryArray:
+    """Encodes polygons as WKB (little endian), without a Python object per polygon.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) vertices of the polygons, as (x, y).
+    offsets : ndarray
+        The (M + 1) offsets of the polygons, with at least one vertex each. The rings
+        are closed in the WKB.
+
+    Returns
+    -------
+    pyarrow.BinaryArray
+        The (M,) WKB geometries.
+    """
+    num_vertices = np.diff(offsets)
+    num_points = num_vertices + 1
+
+    # byte order (1), geometry type (4), number of rings (4), number of points (4),
+    # then 16 bytes for each point
+    sizes = 13 + 16 * num_points
+    wkb_offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=wkb_offsets[1:])
+    starts = wkb_offsets[:-1]
+
+    buffer = np.zeros(wkb_offsets[-1], dtype=np.uint8)
+    buffer[starts] = 1
+    header = np.array([3, 1], dtype="<u4").view(np.uint8)
+    buffer[starts[:, None] + 1 + np.arange(8)] = header
+    buffer[starts[:, None] + 9 + np.arange(4)] = (
+        num_points.astype("<u4").view(np.uint8).reshape(-1, 4)
+    )
+
+    # close the rings, repeating the first vertex of each polygon: the i-th point
+    # of the rings is the vertex i - p, where p is the polygon of the point
+    point_polygons = np.repeat(np.arange(len(num_vertices)), num_points)
+    ring_index = np.arange(len(point_polygons)) - point_polygons
+    ring_index[np.cumsum(num_points) - 1] = offsets[:-1]
+    points = np.ascontiguousarray(vertices[ring_index], dtype="<f8").view(np.uint8)
+
+    first_points = np.cumsum(num_points) - num_points
+    point_starts = (starts + 13 - 16 * first_points)[point_polygons] + 16 * np.arange(
+        len(point_polygons)
+    )
+    buffer[point_starts[:, None] + np.arange(16)] = points.reshape(-1, 16)
+
+    return pa.LargeBinaryArray.from_buffers(
+        pa.large_binary(),
+        len(sizes),
+        [None, pa.py_buffer(wkb_offsets), pa.py_buffer(buffer)],
+    )
+
+
+def write_obstacles_geoparquet(
+    root_path: str,
+    metadata: MetadataStore,
+    obstacle_roof_ids,
+    vertices: ndarray,
+    offsets: ndarray,
+    partition_cols: Sequence[str] = ("photos_folder",),
+    photo_size=PHOTO_SIZE,
+) -> pa.Table:
+    """Writes the detected obstacles to a GeoParquet dataset, partitioned by some
+    columns of the roofs metadata.
+
+    Parameters
+    ----------
+    root_path : str
+        The folder of the dataset.
+    metadata : MetadataStore
+        The metadata of the roofs the obstacles were detected on.
+    obstacle_roof_ids : ArrayLike
+        The (M,) roof of each obstacle.
+    vertices : ndarray
+        The (N, 2) vertices of the obstacles, in the coordinates of the cropped roofs
+        (see `stack_detected_obstacles`).
+    offsets : ndarray
+        The (M + 1) offsets of the obstacles.
+    partition_cols : Sequence[str] (default: ("photos_folder",))
+        The columns of the roofs metadata to partition the dataset by.
+    photo_size : tuple[int, int] (default: PHOTO_SIZE)
+        The size of the photos, in pixels, as (width, height).
+
+    Returns
+    -------
+    pyarrow.Table
+        The obstacles: roof, WGS84 polygon, centroid, area in square metres and the
+        partition columns. Obstacles of roofs with no location are dropped.
+    """
+    obstacle_roof_ids = np.asarray(obstacle_roof_ids)
+    positions = _roof_positions(metadata, obstacle_roof_ids)
+    geo_vertices = _obstacles_to_wgs84(
+        metadata, positions, vertices, offsets, photo_size
+    )
+
+    num_vertices = np.diff(offsets)
+    vertex_obstacles = np.repeat(np.arange(len(num_vertices)), num_vertices)
+    num_unlocated = np.bincount(
+        vertex_obstacles[~np.isfinite(geo_vertices).all(axis=1)],
+        minlength=len(num_vertices),
+    )
+    is_located = (num_unlocated == 0) & (num_vertices > 0)
+
+    # keep the located obstacles, with their vertices
+    is_located_vertex = is_located[vertex_obstacles]
+    geo_vertices = geo_vertices[is_located_vertex]
+    vertices = vertices[is_located_vertex]
+    vertex_obstacles = np.cumsum(is_located)[vertex_obstacles[is_located_vertex]] - 1
+    num_vertices = num_vertices[is_located]
+    offsets = np.concatenate([[0], np.cumsum(num_vertices)])
+    obstacle_roof_ids = obstacle_roof_ids[is_located]
+    positions = positions[is_located]
+
+    centroids = (
+        np.column_stack(
+            [
+                np.bincount(vertex_obstacles, geo_vertices[:, axis], len(num_vertices))
+                for axis in (0, 1)
+            ]
+        )
+        / num_vertices[:, None]
+    )
+
+    # the area in the pixels of the photo (the crop is a rotation), times the area of
+    # a pixel on the ground
+    zoom = metadata.roofs.zoom.to_numpy(dtype=np.float64)[positions]
+    areas = (
+        polygons_area(vertices, offsets) * ground_resolution(centroids[:, 1], zoom) ** 2
+    )
+
+    columns = {
+        "roof_id": pa.array(obstacle_roof_ids),
+        "geometry": polygons_to_wkb(geo_vertices, offsets),
+        "centroid_lng": pa.array(centroids[:, 0]),
+        "centroid_lat": pa.array(centroids[:, 1]),
+        "area_m2": pa.array(areas),
+    }
+    for column in partition_cols:
+        columns[column] = pa.array(
+            metadata.roofs[column].astype(str).to_numpy()[positions]
+        )
+
+    geo_metadata = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Polygon"],
+                "bbox": [
+                    *geo_vertices.min(axis=0).tolist(),
+                    *geo_vertices.max(axis=0).tolist(),
+                ]
+                if len(geo_vertices)
+                else [],
+            }
+        },
+    }
+    table = pa.table(columns).replace_schema_metadata({"geo": json.dumps(geo_metadata)})
+
+    pq.write_to_dataset(table, root_path, partition_cols=list(partition_cols))
+
+    return table
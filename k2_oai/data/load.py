@@ -2,107 +2,421 @@
 Loads data and photos from Dropbox
 """
 
-import os
+from __future__ import annotations
+
+from io import BytesIO
+from typing import Iterator
 
-import cv2 as cv
 import geopandas
 import pandas as pd
+import pyarrow.parquet as pq
+from dropbox.exceptions import ApiError
+from numpy import ndarray
+from pandas import DataFrame
 
 from k2_oai import dropbox as dbx
-from k2_oai.dropbox import DROPBOX_LABEL_ANNOTATIONS_PATH, DROPBOX_PHOTOS_METADATA_PATH
-from k2_oai.utils import draw_labels_on_photo, rotate_and_crop_roof
+from k2_oai.data.annotations import (
+    LABEL_ANNOTATIONS_SNAPSHOT,
+    merge_label_annotations,
+    read_label_annotations_snapshot,
+    write_label_annotations_snapshot,
+)
+from k2_oai.data.catalog import PHOTO_CATALOG_FILE, PhotoCatalog
+from k2_oai.data.store import MetadataStore, require_metadata_store
+from k2_oai.dropbox import (
+    DROPBOX_LABEL_ANNOTATIONS_PATH,
+    DROPBOX_MAX_WORKERS,
+    DROPBOX_MODELS_PATH,
+    DROPBOX_PHOTOS_METADATA_PATH,
+    DROPBOX_RAW_PHOTOS_ROOT,
+)
+from k2_oai.hyperparameter_prediction import HyperparametersPredictor
+from k2_oai.utils import (
+    draw_labels_on_photo,
+    read_photo_from_bytestring,
+    rotate_and_crop_roof,
+    scale_coordinates,
+)
 
 __all__ = [
+    "METADATA_FILE",
+    "GEO_METADATA_FILE",
+    "METADATA_COLUMNS",
+    "metadata_partition_path",
     "dbx_load_dataframe",
+    "dbx_load_dataframes",
+    "dbx_load_photo_list",
     "dbx_load_metadata",
     "dbx_load_geo_metadata",
+    "dbx_read_label_annotations",
+    "dbx_create_label_annotations",
     "dbx_load_label_annotations",
+    "dbx_load_hyperparameters_predictor",
+    "dbx_load_photo_catalog",
     "dbx_load_photo",
+    "dbx_load_photos",
     "dbx_load_photos_from_roof_id",
 ]
 
 
-def dbx_load_dataframe(filename, dropbox_path, dropbox_app):
+METADATA_FILE = "join-roofs_images_obstacles.parquet"
+GEO_METADATA_FILE = "geometries-roofs_images_obstacles.parquet"
+# the consolidated label annotations, before `LABEL_ANNOTATIONS_SNAPSHOT`
+_LEGACY_LABEL_ANNOTATIONS = "obstacles-labels_annotations.csv"
+
+# the columns of the metadata read by default: the geometry of the geo metadata is
+# not read, since it is the same as `lon` and `lat`
+METADATA_COLUMNS = [
+    "roof_id",
+    "imageURL",
+    "pixelCoordinates_roof",
+    "obstacle_id",
+    "pixelCoordinates_obstacle",
+    "zoom",
+    "continent",
+    "name",
+    "photos_folder",
+    "center_lat",
+    "center_lng",
+    "lat",
+    "lon",
+]
 
-    dropbox_file = f"{dropbox_path}/{filename}"
 
-    dropbox_app.files_download_to_file(filename, dropbox_file)
+def metadata_partition_path(filename: str, photos_folder: str) -> tuple[str, str]:
+    """Returns the name and the Dropbox folder of the partition of the metadata file
+    with the photos in `photos_folder` (see `dbx_create_metadata_partitions`).
+
+    Parameters
+    ----------
+    filename : str
+        The name of the metadata file, e.g. `METADATA_FILE`.
+    photos_folder : str
+        The name of the photos folder.
+
+    Returns
+    -------
+    tuple[str, str]
+        The name of the partition and the Dropbox folder it is stored in.
+    """
+    partitions_folder = filename.rsplit(".", maxsplit=1)[0]
+    return (
+        f"{photos_folder}.parquet",
+        f"{DROPBOX_PHOTOS_METADATA_PATH}/{partitions_folder}",
+    )
 
-    if filename.endswith(".parquet"):
-        data = pd.read_parquet(filename)
-    elif filename.endswith(".csv"):
-        data = pd.read_csv(filename)
-    else:
+
+def dbx_load_dataframe(filename, dropbox_path, dropbox_app, columns=None, filters=None):
+    """Loads a .parquet or .csv file from Dropbox.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file.
+    dropbox_path : str
+        The Dropbox folder of the file.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    columns : list[str] or None (default: None)
+        The columns to read. Columns that are not in the file are ignored. If None,
+        reads all the columns.
+    filters : list[tuple] or None (default: None)
+        Only for .parquet files: the filters on the rows, e.g.
+        `[("imageURL", "in", photos)]`, pushed down to the reader. Row groups whose
+        statistics do not match the filters are skipped.
+
+    Returns
+    -------
+    DataFrame
+        The data.
+
+    Notes
+    -----
+    The file is downloaded through the local cache (see `DropboxCache`): it is only
+    downloaded again if it changed on Dropbox.
+    """
+
+    if filename.endswith(".csv") and filters is not None:
+        raise ValueError("Filters are only supported for .parquet files")
+    if not filename.endswith((".parquet", ".csv")):
         raise ValueError("File must be either .parquet or .csv")
 
-    os.remove(filename)
+    local_file = dbx.dropbox_download_cached(dropbox_app, f"{dropbox_path}/{filename}")
+
+    if filename.endswith(".parquet"):
+        if columns is not None:
+            file_columns = pq.read_schema(local_file).names
+            columns = [column for column in columns if column in file_columns]
+        return pd.read_parquet(local_file, columns=columns, filters=filters)
+
+    return pd.read_csv(
+        local_file,
+        usecols=None if columns is None else lambda column: column in columns,
+    )
+
 
-    return data
+def dbx_load_dataframes(
+    filenames, dropbox_path, dropbox_app, max_workers=DROPBOX_MAX_WORKERS
+) -> list[DataFrame]:
+    """Loads many .parquet or .csv files from the same Dropbox folder, e.g.
+    checkpoints, concurrently (see `dropbox_map_concurrently`).
+
+    Parameters
+    ----------
+    filenames : Iterable[str]
+        The names of the files.
+    dropbox_path : str
+        The Dropbox folder of the files.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of concurrent downloads.
+
+    Returns
+    -------
+    list[DataFrame]
+        The data of each file, in the order of `filenames`.
+    """
+    filenames = list(filenames)
+
+    dataframes = dict(
+        dbx.dropbox_map_concurrently(
+            lambda filename: dbx_load_dataframe(filename, dropbox_path, dropbox_app),
+            filenames,
+            max_workers,
+        )
+    )
+
+    return [dataframes[filename] for filename in filenames]
 
 
 def dbx_load_geodataframe(filename, dropbox_path, crs, dropbox_app):
 
-    dropbox_file = f"{dropbox_path}/{filename}"
+    local_file = dbx.dropbox_download_cached(dropbox_app, f"{dropbox_path}/{filename}")
 
-    dropbox_app.files_download_to_file(filename, dropbox_file)
+    return geopandas.read_file(local_file, crs=crs)
 
-    data = geopandas.read_file(filename, crs=crs)
-    os.remove(filename)
 
-    return data
+def dbx_load_photo_list(photos_folder, dropbox_app) -> DataFrame:
+    """Lists the photos in the folder, from its index file if there is one.
 
+    Parameters
+    ----------
+    photos_folder : str
+        The name of the photos folder, in `DROPBOX_RAW_PHOTOS_ROOT`.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+
+    Returns
+    -------
+    DataFrame
+        The list of photos, in the `item_name` column.
+    """
+    root_contents = dbx.dropbox_listdir(DROPBOX_RAW_PHOTOS_ROOT, dropbox_app)
+    index_file = f"index-{photos_folder}.csv"
+
+    if index_file in root_contents.item_name.values:
+        return dbx_load_dataframe(index_file, DROPBOX_RAW_PHOTOS_ROOT, dropbox_app)
+
+    photos_path = f"{DROPBOX_RAW_PHOTOS_ROOT}/{photos_folder}"
+    return dbx.dropbox_listdir(photos_path, dropbox_app)[["item_name"]]
 
-def dbx_load_metadata(dropbox_app):
-    return dbx_load_dataframe(
-        "join-roofs_images_obstacles.parquet",
-        dropbox_path=DROPBOX_PHOTOS_METADATA_PATH,
-        dropbox_app=dropbox_app,
-    )
 
+def _dbx_load_metadata_file(
+    filename, dropbox_app, photos_folder=None, image_urls=None, columns=METADATA_COLUMNS
+):
+    filters = None if image_urls is None else [("imageURL", "in", list(image_urls))]
+
+    if photos_folder is not None:
+        partition, partitions_path = metadata_partition_path(filename, photos_folder)
+        try:
+            return dbx_load_dataframe(
+                partition, partitions_path, dropbox_app, columns, filters
+            )
+        except (ApiError, FileNotFoundError):
+            # the metadata was not partitioned yet: filter the whole file
+            pass
 
-def dbx_load_geo_metadata(dropbox_app):
     return dbx_load_dataframe(
-        "geometries-roofs_images_obstacles.parquet",
-        dropbox_path=DROPBOX_PHOTOS_METADATA_PATH,
-        dropbox_app=dropbox_app,
+        filename, DROPBOX_PHOTOS_METADATA_PATH, dropbox_app, columns, filters
     )
 
 
-def dbx_create_label_annotations(dropbox_app, num_checkpoints: int = 0):
+def dbx_load_metadata(
+    dropbox_app, photos_folder=None, image_urls=None, columns=METADATA_COLUMNS
+):
+    """Loads the obstacles metadata, indexed by roof and with compact dtypes (see
+    `MetadataStore.from_dataframe`).
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    photos_folder : str or None (default: None)
+        If not None, only downloads the partition of the metadata with the photos in
+        the folder (see `dbx_create_metadata_partitions`). If the metadata is not
+        partitioned, downloads the whole file: pass `image_urls` to filter it.
+    image_urls : Iterable[str] or None (default: None)
+        If not None, only reads the metadata of these photos.
+    columns : list[str] or None (default: METADATA_COLUMNS)
+        The columns to read. If None, reads all the columns.
+
+    Returns
+    -------
+    MetadataStore
+        The indexed metadata.
+    """
+    metadata = _dbx_load_metadata_file(
+        METADATA_FILE, dropbox_app, photos_folder, image_urls, columns
+    )
+    return MetadataStore.from_dataframe(metadata)
+
 
-    metadata_folder_contents = dbx.dropbox_listdir(
-        DROPBOX_LABEL_ANNOTATIONS_PATH, dropbox_app
+def dbx_load_geo_metadata(
+    dropbox_app, photos_folder=None, image_urls=None, columns=METADATA_COLUMNS
+):
+    """Loads the obstacles metadata with the coordinates of the roofs, indexed by roof
+    and with compact dtypes (see `MetadataStore.from_dataframe`). The parameters are
+    the same as `dbx_load_metadata`."""
+    metadata = _dbx_load_metadata_file(
+        GEO_METADATA_FILE, dropbox_app, photos_folder, image_urls, columns
     )
+    return MetadataStore.from_dataframe(metadata)
 
-    label_annotation_checkpoints = metadata_folder_contents.loc[
-        lambda df: df.item_name.str.contains("-checkpoint-labels_annotations.csv")
-    ]
+
+def _merge_new_label_annotations(
+    dropbox_app,
+    folder_contents: DataFrame,
+    num_checkpoints: int,
+    rebuild: bool,
+    max_workers: int,
+) -> tuple[DataFrame, dict[str, str], bool]:
+    # the snapshot with the new checkpoints merged in memory, the checkpoints merged
+    # into it, and whether it differs from the snapshot on Dropbox
+    label_annotation_checkpoints = folder_contents.loc[
+        lambda df: df.item_name.str.contains("-checkpoint-")
+        & df.item_name.str.endswith(".csv")
+    ].sort_values("item_name")
 
     if num_checkpoints > 0:
         label_annotation_checkpoints = label_annotation_checkpoints.iloc[
             :num_checkpoints
         ]
-    dataframes = [
-        dbx_load_dataframe(file, DROPBOX_LABEL_ANNOTATIONS_PATH, dropbox_app)
-        for file in label_annotation_checkpoints.item_name
+
+    snapshot, merged_checkpoints = None, {}
+    snapshot_file = folder_contents.loc[
+        lambda df: df.item_name == LABEL_ANNOTATIONS_SNAPSHOT
+    ]
+    if not rebuild and len(snapshot_file) > 0:
+        local_file = dbx.dropbox_download_cached(
+            dropbox_app,
+            f"{DROPBOX_LABEL_ANNOTATIONS_PATH}/{LABEL_ANNOTATIONS_SNAPSHOT}",
+            snapshot_file.item_content_hash.iloc[0],
+        )
+        snapshot, merged_checkpoints = read_label_annotations_snapshot(local_file)
+
+    checkpoints = dict(
+        zip(
+            label_annotation_checkpoints.item_name,
+            label_annotation_checkpoints.item_content_hash,
+        )
+    )
+    new_checkpoints = [
+        checkpoint
+        for checkpoint, content_hash in checkpoints.items()
+        if merged_checkpoints.get(checkpoint) != content_hash
     ]
+    if snapshot is not None and not new_checkpoints:
+        return snapshot, merged_checkpoints, False
 
-    label_annotations = (
+    dataframes = dbx_load_dataframes(
+        new_checkpoints, DROPBOX_LABEL_ANNOTATIONS_PATH, dropbox_app, max_workers
+    )
+    label_annotations = merge_label_annotations(
+        snapshot,
         pd.concat(dataframes, ignore_index=True)
-        .dropna(subset=["roof_id"], keep="last")
-        .sort_values("roof_id")
-        .reset_index(drop=True)
+        if dataframes
+        else DataFrame(columns=["roof_id", "annotation_time"]),
     )
 
-    label_annotations.to_csv("obstacles-labels_annotations.csv", index=False)
+    return label_annotations, {**merged_checkpoints, **checkpoints}, True
+
+
+def dbx_read_label_annotations(
+    dropbox_app, num_checkpoints: int = 0, max_workers: int = DROPBOX_MAX_WORKERS
+) -> DataFrame:
+    """Returns the latest annotation of every roof: the snapshot
+    `LABEL_ANNOTATIONS_SNAPSHOT`, with the checkpoints that are new or changed since
+    the last consolidation merged in memory. Nothing is written on Dropbox: see
+    `dbx_create_label_annotations` to update the snapshot.
 
-    dbx.dropbox_upload_file_to(
-        dropbox_app,
-        "obstacles-labels_annotations.csv",
-        f"{DROPBOX_LABEL_ANNOTATIONS_PATH}/obstacles-labels_annotations.csv",
+    The parameters are the same as `dbx_create_label_annotations`.
+
+    Returns
+    -------
+    DataFrame
+        The latest annotations, with one row per roof sorted by `roof_id`.
+    """
+    folder_contents = dbx.dropbox_listdir(DROPBOX_LABEL_ANNOTATIONS_PATH, dropbox_app)
+    label_annotations, _, _ = _merge_new_label_annotations(
+        dropbox_app, folder_contents, num_checkpoints, False, max_workers
     )
+    return label_annotations
+
+
+def dbx_create_label_annotations(
+    dropbox_app,
+    num_checkpoints: int = 0,
+    rebuild: bool = False,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+) -> DataFrame:
+    """Consolidates the label annotations checkpoints in
+    `DROPBOX_LABEL_ANNOTATIONS_PATH` into the snapshot `LABEL_ANNOTATIONS_SNAPSHOT`,
+    with the latest annotation of every roof.
+
+    Only the checkpoints that are new or changed since the last consolidation are
+    downloaded, concurrently, and merged into the snapshot (see
+    `merge_label_annotations`). If there are none, nothing is written.
+
+    The snapshot replaces the CSV file of the consolidated annotations,
+    `obstacles-labels_annotations.csv`, which is deleted.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    num_checkpoints : int (default: 0)
+        If greater than 0, only consolidates the first checkpoints, by name.
+    rebuild : bool (default: False)
+        Whether to build the snapshot again from all the checkpoints, e.g. to drop
+        the annotations of deleted checkpoints.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of concurrent downloads.
+
+    Returns
+    -------
+    DataFrame
+        The snapshot, with one row per roof sorted by `roof_id`.
+    """
+    storage = dbx.as_storage_backend(dropbox_app)
+    folder_contents = dbx.dropbox_listdir(DROPBOX_LABEL_ANNOTATIONS_PATH, storage)
+
+    label_annotations, checkpoints, is_changed = _merge_new_label_annotations(
+        storage, folder_contents, num_checkpoints, rebuild, max_workers
+    )
+
+    if is_changed:
+        with BytesIO() as buffer:
+            write_label_annotations_snapshot(label_annotations, checkpoints, buffer)
+            storage.upload(
+                buffer.getvalue(),
+                f"{DROPBOX_LABEL_ANNOTATIONS_PATH}/{LABEL_ANNOTATIONS_SNAPSHOT}",
+            )
+
+    if (folder_contents.item_name == _LEGACY_LABEL_ANNOTATIONS).any():
+        storage.delete(f"{DROPBOX_LABEL_ANNOTATIONS_PATH}/{_LEGACY_LABEL_ANNOTATIONS}")
 
-    os.remove("obstacles-labels_annotations.csv")
+    return label_annotations
 
 
 def dbx_load_label_annotations(filename, dropbox_app):
@@ -113,36 +427,126 @@ def dbx_load_label_annotations(filename, dropbox_app):
     )
 
 
+def dbx_load_hyperparameters_predictor(
+    dropbox_app, filename="hyperparameters_predictor.npz"
+):
+
+    local_file = dbx.dropbox_download_cached(
+        dropbox_app, f"{DROPBOX_MODELS_PATH}/{filename}"
+    )
+
+    return HyperparametersPredictor.load(local_file)
+
+
+def dbx_load_photo_catalog(dropbox_app) -> PhotoCatalog:
+    """Loads the catalog of the photos (see `dbx_create_photo_catalog`)."""
+    return PhotoCatalog(
+        dbx_load_dataframe(
+            PHOTO_CATALOG_FILE, DROPBOX_PHOTOS_METADATA_PATH, dropbox_app
+        )
+    )
+
+
 def dbx_load_photo(
-    photo_name, dropbox_folder, dropbox_app, bgr_only=False, greyscale_only=False
+    photo_name,
+    dropbox_folder,
+    dropbox_app,
+    bgr_only=False,
+    greyscale_only=False,
+    catalog: PhotoCatalog | None = None,
+    content_hash: str | None = None,
+    scale: int = 1,
 ):
+    """Loads a photo from Dropbox, in BGR and/or in greyscale.
+
+    The photo is read in memory, from the local cache or from Dropbox (see
+    `DropboxCache.read`), and decoded once (see `read_photo_from_bytestring`).
+
+    Parameters
+    ----------
+    photo_name : str
+        The name of the photo.
+    dropbox_folder : str
+        The Dropbox folder of the photo.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    bgr_only : bool (default: False)
+        If True, only returns the BGR photo.
+    greyscale_only : bool (default: False)
+        If True, only returns the greyscale photo.
+    catalog : PhotoCatalog or None (default: None)
+        If not None, loads the canonical copy of the photo.
+    content_hash : str or None (default: None)
+        The content hash of the photo, if known: it spares a metadata call.
+    scale : int (default: 1)
+        The factor the photo is reduced by, e.g. 4 for previews: one of
+        `PHOTO_SCALES`. JPEG photos are decoded directly at the reduced size. The
+        coordinates of the roofs must be reduced as well (see `scale_coordinates`).
+
+    Returns
+    -------
+    ndarray or tuple[ndarray, ndarray]
+        The BGR photo, the greyscale photo, or both.
+    """
     if greyscale_only and bgr_only:
         raise ValueError("`bgr_only` and `greyscale_only` cannot be both True")
 
     dropbox_path = f"{dropbox_folder}/{photo_name}"
 
-    dropbox_app.files_download_to_file(photo_name, dropbox_path)
+    # download the canonical copy of the photo, which is shared by all its copies. The
+    # hash in the catalog also spares a metadata call to validate the cached copy
+    if catalog is not None and dropbox_path in catalog:
+        content_hash, dropbox_path = catalog.resolve(dropbox_path)
 
-    if bgr_only:
-        bgr_image = cv.imread(photo_name, 1)
-
-        os.remove(photo_name)
-
-        return bgr_image
-
-    if greyscale_only:
-        greyscale_image = cv.imread(photo_name, 0)
+    photo = dbx.dropbox_read_cached(dropbox_app, dropbox_path, content_hash)
 
-        os.remove(photo_name)
+    return read_photo_from_bytestring(photo, bgr_only, greyscale_only, scale)
 
-        return greyscale_image
 
-    bgr_image = cv.imread(photo_name, 1)
-    greyscale_image = cv.imread(photo_name, 0)
+def dbx_load_photos(
+    dropbox_paths,
+    dropbox_app,
+    bgr_only=False,
+    greyscale_only=False,
+    catalog: PhotoCatalog | None = None,
+    scale: int = 1,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+) -> Iterator[tuple[str, ndarray | tuple[ndarray, ndarray]]]:
+    """Loads many photos from Dropbox concurrently, retrying on rate limits and
+    transient errors (see `dropbox_map_concurrently`).
+
+    Parameters
+    ----------
+    dropbox_paths : Iterable[str]
+        The Dropbox paths of the photos.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of photos downloaded and decoded at the same time.
+
+    The other parameters are the same as `dbx_load_photo`.
+
+    Yields
+    ------
+    tuple[str, ndarray or tuple[ndarray, ndarray]]
+        The path of each photo and the photo, in the order the downloads complete.
+    """
+    if greyscale_only and bgr_only:
+        raise ValueError("`bgr_only` and `greyscale_only` cannot be both True")
 
-    os.remove(photo_name)
+    def load_photo(dropbox_path):
+        dropbox_folder, photo_name = dropbox_path.rsplit("/", maxsplit=1)
+        return dbx_load_photo(
+            photo_name,
+            dropbox_folder,
+            dropbox_app,
+            bgr_only,
+            greyscale_only,
+            catalog,
+            scale=scale,
+        )
 
-    return bgr_image, greyscale_image
+    yield from dbx.dropbox_map_concurrently(load_photo, dropbox_paths, max_workers)
 
 
 def dbx_load_photos_from_roof_id(
@@ -152,28 +556,28 @@ def dbx_load_photos_from_roof_id(
     dropbox_app,
     bgr_only: bool = False,
     greyscale_only: bool = False,
+    scale: int = 1,
 ):
-    photo_name = metadata.loc[lambda df: df["roof_id"] == roof_id, "imageURL"].values[0]
+    photo_name = require_metadata_store(metadata).get_image_url(roof_id)
 
     return dbx_load_photo(
-        photo_name, dropbox_path, dropbox_app, bgr_only, greyscale_only
+        photo_name, dropbox_path, dropbox_app, bgr_only, greyscale_only, scale=scale
     )
 
 
-def get_coordinates_from_roof_id(roof_id, metadata) -> tuple[str, list[str]]:
+def get_coordinates_from_roof_id(roof_id, metadata) -> tuple[ndarray, list[ndarray]]:
+    """Returns the coordinates of the roof and of its obstacles (see
+    `MetadataStore.get_coordinates`). The metadata must be a `MetadataStore`, built
+    once (see `require_metadata_store`)."""
 
-    roof_px_coordinates = metadata.loc[
-        metadata.roof_id == roof_id, "pixelCoordinates_roof"
-    ].iloc[0]
+    return require_metadata_store(metadata).get_coordinates(roof_id)
 
-    obstacles_px_coordinates = [
-        coord
-        for coord in metadata.loc[
-            metadata.roof_id == roof_id, "pixelCoordinates_obstacle"
-        ].values
-    ]
 
-    return roof_px_coordinates, obstacles_px_coordinates
+def get_geometry_from_roof_id(roof_id, metadata):
+    """Returns the precomputed geometry of the roof's crop, or None if the metadata has
+    no geometry columns (see `insert_roofs_geometry`)."""
+
+    return require_metadata_store(metadata).get_geometry(roof_id)
 
 
 def load_and_crop_roof_from_roof_id(
@@ -184,8 +588,17 @@ def load_and_crop_roof_from_roof_id(
     greyscale_only: bool = False,
     bgr_only: bool = False,
     with_labels: bool = False,
+    scale: int = 1,
 ):
-    roof_px_coord, obstacles_px_coord = get_coordinates_from_roof_id(roof_id, metadata)
+    metadata = require_metadata_store(metadata)
+    roof_px_coord, obstacles_px_coord = metadata.get_coordinates(roof_id)
+    roof_geometry = metadata.get_geometry(roof_id)
+
+    if scale != 1:
+        # the precomputed geometry is in the coordinates of the full-size photo
+        roof_px_coord = scale_coordinates(roof_px_coord, scale)
+        obstacles_px_coord = scale_coordinates(obstacles_px_coord, scale)
+        roof_geometry = None
 
     if greyscale_only:
         greyscale_image = dbx_load_photos_from_roof_id(
@@ -194,33 +607,36 @@ def load_and_crop_roof_from_roof_id(
             dropbox_path,
             dropbox_app,
             greyscale_only=greyscale_only,
+            scale=scale,
         )
         if with_labels:
             labelled_roof = draw_labels_on_photo(
                 greyscale_image, roof_px_coord, obstacles_px_coord
             )
-            return rotate_and_crop_roof(labelled_roof, roof_px_coord)
-        return rotate_and_crop_roof(greyscale_image, roof_px_coord)
+            return rotate_and_crop_roof(labelled_roof, roof_px_coord, roof_geometry)
+        return rotate_and_crop_roof(greyscale_image, roof_px_coord, roof_geometry)
 
     if bgr_only:
         bgr_image = dbx_load_photos_from_roof_id(
-            roof_id, metadata, dropbox_path, dropbox_app, bgr_only=bgr_only
+            roof_id, metadata, dropbox_path, dropbox_app, bgr_only=bgr_only, scale=scale
         )
         if with_labels:
             labelled_roof = draw_labels_on_photo(
                 bgr_image, roof_px_coord, obstacles_px_coord
             )
-            return rotate_and_crop_roof(labelled_roof, roof_px_coord)
-        return rotate_and_crop_roof(bgr_image, roof_px_coord)
+            return rotate_and_crop_roof(labelled_roof, roof_px_coord, roof_geometry)
+        return rotate_and_crop_roof(bgr_image, roof_px_coord, roof_geometry)
 
     bgr_image, greyscale_image = dbx_load_photos_from_roof_id(
-        roof_id, metadata, dropbox_path, dropbox_app
+        roof_id, metadata, dropbox_path, dropbox_app, scale=scale
     )
 
     k2_labelled_image = draw_labels_on_photo(
         bgr_image, roof_px_coord, obstacles_px_coord
     )
-    labelled_roof = rotate_and_crop_roof(k2_labelled_image, roof_px_coord)
-    greyscale_roof = rotate_and_crop_roof(greyscale_image, roof_px_coord)
+    labelled_roof = rotate_and_crop_roof(
+        k2_labelled_image, roof_px_coord, roof_geometry
+    )
+    greyscale_roof = rotate_and_crop_roof(greyscale_image, roof_px_coord, roof_geometry)
 
     return k2_labelled_image, labelled_roof, greyscale_roof
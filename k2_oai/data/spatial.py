@@ -0,0 +1,384 @@
+"""
+Spatial index over the locations of the roofs, to select the roofs in a region (a
+bounding box, a circle or a polygon) without scanning the whole metadata.
+
+The roofs are bucketed in a regular grid of latitude and longitude, and sorted by
+cell: the roofs in a bounding box are a few contiguous slices of the sorted roofs, one
+per row of the grid, found with a binary search. Only the roofs in these slices are
+then tested against the region.
+
+The geo metadata is stored sorted by `hilbert_key`, so that roofs that are close in
+space are also close in the file (and in the same row groups).
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from numpy import ndarray
+
+__all__ = [
+    "EARTH_RADIUS",
+    "WEB_MERCATOR_RADIUS",
+    "TILE_SIZE",
+    "PHOTO_SIZE",
+    "hilbert_key",
+    "haversine_distance",
+    "lat_lng_to_web_mercator",
+    "web_mercator_to_lat_lng",
+    "photo_pixels_to_web_mercator",
+    "ground_resolution",
+    "SpatialIndex",
+]
+
+# mean radius of the Earth, in metres
+EARTH_RADIUS = 6_371_008.8
+
+# the satellite photos are Web Mercator (EPSG:3857) map tiles: the radius of the
+# sphere of the projection, in metres, and the size of a tile at zoom 0, in pixels
+WEB_MERCATOR_RADIUS = 6_378_137.0
+TILE_SIZE = 256
+
+# the size of the satellite photos, in pixels, as (width, height): their centre is at
+# (`center_lat`, `center_lng`)
+PHOTO_SIZE = (640, 640)
+
+
+def hilbert_key(lat, lon, order: int = 16) -> ndarray:
+    """Computes the position of the points along a Hilbert curve that covers the
+    world, e.g. to sort them so that points that are close in space are close in the
+    sorted order.
+
+    Parameters
+    ----------
+    lat : ArrayLike
+        The latitudes of the points, in degrees.
+    lon : ArrayLike
+        The longitudes of the points, in degrees.
+    order : int (default: 16)
+        The order of the curve: the world is divided in a grid of 2^order by 2^order
+        cells. With 16, cells are about 600 by 300 metres at the equator. Must be at
+        most 31.
+
+    Returns
+    -------
+    ndarray
+        The keys (int64). Missing coordinates are mapped to the first cell.
+    """
+    if not 1 <= order <= 31:
+        raise ValueError("`order` must be between 1 and 31.")
+
+    num_cells = 1 << order
+    x = _to_grid(np.asarray(lon, dtype=np.float64), -180, 360, num_cells)
+    y = _to_grid(np.asarray(lat, dtype=np.float64), -90, 180, num_cells)
+
+    keys = np.zeros(x.shape, dtype=np.int64)
+    step = num_cells >> 1
+
+    while step > 0:
+        rx = (x & step) > 0
+        ry = (y & step) > 0
+        keys += step * step * ((3 * rx) ^ ry)
+
+        # rotate the quadrant, so that the curve is continuous
+        is_flipped = ~ry & rx
+        x[is_flipped] = num_cells - 1 - x[is_flipped]
+        y[is_flipped] = num_cells - 1 - y[is_flipped]
+        is_swapped = ~ry
+        x[is_swapped], y[is_swapped] = y[is_swapped], x[is_swapped]
+
+        step >>= 1
+
+    return keys
+
+
+def _to_grid(values: ndarray, start: float, extent: float, num_cells: int) -> ndarray:
+    cells = np.floor((values - start) / extent * num_cells)
+    return np.nan_to_num(cells).clip(0, num_cells - 1).astype(np.int64)
+
+
+def haversine_distance(lat, lon, other_lat, other_lon) -> ndarray:
+    """Computes the great-circle distance between points, in metres.
+
+    Parameters
+    ----------
+    lat, lon : ArrayLike
+        The coordinates of the first points, in degrees.
+    other_lat, other_lon : ArrayLike
+        The coordinates of the other points, in degrees.
+
+    Returns
+    -------
+    ndarray
+        The distances, in metres.
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    other_lat, other_lon = np.radians(other_lat), np.radians(other_lon)
+
+    a = (
+        np.sin((other_lat - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(other_lat) * np.sin((other_lon - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def lat_lng_to_web_mercator(lat, lng) -> tuple[ndarray, ndarray]:
+    """Projects points to Web Mercator (EPSG:3857).
+
+    Parameters
+    ----------
+    lat, lng : ArrayLike
+        The coordinates of the points, in degrees.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The x and y coordinates, in metres of the projection (i.e. stretched by
+        1 / cos(lat) with respect to metres on the ground).
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+
+    return (
+        WEB_MERCATOR_RADIUS * lng,
+        WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2)),
+    )
+
+
+def web_mercator_to_lat_lng(x, y) -> tuple[ndarray, ndarray]:
+    """Projects points from Web Mercator (EPSG:3857) to WGS84 (EPSG:4326), i.e. the
+    inverse of `lat_lng_to_web_mercator`.
+
+    Parameters
+    ----------
+    x, y : ArrayLike
+        The coordinates of the points, in metres of the projection.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The latitudes and longitudes, in degrees.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    return (
+        np.degrees(2 * np.arctan(np.exp(y / WEB_MERCATOR_RADIUS)) - np.pi / 2),
+        np.degrees(x / WEB_MERCATOR_RADIUS),
+    )
+
+
+def ground_resolution(lat, zoom) -> ndarray:
+    """Computes the size of a pixel of the satellite photos on the ground.
+
+    Parameters
+    ----------
+    lat : ArrayLike
+        The latitudes, in degrees.
+    zoom : ArrayLike
+        The zoom levels of the photos.
+
+    Returns
+    -------
+    ndarray
+        The side of a pixel, in metres.
+    """
+    return (
+        2
+        * np.pi
+        * WEB_MERCATOR_RADIUS
+        * np.cos(np.radians(lat))
+        / (TILE_SIZE * np.power(2.0, zoom))
+    )
+
+
+def photo_pixels_to_web_mercator(
+    x, y, center_lat, center_lng, zoom, photo_size=PHOTO_SIZE
+) -> tuple[ndarray, ndarray]:
+    """Maps pixel coordinates in the satellite photos to Web Mercator (EPSG:3857).
+
+    Parameters
+    ----------
+    x, y : ArrayLike
+        The pixel coordinates, from the top-left corner of the photos.
+    center_lat, center_lng : ArrayLike
+        The coordinates of the centre of the photos, in degrees.
+    zoom : ArrayLike
+        The zoom level of the photos: at zoom z, the world is 256 * 2^z pixels wide.
+    photo_size : tuple[int, int] (default: PHOTO_SIZE)
+        The size of the photos, in pixels, as (width, height).
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The x and y coordinates, in metres of the projection.
+    """
+    center_x, center_y = lat_lng_to_web_mercator(center_lat, center_lng)
+    metres_per_pixel = (
+        2 * np.pi * WEB_MERCATOR_RADIUS / (TILE_SIZE * np.power(2.0, zoom))
+    )
+    width, height = photo_size
+
+    return (
+        center_x + (np.asarray(x) - width / 2) * metres_per_pixel,
+        center_y - (np.asarray(y) - height / 2) * metres_per_pixel,
+    )
+
+
+class SpatialIndex:
+    """Grid index over points, e.g. the centres of the roofs.
+
+    Parameters
+    ----------
+    lat : ArrayLike
+        The latitudes of the points, in degrees.
+    lon : ArrayLike
+        The longitudes of the points, in degrees.
+    cell_size : float (default: 0.05)
+        The size of the cells of the grid, in degrees.
+
+    Notes
+    -----
+    Queries return the positions of the points in `lat` and `lon`. Points with missing
+    coordinates are never returned.
+    """
+
+    def __init__(self, lat, lon, cell_size: float = 0.05):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if lat.shape != lon.shape:
+            raise ValueError("`lat` and `lon` must have the same shape.")
+        if cell_size <= 0:
+            raise ValueError("`cell_size` must be positive.")
+
+        self.cell_size = cell_size
+        self._num_columns = int(np.ceil(360 / cell_size)) + 1
+
+        positions = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        keys = self._cell_keys(lat[positions], lon[positions])
+        order = np.argsort(keys, kind="stable")
+
+        self._keys = keys[order]
+        self._positions = positions[order]
+        self._lat = lat[self._positions]
+        self._lon = lon[self._positions]
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _cell_rows(self, lat):
+        return np.floor((np.asarray(lat) + 90) / self.cell_size).astype(np.int64)
+
+    def _cell_columns(self, lon):
+        return np.floor((np.asarray(lon) + 180) / self.cell_size).astype(np.int64)
+
+    def _cell_keys(self, lat, lon) -> ndarray:
+        return self._cell_rows(lat) * self._num_columns + self._cell_columns(lon)
+
+    def _candidates(self, min_lon, min_lat, max_lon, max_lat) -> ndarray:
+        # the points in the cells that overlap the bounding box, one slice per row
+        rows = np.arange(self._cell_rows(min_lat), self._cell_rows(max_lat) + 1)
+        first_column = self._cell_columns(min_lon)
+        last_column = self._cell_columns(max_lon)
+
+        starts = np.searchsorted(self._keys, rows * self._num_columns + first_column)
+        stops = np.searchsorted(
+            self._keys, rows * self._num_columns + last_column, side="right"
+        )
+
+        # concatenate the slices without a python loop
+        lengths = stops - starts
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(lengths.sum()) + shifts
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat) -> ndarray:
+        """Finds the points in a bounding box (borders included). Boxes that cross the
+        antimeridian are not supported.
+
+        Parameters
+        ----------
+        min_lon, min_lat, max_lon, max_lat : float
+            The bounds of the box, in degrees, in the same order of shapely's `bounds`.
+
+        Returns
+        -------
+        ndarray
+            The positions of the points, sorted.
+        """
+        if min_lon > max_lon or min_lat > max_lat:
+            raise ValueError("The minimum bounds must not exceed the maximum bounds.")
+
+        candidates = self._candidates(min_lon, min_lat, max_lon, max_lat)
+        lat, lon = self._lat[candidates], self._lon[candidates]
+        is_inside = (
+            (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        )
+        return np.sort(self._positions[candidates[is_inside]])
+
+    def query_radius(self, lat: float, lon: float, radius: float) -> ndarray:
+        """Finds the points within a distance (great-circle) from a point.
+
+        Parameters
+        ----------
+        lat, lon : float
+            The centre of the circle, in degrees.
+        radius : float
+            The radius of the circle, in metres.
+
+        Returns
+        -------
+        ndarray
+            The positions of the points, sorted.
+        """
+        lat_delta = np.degrees(radius / EARTH_RADIUS)
+        # the longitude delta grows with the latitude: bound it at the pole-most side
+        max_abs_lat = min(abs(lat) + lat_delta, 89.9)
+        lon_delta = min(lat_delta / np.cos(np.radians(max_abs_lat)), 180)
+
+        candidates = self._candidates(
+            max(lon - lon_delta, -180),
+            max(lat - lat_delta, -90),
+            min(lon + lon_delta, 180),
+            min(lat + lat_delta, 90),
+        )
+        distances = haversine_distance(
+            lat, lon, self._lat[candidates], self._lon[candidates]
+        )
+        return np.sort(self._positions[candidates[distances <= radius]])
+
+    def query_polygon(self, polygon) -> ndarray:
+        """Finds the points inside a polygon, e.g. the border of a region.
+
+        Parameters
+        ----------
+        polygon : ArrayLike or shapely.geometry.Polygon
+            The (n, 2) vertices of the polygon, as (lon, lat) pairs in degrees, or a
+            shapely polygon (only the exterior is used).
+
+        Returns
+        -------
+        ndarray
+            The positions of the points, sorted.
+        """
+        if hasattr(polygon, "exterior"):
+            polygon = polygon.exterior.coords
+        vertices = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        if len(vertices) < 3:
+            raise ValueError("A polygon must have at least 3 vertices.")
+
+        min_lon, min_lat = vertices.min(axis=0)
+        max_lon, max_lat = vertices.max(axis=0)
+        candidates = self._candidates(min_lon, min_lat, max_lon, max_lat)
+        lon, lat = self._lon[candidates], self._lat[candidates]
+
+        # ray casting: count the edges crossed by a ray from each point towards +lon
+        is_inside = np.zeros(len(candidates), dtype=bool)
+        for (lon_a, lat_a), (lon_b, lat_b) in zip(
+            vertices, np.roll(vertices, -1, axis=0)
+        ):
+            if lat_a == lat_b:
+                continue
+            is_crossed = (lat_a > lat) != (lat_b > lat)
+            crossing_lon = lon_a + (lat - lat_a) * (lon_b - lon_a) / (lat_b - lat_a)
+            is_inside ^= is_crossed & (lon < crossing_lon)
+
+        return np.sort(self._positions[candidates[is_inside]])
@@ -0,0 +1,657 @@
+"""
+In-memory store of the metadata of roofs and obstacles, indexed by roof, photo and
+photos folder.
+
+The metadata is stored on file as a join, with one row per obstacle: the store splits
+it into a table of roofs and a table of obstacles, sorted by roof, so that the
+obstacles of each roof are a contiguous slice. It then builds hash indexes from roof
+identifiers, photos and folders to roofs. Looking up a roof takes constant time,
+instead of scanning the whole metadata.
+
+To keep the metadata small, its columns are cast to compact dtypes (see
+`METADATA_SCHEMA`) and the strings of coordinates are parsed once: every distinct
+polygon is stored once in a ragged array (see `k2_oai.utils._geometry`), and the
+metadata only keeps its integer identifier.
+"""
+
+from __future__ import annotations
+
+import warnings
+from functools import cached_property
+from typing import Any, Hashable, Iterable
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from pandas import DataFrame, Series
+
+from k2_oai.data.duplicates import find_near_duplicates, roofs_web_mercator_polygons
+from k2_oai.data.spatial import PHOTO_SIZE, SpatialIndex
+from k2_oai.utils import (
+    ROOF_GEOMETRY_COLUMNS,
+    compute_ragged_roofs_geometry,
+    parse_coordinates_column,
+    take_polygons,
+)
+
+__all__ = [
+    "METADATA_SCHEMA",
+    "POLYGON_ID_COLUMNS",
+    "apply_metadata_schema",
+    "parse_polygon_columns",
+    "insert_roofs_geometry",
+    "split_roofs_and_obstacles",
+    "insert_fingerprints",
+    "MetadataStore",
+    "as_metadata_store",
+    "require_metadata_store",
+]
+
+# the dtypes of the obstacles metadata: "category" for repeated strings, "integer" to
+# downcast integers to the narrowest type that fits them. Coordinates (degrees) stay
+# 64-bit: 32-bit floats are only accurate to about half a metre.
+METADATA_SCHEMA = {
+    "roof_id": "integer",
+    "obstacle_id": "integer",
+    "imageURL": "category",
+    "continent": "category",
+    "name": "category",
+    "photos_folder": "category",
+    "zoom": "integer",
+    "center_lat": "float64",
+    "center_lng": "float64",
+}
+
+# the columns of strings of coordinates, and the columns with the identifiers of the
+# parsed polygons that replace them (-1 if missing)
+POLYGON_ID_COLUMNS = {
+    "pixelCoordinates_roof": "roof_polygon_id",
+    "pixelCoordinates_obstacle": "obstacle_polygon_id",
+}
+
+
+def apply_metadata_schema(metadata: DataFrame, schema=None) -> DataFrame:
+    """Casts the columns of the metadata to compact dtypes. Columns that are not in the
+    schema, or that are not in the metadata, are left as they are.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        The obstacles metadata.
+    schema : dict[str, str] or None (default: None)
+        The dtype of each column: either "category", "integer" (the narrowest integer
+        type that fits the values, only if the column has no missing values) or a numpy
+        dtype. If None, uses `METADATA_SCHEMA`.
+
+    Returns
+    -------
+    DataFrame
+        A copy of the metadata, with compact dtypes.
+    """
+    schema = METADATA_SCHEMA if schema is None else schema
+
+    columns = {}
+    for column, dtype in schema.items():
+        if column not in metadata.columns:
+            continue
+        if dtype == "integer":
+            if pd.api.types.is_integer_dtype(metadata[column].dtype):
+                columns[column] = pd.to_numeric(metadata[column], downcast=dtype)
+        else:
+            columns[column] = metadata[column].astype(dtype)
+
+    # a new DataFrame: the caller's one keeps its dtypes
+    return metadata.assign(**columns)
+
+
+def parse_polygon_columns(
+    metadata: DataFrame,
+) -> tuple[DataFrame, dict[str, tuple[ndarray, ndarray]]]:
+    """Parses the coordinates of all roofs and obstacles at once (see
+    `parse_coordinates_column`), and replaces the strings with the identifiers of the
+    distinct polygons (see `POLYGON_ID_COLUMNS`).
+
+    Malformed coordinates are reported with a warning. Rows with malformed, empty or
+    missing roof coordinates are dropped, while malformed obstacle coordinates are
+    treated as missing.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        The obstacles metadata, with the strings of coordinates.
+
+    Returns
+    -------
+    tuple[DataFrame, dict[str, tuple[ndarray, ndarray]]]
+        The metadata, and the polygons by identifier column, as ragged arrays of
+        vertices and offsets.
+    """
+    roof_ids = metadata.roof_id if "roof_id" in metadata.columns else metadata.index
+    is_roof_malformed = np.zeros(len(metadata), dtype=bool)
+    polygons = {}
+
+    for column, id_column in POLYGON_ID_COLUMNS.items():
+        if column not in metadata.columns:
+            continue
+
+        # roofs are repeated once per obstacle: parse each string once
+        codes, unique_strings = pd.factorize(metadata[column])
+        vertices, offsets, is_valid = parse_coordinates_column(unique_strings)
+        if column == "pixelCoordinates_roof":
+            # a roof with no vertices has no crop
+            is_valid &= np.diff(offsets) > 0
+
+        # missing values (code -1) are not malformed, e.g. roofs with no obstacles
+        is_malformed = (codes >= 0) & ~is_valid[codes]
+        if is_malformed.any():
+            warnings.warn(
+                f"{is_malformed.sum()} rows have malformed `{column}`, e.g. roofs "
+                f"{pd.unique(np.asarray(roof_ids)[is_malformed])[:5].tolist()}."
+            )
+            codes[is_malformed] = -1
+        if column == "pixelCoordinates_roof":
+            is_roof_malformed = codes < 0
+
+        position = metadata.columns.get_loc(column)
+        metadata = metadata.drop(columns=column)
+        metadata.insert(position, id_column, codes.astype(np.int32))
+        polygons[id_column] = (vertices, offsets)
+
+    if is_roof_malformed.any():
+        metadata = metadata.loc[~is_roof_malformed].reset_index(drop=True)
+
+    return metadata, polygons
+
+
+def insert_roofs_geometry(
+    metadata: DataFrame, roof_polygons: tuple[ndarray, ndarray]
+) -> DataFrame:
+    """Computes the geometry of the crop of every roof at once (see
+    `compute_roofs_geometry`) and inserts it as columns next to `roof_polygon_id`.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        The metadata of the roofs, with the identifiers of the roof polygons (see
+        `parse_polygon_columns`).
+    roof_polygons : tuple[ndarray, ndarray]
+        The ragged array of the roof polygons.
+
+    Returns
+    -------
+    DataFrame
+        The metadata, with the `ROOF_GEOMETRY_COLUMNS`.
+    """
+    # duplicate roofs share the same polygon: compute the geometry of each one once
+    used_polygons, roofs_codes = np.unique(
+        metadata.roof_polygon_id.to_numpy(), return_inverse=True
+    )
+    roofs_geometry = compute_ragged_roofs_geometry(
+        *take_polygons(*roof_polygons, used_polygons)
+    )
+
+    position = metadata.columns.get_loc("roof_polygon_id") + 1
+    for offset, (column, values) in enumerate(roofs_geometry.items()):
+        metadata.insert(position + offset, column, values[roofs_codes])
+
+    return metadata
+
+
+def split_roofs_and_obstacles(
+    metadata: DataFrame,
+) -> tuple[DataFrame, DataFrame, ndarray]:
+    """Normalizes the join of roofs and obstacles (one row per obstacle) into a table
+    of roofs and a table of obstacles. The obstacles are sorted by roof, and the
+    obstacles of the i-th roof are `obstacles.iloc[offsets[i] : offsets[i + 1]]`.
+
+    The columns whose name contains "obstacle" go to the table of obstacles, all the
+    others to the table of roofs. Rows with no obstacle (i.e. a missing
+    `obstacle_polygon_id`) only add a roof.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        The obstacles metadata, with the identifiers of the polygons (see
+        `parse_polygon_columns`).
+
+    Returns
+    -------
+    tuple[DataFrame, DataFrame, ndarray]
+        The roofs, sorted by `roof_id`, the obstacles and the (R + 1) offsets.
+    """
+    metadata = metadata.sort_values("roof_id", kind="stable", ignore_index=True)
+
+    obstacle_columns = [column for column in metadata.columns if "obstacle" in column]
+    roof_columns = [
+        column for column in metadata.columns if column not in obstacle_columns
+    ]
+
+    roof_ids = metadata.roof_id.to_numpy()
+    is_first_row = np.ones(len(roof_ids), dtype=bool)
+    is_first_row[1:] = roof_ids[1:] != roof_ids[:-1]
+
+    if "obstacle_polygon_id" in metadata.columns:
+        is_obstacle = metadata.obstacle_polygon_id.to_numpy() >= 0
+    else:
+        is_obstacle = np.ones(len(metadata), dtype=bool)
+
+    # the roof of each row is the number of first rows up to it
+    roof_index = np.cumsum(is_first_row) - 1
+    offsets = np.zeros(is_first_row.sum() + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(roof_index[is_obstacle], minlength=len(offsets) - 1),
+        out=offsets[1:],
+    )
+
+    roofs = metadata.loc[is_first_row, roof_columns].reset_index(drop=True)
+    obstacles = metadata.loc[is_obstacle, obstacle_columns].reset_index(drop=True)
+
+    return roofs, obstacles, offsets
+
+
+def insert_fingerprints(
+    roofs: DataFrame, obstacles: DataFrame, obstacle_offsets: ndarray
+) -> tuple[DataFrame, DataFrame]:
+    """Computes the fingerprints of roofs and obstacles, i.e. int64 identifiers of the
+    photo and of the polygon: roofs (or obstacles) with the same fingerprint were
+    labelled more than once on the same photo.
+
+    The photo is in the high 32 bits and the polygon in the low 32 bits, so that
+    fingerprints never collide. They are only comparable within the same metadata.
+
+    Parameters
+    ----------
+    roofs : DataFrame
+        The metadata of the roofs (see `split_roofs_and_obstacles`).
+    obstacles : DataFrame
+        The metadata of the obstacles.
+    obstacle_offsets : ndarray
+        The offsets of the obstacles of each roof.
+
+    Returns
+    -------
+    tuple[DataFrame, DataFrame]
+        The roofs and the obstacles, with the `roof_fingerprint` and
+        `obstacle_fingerprint` columns.
+    """
+    photo_codes = pd.factorize(roofs.imageURL.to_numpy())[0].astype(np.int64) << 32
+    obstacle_photo_codes = np.repeat(photo_codes, np.diff(obstacle_offsets))
+
+    roofs = roofs.assign(
+        roof_fingerprint=photo_codes | roofs.roof_polygon_id.to_numpy(np.int64)
+    )
+    obstacles = obstacles.assign(
+        obstacle_fingerprint=obstacle_photo_codes
+        | obstacles.obstacle_polygon_id.to_numpy(np.int64)
+    )
+
+    return roofs, obstacles
+
+
+def _get_polygon(polygons: tuple[ndarray, ndarray], polygon_id: int) -> ndarray:
+    vertices, offsets = polygons
+    return vertices[offsets[polygon_id] : offsets[polygon_id + 1]]
+
+
+class MetadataStore:
+    """Metadata of roofs and obstacles, indexed by `roof_id`, `imageURL` and
+    `photos_folder`. Build it with `MetadataStore.from_dataframe`.
+
+    Parameters
+    ----------
+    roofs : DataFrame
+        The metadata of the roofs, one row per roof, sorted by `roof_id`.
+    obstacles : DataFrame
+        The metadata of the obstacles, sorted by roof.
+    obstacle_offsets : ndarray
+        The (R + 1) offsets of the obstacles of each roof (see
+        `split_roofs_and_obstacles`).
+    roof_polygons : tuple[ndarray, ndarray] or None (default: None)
+        The ragged array of the roof polygons.
+    obstacle_polygons : tuple[ndarray, ndarray] or None (default: None)
+        The ragged array of the obstacle polygons.
+
+    Attributes
+    ----------
+    roofs : DataFrame
+        The metadata of the roofs. It must not be modified in place.
+    obstacles : DataFrame
+        The metadata of the obstacles. It must not be modified in place.
+    roof_ids : ndarray
+        The roof identifiers, sorted.
+    """
+
+    def __init__(
+        self,
+        roofs: DataFrame,
+        obstacles: DataFrame,
+        obstacle_offsets: ndarray,
+        roof_polygons: tuple[ndarray, ndarray] | None = None,
+        obstacle_polygons: tuple[ndarray, ndarray] | None = None,
+    ):
+        self.roofs = roofs
+        self.obstacles = obstacles
+        self.obstacle_offsets = obstacle_offsets
+        self.roof_polygons = roof_polygons
+        self.obstacle_polygons = obstacle_polygons
+
+        self.roof_ids = roofs.roof_id.to_numpy()
+        self._positions = {
+            roof_id: position for position, roof_id in enumerate(self.roof_ids.tolist())
+        }
+
+        self._roofs_by_photo = self._index_roofs_by("imageURL")
+        self._roofs_by_folder = self._index_roofs_by("photos_folder")
+
+    @classmethod
+    def from_dataframe(cls, metadata: DataFrame, schema=None) -> MetadataStore:
+        """Builds the store from the metadata as it is stored on file: casts it to
+        compact dtypes, parses the coordinates, splits roofs and obstacles and computes
+        the geometry of the roofs.
+
+        Parameters
+        ----------
+        metadata : DataFrame
+            The join of roofs and obstacles, with the strings of coordinates.
+        schema : dict[str, str] or None (default: None)
+            The dtypes of the columns (see `apply_metadata_schema`).
+
+        Returns
+        -------
+        MetadataStore
+            The indexed metadata.
+        """
+        metadata, polygons = parse_polygon_columns(
+            apply_metadata_schema(metadata, schema)
+        )
+        roofs, obstacles, obstacle_offsets = split_roofs_and_obstacles(metadata)
+        roofs, obstacles = insert_fingerprints(roofs, obstacles, obstacle_offsets)
+
+        roof_polygons = polygons.get("roof_polygon_id")
+        if roof_polygons is not None:
+            roofs = insert_roofs_geometry(roofs, roof_polygons)
+
+        return cls(
+            roofs,
+            obstacles,
+            obstacle_offsets,
+            roof_polygons,
+            polygons.get("obstacle_polygon_id"),
+        )
+
+    def _index_roofs_by(self, column: str) -> dict[Hashable, ndarray] | None:
+        if column not in self.roofs.columns:
+            return None
+
+        codes, keys = pd.factorize(self.roofs[column].to_numpy())
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(keys) + 1))
+
+        return {
+            key: order[start:stop]
+            for key, start, stop in zip(keys, bounds[:-1], bounds[1:])
+        }
+
+    def __len__(self) -> int:
+        return len(self.roof_ids)
+
+    def __contains__(self, roof_id) -> bool:
+        return roof_id in self._positions
+
+    @property
+    def obstacle_roof_index(self) -> ndarray:
+        """The position of the roof of each obstacle, e.g. to join roofs and
+        obstacles."""
+        return np.repeat(np.arange(len(self.roof_ids)), np.diff(self.obstacle_offsets))
+
+    def position(self, roof_id) -> int:
+        """Returns the position of the roof in `roof_ids` and in `roofs`."""
+        try:
+            return self._positions[roof_id]
+        except KeyError:
+            raise KeyError(f"Roof {roof_id} is not in the metadata.") from None
+
+    def get_roof(self, roof_id) -> Series:
+        """Returns the metadata of the roof."""
+        return self.roofs.iloc[self.position(roof_id)]
+
+    def get_obstacles(self, roof_id) -> DataFrame:
+        """Returns the metadata of the obstacles of the roof."""
+        position = self.position(roof_id)
+        return self.obstacles.iloc[
+            self.obstacle_offsets[position] : self.obstacle_offsets[position + 1]
+        ]
+
+    def get_image_url(self, roof_id) -> str:
+        """Returns the name of the photo of the roof."""
+        return self.roofs.imageURL.iat[self.position(roof_id)]
+
+    def get_coordinates(self, roof_id) -> tuple[ndarray, list[ndarray]]:
+        """Returns the coordinates of the roof and of its obstacles, as arrays."""
+        if self.roof_polygons is None or self.obstacle_polygons is None:
+            raise KeyError("The metadata has no pixel coordinates.")
+
+        position = self.position(roof_id)
+        start, stop = self.obstacle_offsets[position : position + 2]
+
+        roof_polygon_id = self.roofs.roof_polygon_id.iat[position]
+        obstacle_polygon_ids = self.obstacles.obstacle_polygon_id.to_numpy()[start:stop]
+
+        return _get_polygon(self.roof_polygons, roof_polygon_id), [
+            _get_polygon(self.obstacle_polygons, polygon_id)
+            for polygon_id in obstacle_polygon_ids
+        ]
+
+    def get_geometry(self, roof_id) -> Series | None:
+        """Returns the precomputed geometry of the roof's crop, or None if the metadata
+        has no geometry columns (see `insert_roofs_geometry`)."""
+        if not set(ROOF_GEOMETRY_COLUMNS).issubset(self.roofs.columns):
+            return None
+
+        return self.roofs[list(ROOF_GEOMETRY_COLUMNS)].iloc[self.position(roof_id)]
+
+    def roofs_in_photo(self, image_url: str) -> ndarray:
+        """Returns the identifiers of the roofs in the photo."""
+        positions = self._lookup(self._roofs_by_photo, [image_url], "imageURL")
+        return self.roof_ids[positions]
+
+    def roofs_in_folder(self, photos_folder: str) -> ndarray:
+        """Returns the identifiers of the roofs in the photos folder."""
+        positions = self._lookup(
+            self._roofs_by_folder, [photos_folder], "photos_folder"
+        )
+        return self.roof_ids[positions]
+
+    def _locations(self) -> tuple[Series, Series]:
+        # the geo metadata renames the coordinates of the photos' centres
+        for lat, lon in (("lat", "lon"), ("center_lat", "center_lng")):
+            if lat in self.roofs.columns and lon in self.roofs.columns:
+                return self.roofs[lat], self.roofs[lon]
+        raise KeyError("The metadata has no coordinates of the roofs.")
+
+    @cached_property
+    def spatial_index(self) -> SpatialIndex:
+        """The index of the locations of the roofs, built at the first query."""
+        return SpatialIndex(*self._locations())
+
+    def roofs_in_bbox(self, min_lon, min_lat, max_lon, max_lat) -> ndarray:
+        """Returns the identifiers of the roofs in the bounding box (see
+        `SpatialIndex.query_bbox`)."""
+        return self.roof_ids[
+            self.spatial_index.query_bbox(min_lon, min_lat, max_lon, max_lat)
+        ]
+
+    def roofs_within(self, lat: float, lon: float, radius: float) -> ndarray:
+        """Returns the identifiers of the roofs within `radius` metres from the point
+        (see `SpatialIndex.query_radius`)."""
+        return self.roof_ids[self.spatial_index.query_radius(lat, lon, radius)]
+
+    def roofs_in_polygon(self, polygon) -> ndarray:
+        """Returns the identifiers of the roofs in the polygon of (lon, lat) vertices
+        (see `SpatialIndex.query_polygon`)."""
+        return self.roof_ids[self.spatial_index.query_polygon(polygon)]
+
+    def find_near_duplicates(
+        self,
+        cell_size: float = 50.0,
+        min_overlap: float = 0.5,
+        photo_size=PHOTO_SIZE,
+    ) -> ndarray:
+        """Finds the roofs that are the same physical roof, e.g. in different photos
+        (see `k2_oai.data.duplicates.find_near_duplicates`).
+
+        Parameters
+        ----------
+        cell_size : float (default: 50.0)
+            The size of the cells to bucket the roofs by, in metres of the Web
+            Mercator projection.
+        min_overlap : float (default: 0.5)
+            The minimum intersection over union of the polygons of duplicates.
+        photo_size : tuple[int, int] (default: PHOTO_SIZE)
+            The size of the photos, in pixels, as (width, height).
+
+        Returns
+        -------
+        ndarray
+            The canonical roof of each roof in `roof_ids`: roofs with no duplicates
+            are their own canonical roof.
+        """
+        if self.roof_polygons is None:
+            raise KeyError("The metadata has no pixel coordinates.")
+
+        center_lat, center_lng = self._locations()
+        vertices, offsets = take_polygons(
+            *self.roof_polygons, self.roofs.roof_polygon_id.to_numpy()
+        )
+        vertices = roofs_web_mercator_polygons(
+            vertices, offsets, center_lat, center_lng, self.roofs.zoom, photo_size
+        )
+        return self.roof_ids[
+            find_near_duplicates(vertices, offsets, cell_size, min_overlap)
+        ]
+
+    @cached_property
+    def canonical_roof_ids(self) -> ndarray:
+        """The canonical roof of each roof in `roof_ids`, with the default parameters
+        of `find_near_duplicates`. Computed once per store."""
+        return self.find_near_duplicates()
+
+    def subset(self, roof_ids: Iterable[Any]) -> MetadataStore:
+        """Returns a new store with only the given roofs. Unknown roofs are ignored."""
+        return self._subset(np.isin(self.roof_ids, np.asarray(list(roof_ids))))
+
+    def subset_photos(self, image_urls: Iterable[str]) -> MetadataStore:
+        """Returns a new store with only the roofs in the given photos. Unknown photos
+        are ignored."""
+        is_selected = np.zeros(len(self.roof_ids), dtype=bool)
+        is_selected[self._lookup(self._roofs_by_photo, image_urls, "imageURL")] = True
+        return self._subset(is_selected)
+
+    @cached_property
+    def _duplicates(self) -> tuple[ndarray, ndarray]:
+        return (
+            pd.Series(self.roofs.roof_fingerprint.to_numpy()).duplicated().to_numpy(),
+            pd.Series(self.obstacles.obstacle_fingerprint.to_numpy())
+            .duplicated()
+            .to_numpy(),
+        )
+
+    @cached_property
+    def _without_duplicates(self) -> MetadataStore:
+        is_duplicate_roof, is_duplicate_obstacle = self._duplicates
+        return self._subset(~is_duplicate_roof, ~is_duplicate_obstacle)
+
+    def find_duplicates(self) -> tuple[ndarray, ndarray]:
+        """Finds the roofs and the obstacles that were labelled more than once on the
+        same photo, i.e. with the same fingerprint of an earlier one (see
+        `insert_fingerprints`). The masks are computed once per store.
+
+        Returns
+        -------
+        tuple[ndarray, ndarray]
+            The boolean masks of the duplicate roofs and of the duplicate obstacles.
+        """
+        return self._duplicates
+
+    def drop_duplicates(self) -> MetadataStore:
+        """Returns a store without the duplicate roofs and obstacles (see
+        `find_duplicates`). The store is built once, and it must not be modified."""
+        return self._without_duplicates
+
+    def _lookup(
+        self, index: dict[Hashable, ndarray] | None, keys: Iterable, column: str
+    ) -> ndarray:
+        if index is None:
+            raise KeyError(f"The metadata has no `{column}` column.")
+
+        positions = [index[key] for key in keys if key in index]
+        if not positions:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(positions))
+
+    def _subset(
+        self, is_selected_roof: ndarray, is_selected_obstacle: ndarray | None = None
+    ) -> MetadataStore:
+        roof_index = self.obstacle_roof_index
+        is_kept_obstacle = is_selected_roof[roof_index]
+        if is_selected_obstacle is not None:
+            is_kept_obstacle &= is_selected_obstacle
+
+        obstacle_offsets = np.zeros(is_selected_roof.sum() + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(roof_index[is_kept_obstacle], minlength=len(self.roof_ids))[
+                is_selected_roof
+            ],
+            out=obstacle_offsets[1:],
+        )
+
+        # the polygons are shared: the identifiers in the metadata are unchanged
+        return MetadataStore(
+            self.roofs.loc[is_selected_roof].reset_index(drop=True),
+            self.obstacles.loc[is_kept_obstacle].reset_index(drop=True),
+            obstacle_offsets,
+            self.roof_polygons,
+            self.obstacle_polygons,
+        )
+
+
+def as_metadata_store(metadata: DataFrame | MetadataStore) -> MetadataStore:
+    """Returns the metadata as a `MetadataStore`, building it if it is a DataFrame.
+
+    Parameters
+    ----------
+    metadata : DataFrame or MetadataStore
+        The obstacles metadata.
+
+    Returns
+    -------
+    MetadataStore
+        The indexed metadata. Building it scales with the size of the metadata: keep
+        it, and pass it to the functions that look up single roofs (see
+        `require_metadata_store`).
+    """
+    if isinstance(metadata, MetadataStore):
+        return metadata
+    return MetadataStore.from_dataframe(metadata)
+
+
+def require_metadata_store(metadata: MetadataStore) -> MetadataStore:
+    """Returns the metadata if it is a `MetadataStore`, and raises TypeError otherwise:
+    functions that look up single roofs would build the store at every call.
+
+    Parameters
+    ----------
+    metadata : MetadataStore
+        The obstacles metadata.
+
+    Returns
+    -------
+    MetadataStore
+        The metadata itself.
+    """
+    if not isinstance(metadata, MetadataStore):
+        raise TypeError(
+            f"Expected a MetadataStore, got {type(metadata).__name__}: build it once "
+            "with `MetadataStore.from_dataframe` and reuse it."
+        )
+    return metadata
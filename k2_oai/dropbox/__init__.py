@@ -2,5 +2,10 @@
 Wrapper around the Dropbox APIs to read from and write data to Dropbox.
 """
 
+from ._cache import *
 from ._io import *
+from ._listing import *
+from ._parallel import *
 from ._paths import *
+from ._storage import *
+from ._watcher import *
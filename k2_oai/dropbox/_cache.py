@@ -0,0 +1,331 @@
+"""
+Persistent local cache of the files downloaded from Dropbox.
+
+Files are stored in `DROPBOX_CACHE_DIR`, keyed by their Dropbox content hash: a cached
+copy is valid as long as the hash of the file on Dropbox is the same, which a cheap
+metadata call (or the photos catalog) tells without downloading the file. Copies of a
+file share the same cached copy. When the cache grows above its size limit, the least
+recently used files are evicted, except those used in the last minute: a path returned
+by `DropboxCache.get` is not removed under the feet of the caller about to open it.
+
+Downloads land in a unique temporary file and are then renamed atomically, so that
+concurrent sessions never read or overwrite each other's partial downloads. Photos are
+read as bytes (see `DropboxCache.read`): they are downloaded in memory and only then
+written to the cache, if the cache folder is writable; otherwise, files that must be
+on disk are downloaded to a private temporary folder, removed at exit. Files of
+storage backends with local paths (see `LocalBackend`) are never cached.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ._storage import as_storage_backend
+
+__all__ = [
+    "DROPBOX_CACHE_DIR",
+    "DROPBOX_CACHE_SIZE",
+    "DropboxCache",
+    "get_dropbox_cache",
+    "dropbox_download_cached",
+    "dropbox_read_cached",
+]
+
+DROPBOX_CACHE_DIR = os.environ.get(
+    "K2_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "k2_oai")
+)
+# the size limit of the cache, in bytes
+DROPBOX_CACHE_SIZE = int(os.environ.get("K2_CACHE_SIZE", 4 * 1024**3))
+
+_TEMPORARY_PREFIX = ".download-"
+
+# the private folder of the files downloaded when the cache is read-only
+_uncached_dir = None
+_uncached_dir_lock = threading.Lock()
+
+
+def _get_uncached_dir() -> str:
+    global _uncached_dir
+
+    with _uncached_dir_lock:
+        if _uncached_dir is None:
+            _uncached_dir = tempfile.mkdtemp(prefix="k2_oai-")
+            atexit.register(shutil.rmtree, _uncached_dir, ignore_errors=True)
+        return _uncached_dir
+
+
+def _download_uncached(storage, dropbox_path: str) -> str:
+    # keep the extension, which some readers use to pick the format
+    _, extension = os.path.splitext(dropbox_path)
+    file_descriptor, local_path = tempfile.mkstemp(
+        prefix=_TEMPORARY_PREFIX, suffix=extension.lower(), dir=_get_uncached_dir()
+    )
+    os.close(file_descriptor)
+    try:
+        storage.download_to_file(local_path, dropbox_path)
+    except BaseException:
+        os.remove(local_path)
+        raise
+
+    return local_path
+
+
+class DropboxCache:
+    """Cache of Dropbox files in a local folder, with LRU eviction.
+
+    Parameters
+    ----------
+    cache_dir : str (default: DROPBOX_CACHE_DIR)
+        The local folder of the cache. It is created if it does not exist.
+    max_size : int (default: DROPBOX_CACHE_SIZE)
+        The size limit of the cache, in bytes.
+    min_age : float (default: 60.0)
+        The files used more recently than this, in seconds, are never evicted, even
+        if the cache is above its size limit: the paths returned by `get` stay valid
+        for at least this long, also in other threads and processes.
+    """
+
+    def __init__(
+        self,
+        cache_dir=DROPBOX_CACHE_DIR,
+        max_size=DROPBOX_CACHE_SIZE,
+        min_age: float = 60.0,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.min_age = min_age
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            # e.g. a read-only filesystem: files are read (see `read`) but not cached
+            pass
+
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _cached_path(self, content_hash: str, dropbox_path: str) -> str:
+        # keep the extension, which some readers use to pick the format
+        _, extension = os.path.splitext(dropbox_path)
+        return os.path.join(self.cache_dir, f"{content_hash}{extension.lower()}")
+
+    def _cached_files(self) -> list[tuple[float, int, str]]:
+        # the last use, size and path of every cached file
+        cached_files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.startswith(_TEMPORARY_PREFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # evicted by another process while scanning
+                continue
+            cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+        return cached_files
+
+    @property
+    def size(self) -> int:
+        """The size of the cached files, in bytes."""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._cached_files())
+            return self._size
+
+    def _mark_as_used(self, cached_path: str) -> bool:
+        try:
+            os.utime(cached_path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # the cache is read-only: the file is still valid
+            return os.path.exists(cached_path)
+
+    def _add(self, cached_path: str, file_size: int):
+        with self._lock:
+            if self._size is not None:
+                self._size += file_size
+        if self.size > self.max_size:
+            self.evict(keep=cached_path)
+
+    def get(self, dropbox_app, dropbox_path: str, content_hash: str | None = None):
+        """Returns the local path of a cached copy of the file, downloading it if
+        there is none or if the file changed on Dropbox.
+
+        Parameters
+        ----------
+        dropbox_app : Dropbox or StorageBackend
+            The Dropbox app instance.
+        dropbox_path : str
+            The Dropbox path of the file.
+        content_hash : str or None (default: None)
+            The content hash of the file, e.g. from the photos catalog. If None, it is
+            read from the metadata of the file on Dropbox.
+
+        Returns
+        -------
+        str
+            The local path of the file. It must not be modified or removed, and must be
+            opened within `min_age` seconds, after which it may be evicted. If the
+            cache folder is not writable, the file is downloaded to a private temporary
+            folder instead, which is removed when the interpreter exits.
+        """
+        storage = as_storage_backend(dropbox_app)
+        local_path = storage.local_path(dropbox_path)
+        if local_path is not None:
+            return local_path
+
+        if content_hash is None:
+            content_hash = storage.get_metadata(dropbox_path).content_hash
+
+        cached_path = self._cached_path(content_hash, dropbox_path)
+        if self._mark_as_used(cached_path):
+            return cached_path
+
+        try:
+            file_descriptor, temporary_path = tempfile.mkstemp(
+                prefix=_TEMPORARY_PREFIX, dir=self.cache_dir
+            )
+        except OSError:
+            # the cache is read-only: download to a private file outside of it
+            return _download_uncached(storage, dropbox_path)
+        os.close(file_descriptor)
+        try:
+            file_metadata = storage.download_to_file(temporary_path, dropbox_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        # the file may have changed since its hash was read: key it by what was
+        # actually downloaded
+        cached_path = self._cached_path(file_metadata.content_hash, dropbox_path)
+        os.replace(temporary_path, cached_path)
+        self._add(cached_path, file_metadata.size)
+
+        return cached_path
+
+    def read(
+        self, dropbox_app, dropbox_path: str, content_hash: str | None = None
+    ) -> bytes:
+        """Returns the content of the file, from the cache or downloaded in memory.
+        Downloaded files are then cached, unless the cache folder is not writable.
+
+        The parameters are the same as `get`.
+
+        Returns
+        -------
+        bytes
+            The content of the file.
+        """
+        storage = as_storage_backend(dropbox_app)
+        if storage.local_path(dropbox_path) is not None:
+            return storage.download(dropbox_path)[1]
+
+        if content_hash is None:
+            content_hash = storage.get_metadata(dropbox_path).content_hash
+
+        cached_path = self._cached_path(content_hash, dropbox_path)
+        if self._mark_as_used(cached_path):
+            try:
+                with open(cached_path, "rb") as cached_file:
+                    return cached_file.read()
+            except FileNotFoundError:
+                # evicted in the meantime
+                pass
+
+        file_metadata, content = storage.download(dropbox_path)
+
+        cached_path = self._cached_path(file_metadata.content_hash, dropbox_path)
+        try:
+            file_descriptor, temporary_path = tempfile.mkstemp(
+                prefix=_TEMPORARY_PREFIX, dir=self.cache_dir
+            )
+        except OSError:
+            # the cache is read-only
+            return content
+
+        try:
+            with os.fdopen(file_descriptor, "wb") as temporary_file:
+                temporary_file.write(content)
+            os.replace(temporary_path, cached_path)
+        except OSError:
+            # e.g. the disk is full: the file is not cached
+            os.remove(temporary_path)
+            return content
+        self._add(cached_path, file_metadata.size)
+
+        return content
+
+    def evict(self, keep: str | None = None):
+        """Removes the least recently used files until the cache is within its size
+        limit. The files used in the last `min_age` seconds are kept.
+
+        Parameters
+        ----------
+        keep : str or None (default: None)
+            A cached file that must not be removed, e.g. the one just downloaded.
+        """
+        with self._lock:
+            cached_files = sorted(self._cached_files())
+            size = sum(file_size for _, file_size, _ in cached_files)
+            min_mtime = time.time() - self.min_age
+
+            for mtime, file_size, path in cached_files:
+                if size <= self.max_size or mtime > min_mtime:
+                    # the other files were used more recently
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # evicted by another process
+                    pass
+                except PermissionError:
+                    # e.g. open on Windows
+                    continue
+                size -= file_size
+
+            self._size = size
+
+    def clear(self):
+        """Removes all the cached files."""
+        with self._lock:
+            for _, _, path in self._cached_files():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+
+
+_dropbox_cache = None
+
+
+def get_dropbox_cache() -> DropboxCache:
+    """Returns the cache in `DROPBOX_CACHE_DIR`, shared by all the loaders."""
+    global _dropbox_cache
+
+    if _dropbox_cache is None:
+        _dropbox_cache = DropboxCache()
+    return _dropbox_cache
+
+
+def dropbox_download_cached(
+    dropbox_app, download_from: str, content_hash: str | None = None
+) -> str:
+    """Downloads a file through the shared cache (see `DropboxCache.get`) and returns
+    its local path."""
+    return get_dropbox_cache().get(dropbox_app, download_from, content_hash)
+
+
+def dropbox_read_cached(
+    dropbox_app, download_from: str, content_hash: str | None = None
+) -> bytes:
+    """Reads a file through the shared cache (see `DropboxCache.read`) and returns its
+    content."""
+    return get_dropbox_cache().read(dropbox_app, download_from, content_hash)
@@ -6,10 +6,11 @@ download files.
 import os
 
 import dropbox
-import pandas as pd
 from dotenv import load_dotenv
-from dropbox.exceptions import ApiError, AuthError
-from dropbox.files import WriteMode
+from dropbox.exceptions import AuthError
+
+from ._listing import get_dropbox_listings
+from ._storage import as_storage_backend
 
 load_dotenv()
 
@@ -114,68 +115,28 @@ def dropbox_connect(
         return None
 
 
-def _parse_dropbox_folder_content(folder_content):
-    files_list = []
-
-    files = folder_content.entries
-
-    for file in files:
-        if isinstance(file, dropbox.files.FolderMetadata):
-            metadata = {
-                "item_type": "folder",
-                "item_dropbox_id": file.id,
-                "item_name": file.name,
-                "item_abs_path": file.path_display,
-                # 'client_modified': file.client_modified,
-                # 'server_modified': file.server_modified
-            }
-            files_list.append(metadata)
-        elif isinstance(file, dropbox.files.FileMetadata):
-            metadata = {
-                "item_type": "file",
-                "item_dropbox_id": file.id,
-                "item_name": file.name,
-                "item_abs_path": file.path_display,
-                # 'client_modified': file.client_modified,
-                # 'server_modified': file.server_modified
-            }
-            files_list.append(metadata)
-
-    return files_list
-
-
-def dropbox_listdir(dropbox_path, dropbox_app):
+def dropbox_listdir(dropbox_path, dropbox_app, recursive: bool = False):
     """Return a Pandas dataframe of files in a given Dropbox folder path in the Apps
-    directory.
-    """
-
-    files_list = []
+    directory. `dropbox_app` can also be a `StorageBackend`.
 
-    dbx_folder_contents = dropbox_app.files_list_folder(dropbox_path)
-    files = dbx_folder_contents.entries
-
-    while dbx_folder_contents.has_more or len(files):
-        files = dbx_folder_contents.entries
-        files_list += _parse_dropbox_folder_content(dbx_folder_contents)
-        dbx_folder_contents = dropbox_app.files_list_folder_continue(
-            dbx_folder_contents.cursor
-        )
+    The listing is stored locally with its cursor: the following calls only list the
+    changes since then (see `DropboxListings`).
+    """
 
-    return pd.DataFrame.from_records(files_list)
+    return get_dropbox_listings().listdir(dropbox_app, dropbox_path, recursive)
 
 
 def dropbox_upload_file_to(
     dropbox_app, upload_from, save_to, remove_original: bool = False
 ):
+    """Uploads a local file, overwriting the file on Dropbox if it exists. Large files
+    are streamed from disk in chunks (see `DropboxBackend.upload_file`)."""
     with open(upload_from, "rb") as f:
-        try:
-            dropbox_app.files_upload(f.read(), save_to, mode=WriteMode.add)
-        except ApiError:
-            dropbox_app.files_upload(f.read(), save_to, mode=WriteMode.overwrite)
+        as_storage_backend(dropbox_app).upload_file(f, save_to, overwrite=True)
 
     if remove_original:
         os.remove(upload_from)
 
 
 def dropbox_download_from(dropbox_app, save_to, download_from):
-    dropbox_app.files_download_to_file(save_to, download_from)
+    as_storage_backend(dropbox_app).download_to_file(save_to, download_from)
@@ -0,0 +1,185 @@
+"""
+Incremental listings of Dropbox folders, persisted on disk with their cursor.
+
+The first listing of a folder lists all its contents and stores them, with the cursor
+Dropbox returns, in `DROPBOX_LISTINGS_DIR`. The following listings, also after a
+restart, only ask Dropbox for the changes since the cursor (see
+`StorageBackend.list_folder_changes`): listing a folder with tens of thousands of
+photos costs one small request. If the cursor expired, the folder is listed again.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from hashlib import sha256
+
+import pandas as pd
+from dropbox.exceptions import ApiError
+from pandas import DataFrame
+
+from ._cache import DROPBOX_CACHE_DIR
+from ._storage import as_storage_backend
+
+__all__ = [
+    "DROPBOX_LISTINGS_DIR",
+    "DropboxListings",
+    "get_dropbox_listings",
+]
+
+DROPBOX_LISTINGS_DIR = os.path.join(DROPBOX_CACHE_DIR, "listings")
+
+
+class DropboxListings:
+    """Listings of Dropbox folders, updated with the changes since the last listing.
+
+    Parameters
+    ----------
+    listings_dir : str (default: DROPBOX_LISTINGS_DIR)
+        The local folder the listings are stored in. If it is not writable, the
+        listings are only kept in memory.
+    """
+
+    def __init__(self, listings_dir=DROPBOX_LISTINGS_DIR):
+        self.listings_dir = listings_dir
+        try:
+            os.makedirs(listings_dir, exist_ok=True)
+        except OSError:
+            pass
+
+        self._listings = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _listing_file(self, path: str, recursive: bool) -> str:
+        key = sha256(f"{path.lower()}:{recursive}".encode()).hexdigest()
+        return os.path.join(self.listings_dir, f"{key}.json")
+
+    def _load(self, listing_file: str) -> dict | None:
+        if listing_file in self._listings:
+            return self._listings[listing_file]
+        try:
+            with open(listing_file) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, listing_file: str, listing: dict):
+        self._listings[listing_file] = listing
+        try:
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.listings_dir)
+        except OSError:
+            return
+        try:
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(listing, file)
+            os.replace(temporary_path, listing_file)
+        except OSError:
+            os.remove(temporary_path)
+
+    def listdir(self, dropbox_app, path: str, recursive: bool = False) -> DataFrame:
+        """Lists the contents of a folder, only asking Dropbox for the changes since
+        the last listing.
+
+        Parameters
+        ----------
+        dropbox_app : Dropbox or StorageBackend
+            The Dropbox app instance. Backends that do not support cursors, e.g.
+            `LocalBackend`, are listed in full every time.
+        path : str
+            The path of the folder.
+        recursive : bool (default: False)
+            If True, also lists the contents of the subfolders.
+
+        Returns
+        -------
+        DataFrame
+            The contents of the folder (see `StorageBackend.list_folder`).
+        """
+        storage = as_storage_backend(dropbox_app)
+        listing_file = self._listing_file(path, recursive)
+
+        with self._lock:
+            lock = self._locks.setdefault(listing_file, threading.Lock())
+
+        with lock:
+            listing = self._load(listing_file)
+
+            if listing is not None:
+                try:
+                    records, deleted_paths, cursor = storage.list_folder_changes(
+                        listing["cursor"]
+                    )
+                except (ApiError, NotImplementedError):
+                    # the cursor expired, or it belongs to another backend
+                    listing = None
+                else:
+                    if records or deleted_paths:
+                        listing = _apply_changes(listing, records, deleted_paths)
+                        listing["cursor"] = cursor
+                        self._save(listing_file, listing)
+                    else:
+                        # the stored cursor still lists no changes: only keep the new
+                        # one in memory
+                        listing = self._listings[listing_file] = {
+                            "cursor": cursor,
+                            "entries": listing["entries"],
+                        }
+
+            if listing is None:
+                records, cursor = storage.list_folder_with_cursor(path, recursive)
+                if cursor is None:
+                    return pd.DataFrame.from_records(records)
+
+                listing = {
+                    "cursor": cursor,
+                    "entries": {
+                        record["item_abs_path"].lower(): record for record in records
+                    },
+                }
+                self._save(listing_file, listing)
+
+            return pd.DataFrame.from_records(list(listing["entries"].values()))
+
+    def clear(self):
+        """Removes all the listings."""
+        with self._lock:
+            self._listings.clear()
+            for entry in os.scandir(self.listings_dir):
+                os.remove(entry.path)
+
+
+def _apply_changes(listing: dict, records: list[dict], deleted_paths: list[str]):
+    entries = dict(listing["entries"])
+
+    for deleted_path in deleted_paths:
+        deleted_path = deleted_path.lower()
+        deleted = entries.pop(deleted_path, None)
+        if deleted is not None and deleted["item_type"] == "file":
+            continue
+
+        # the contents of a deleted folder are deleted with it
+        deleted_contents = [
+            entry for entry in entries if entry.startswith(f"{deleted_path}/")
+        ]
+        for entry in deleted_contents:
+            del entries[entry]
+
+    for record in records:
+        entries[record["item_abs_path"].lower()] = record
+
+    return {"cursor": listing["cursor"], "entries": entries}
+
+
+_dropbox_listings = None
+
+
+def get_dropbox_listings() -> DropboxListings:
+    """Returns the listings in `DROPBOX_LISTINGS_DIR`, shared by all the loaders."""
+    global _dropbox_listings
+
+    if _dropbox_listings is None:
+        _dropbox_listings = DropboxListings()
+    return _dropbox_listings
@@ -0,0 +1,235 @@
+"""
+Concurrent calls to the Dropbox APIs, to download or upload many files at once.
+
+The Dropbox SDK is synchronous: bulk jobs run the calls in a pool of threads, with at
+most `max_workers` calls in flight, and get the results as they complete. Calls that
+fail because of rate limits or transient errors (server errors, dropped connections)
+are retried with jittered exponential backoff.
+"""
+
+from __future__ import annotations
+
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator
+
+from dropbox.exceptions import InternalServerError, RateLimitError
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout
+
+from ._cache import dropbox_read_cached
+from ._storage import StorageFile, as_storage_backend
+
+__all__ = [
+    "DROPBOX_MAX_WORKERS",
+    "DROPBOX_MAX_RETRIES",
+    "dropbox_call_with_retry",
+    "dropbox_map_concurrently",
+    "dropbox_read_many",
+    "dropbox_upload_folder",
+]
+
+DROPBOX_MAX_WORKERS = 8
+DROPBOX_MAX_RETRIES = 5
+
+_TRANSIENT_ERRORS = (
+    RateLimitError,
+    InternalServerError,
+    RequestsConnectionError,
+    Timeout,
+)
+_EXHAUSTED = object()
+
+
+def _backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    # "full jitter": a random delay up to the exponential backoff, so that the calls
+    # that failed together do not retry together
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def dropbox_call_with_retry(
+    function: Callable,
+    *args,
+    max_retries: int = DROPBOX_MAX_RETRIES,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    **kwargs,
+):
+    """Calls a Dropbox API, retrying it on rate limits and transient errors.
+
+    Parameters
+    ----------
+    function : Callable
+        The function to call, e.g. `dropbox_app.files_download`.
+    *args, **kwargs
+        The arguments of the function.
+    max_retries : int (default: DROPBOX_MAX_RETRIES)
+        The maximum number of retries. The last error is raised.
+    base_delay : float (default: 1.0)
+        The delay before the first retry, in seconds, before jitter. It doubles at
+        every retry.
+    max_delay : float (default: 60.0)
+        The maximum delay between retries, in seconds.
+
+    Returns
+    -------
+    Any
+        The result of the function.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except _TRANSIENT_ERRORS as error:
+            if attempt == max_retries:
+                raise
+
+            delay = _backoff(attempt, base_delay, max_delay)
+            # Dropbox tells how long to wait after a rate limit
+            if isinstance(error, RateLimitError) and error.backoff is not None:
+                delay = max(delay, error.backoff)
+            time.sleep(delay)
+
+
+def dropbox_map_concurrently(
+    function: Callable,
+    items: Iterable,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+    max_retries: int = DROPBOX_MAX_RETRIES,
+) -> Iterator[tuple[Any, Any]]:
+    """Calls a function on many items in a pool of threads, retrying each call on
+    rate limits and transient errors (see `dropbox_call_with_retry`).
+
+    Parameters
+    ----------
+    function : Callable
+        The function to call on each item, e.g. a loader.
+    items : Iterable
+        The items. They are consumed lazily: at most `max_workers` calls are in flight
+        and at most `max_workers` results are waiting to be consumed.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of concurrent calls.
+    max_retries : int (default: DROPBOX_MAX_RETRIES)
+        The maximum number of retries of each call.
+
+    Yields
+    ------
+    tuple[Any, Any]
+        Each item and its result, in the order the calls complete. If a call fails,
+        its error is raised and the pending calls are cancelled.
+    """
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit(item):
+            future = executor.submit(
+                dropbox_call_with_retry, function, item, max_retries=max_retries
+            )
+            pending[future] = item
+
+        for item in items:
+            submit(item)
+            if len(pending) == max_workers:
+                break
+
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    yield item, future.result()
+
+                    next_item = next(items, _EXHAUSTED)
+                    if next_item is not _EXHAUSTED:
+                        submit(next_item)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def dropbox_read_many(
+    dropbox_app,
+    dropbox_paths: Iterable[str],
+    max_workers: int = DROPBOX_MAX_WORKERS,
+    content_hashes: dict[str, str] | None = None,
+) -> Iterator[tuple[str, bytes]]:
+    """Reads many files through the shared cache (see `dropbox_read_cached`),
+    concurrently.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    dropbox_paths : Iterable[str]
+        The Dropbox paths of the files.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of concurrent downloads.
+    content_hashes : dict[str, str] or None (default: None)
+        The content hash of some of the files, e.g. from the photos catalog: they
+        spare a metadata call each.
+
+    Yields
+    ------
+    tuple[str, bytes]
+        The path and the content of each file, in the order the downloads complete.
+    """
+    content_hashes = content_hashes or {}
+
+    def read(dropbox_path):
+        return dropbox_read_cached(
+            dropbox_app, dropbox_path, content_hashes.get(dropbox_path)
+        )
+
+    yield from dropbox_map_concurrently(read, dropbox_paths, max_workers)
+
+
+def dropbox_upload_folder(
+    dropbox_app,
+    upload_from: str,
+    save_to: str,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+    overwrite: bool = True,
+) -> list[StorageFile]:
+    """Uploads the files of a local folder and of its subfolders concurrently, e.g. a
+    partitioned dataset (see `write_obstacles_geoparquet`). Each file is streamed from
+    disk (see `StorageBackend.upload_file`).
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    upload_from : str
+        The local folder.
+    save_to : str
+        The Dropbox folder to upload the files to, with the same layout.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of concurrent uploads.
+    overwrite : bool (default: True)
+        If False and a file exists on Dropbox, an error is raised.
+
+    Returns
+    -------
+    list[StorageFile]
+        The metadata of the uploaded files, sorted by path.
+    """
+    storage = as_storage_backend(dropbox_app)
+    save_to = save_to.rstrip("/")
+
+    local_paths = sorted(
+        os.path.join(folder, file)
+        for folder, _, files in os.walk(upload_from)
+        for file in files
+    )
+
+    def upload(local_path):
+        relative_path = os.path.relpath(local_path, upload_from).replace(os.sep, "/")
+        with open(local_path, "rb") as local_file:
+            return storage.upload_file(
+                local_file, f"{save_to}/{relative_path}", overwrite
+            )
+
+    uploaded_files = dropbox_map_concurrently(upload, local_paths, max_workers)
+    return sorted((file for _, file in uploaded_files), key=lambda file: file.path)
@@ -8,6 +8,7 @@ __all__ = [
     "DROPBOX_EXTERNAL_DATA_PATH",
     "DROPBOX_HYPERPARAM_ANNOTATIONS_PATH",
     "DROPBOX_LABEL_ANNOTATIONS_PATH",
+    "DROPBOX_MODELS_PATH",
     "DROPBOX_PHOTOS_METADATA_PATH",
     "DROPBOX_RAW_PHOTOS_ROOT",
 ]
@@ -16,5 +17,6 @@ DROPBOX_DESIGN_MATRIX_PATH = "/k2/design_matrix"
 DROPBOX_EXTERNAL_DATA_PATH = "/k2/external_data"
 DROPBOX_HYPERPARAM_ANNOTATIONS_PATH = "/k2/metadata/hyperparameters"
 DROPBOX_LABEL_ANNOTATIONS_PATH = "/k2/metadata/label_annotations"
+DROPBOX_MODELS_PATH = "/k2/models"
 DROPBOX_PHOTOS_METADATA_PATH = "/k2/metadata/transformed_data"
 DROPBOX_RAW_PHOTOS_ROOT = "/k2/raw_photos"
@@ -0,0 +1,614 @@
+"""
+Storage backends: list, read and write the files of the `/k2/...` layout (see
+`_paths.py`) on Dropbox or in a local folder with the same layout, e.g. a NAS mirror,
+an offline container or a test fixture.
+
+Every function that takes a `dropbox_app` also accepts a `StorageBackend`: Dropbox apps
+are wrapped in a `DropboxBackend` (see `as_storage_backend`).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import BinaryIO, NamedTuple
+
+import dropbox
+import pandas as pd
+from dropbox.exceptions import ApiError
+from dropbox.files import (
+    CommitInfo,
+    UploadSessionCursor,
+    UploadSessionFinishArg,
+    WriteMode,
+)
+from pandas import DataFrame
+
+__all__ = [
+    "LOCAL_STORAGE_ROOT",
+    "DROPBOX_UPLOAD_CHUNK_SIZE",
+    "StorageFile",
+    "StorageBackend",
+    "DropboxBackend",
+    "LocalBackend",
+    "as_storage_backend",
+    "dropbox_content_hash",
+]
+
+# if set, the dashboard reads and writes the files in this local folder, not on Dropbox
+LOCAL_STORAGE_ROOT = os.environ.get("K2_LOCAL_STORAGE")
+
+# the size of the blocks of the Dropbox content hash
+_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# files larger than this are uploaded in chunks of this size, in an upload session: a
+# single request uploads at most 150 MiB. Chunks are multiples of 4 MiB
+DROPBOX_UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+
+
+class StorageFile(NamedTuple):
+    """The metadata of a file in a storage backend."""
+
+    path: str
+    content_hash: str
+    size: int
+    rev: str
+
+
+class StorageBackend(ABC):
+    """Reads and writes the files of the `/k2/...` layout. Paths are absolute and
+    start with a slash, as on Dropbox."""
+
+    def list_folder(self, path: str, recursive: bool = False) -> DataFrame:
+        """Lists the contents of a folder.
+
+        Parameters
+        ----------
+        path : str
+            The path of the folder.
+        recursive : bool (default: False)
+            If True, also lists the contents of the subfolders.
+
+        Returns
+        -------
+        DataFrame
+            One row per file or folder, with the `item_type` ("file" or "folder"),
+            the `item_dropbox_id`, the `item_name` and the `item_abs_path`. Files also
+            have the `item_content_hash`, the `item_size` and the `item_rev`.
+        """
+        records, _ = self.list_folder_with_cursor(path, recursive)
+        return pd.DataFrame.from_records(records)
+
+    @abstractmethod
+    def list_folder_with_cursor(
+        self, path: str, recursive: bool = False
+    ) -> tuple[list[dict], str | None]:
+        """Lists the contents of a folder, as records (see `list_folder`), and returns
+        a cursor to list the changes since then (see `list_folder_changes`), or None if
+        the backend does not support cursors."""
+
+    def list_folder_changes(self, cursor: str) -> tuple[list[dict], list[str], str]:
+        """Lists the changes to a folder since a listing or since the previous changes.
+
+        Parameters
+        ----------
+        cursor : str
+            The cursor returned by `list_folder_with_cursor` or by the previous call.
+
+        Returns
+        -------
+        tuple[list[dict], list[str], str]
+            The records of the added or modified files and folders (see
+            `list_folder`), the paths of the deleted ones and the new cursor.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support listing changes."
+        )
+
+    def get_latest_cursor(self, path: str, recursive: bool = False) -> str:
+        """Returns a cursor to wait for the changes to a folder from now on (see
+        `wait_for_changes`), without listing it."""
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support waiting for changes."
+        )
+
+    def wait_for_changes(
+        self, cursor: str, timeout: int = 30
+    ) -> tuple[bool, float | None]:
+        """Waits until the folder of the cursor changes, or until the timeout.
+
+        Parameters
+        ----------
+        cursor : str
+            The cursor returned by `get_latest_cursor`. It is not advanced: after a
+            change, get a new cursor.
+        timeout : int (default: 30)
+            The maximum time to wait, in seconds.
+
+        Returns
+        -------
+        tuple[bool, float or None]
+            Whether the folder changed, and how many seconds to wait before waiting
+            again, if the backend asks to back off.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support waiting for changes."
+        )
+
+    @abstractmethod
+    def get_metadata(self, path: str) -> StorageFile:
+        """Returns the metadata of a file, without reading it."""
+
+    @abstractmethod
+    def download(self, path: str) -> tuple[StorageFile, bytes]:
+        """Returns the metadata and the content of a file."""
+
+    def download_to_file(self, local_path: str, path: str) -> StorageFile:
+        """Downloads a file to a local path and returns its metadata."""
+        metadata, content = self.download(path)
+        with open(local_path, "wb") as local_file:
+            local_file.write(content)
+        return metadata
+
+    @abstractmethod
+    def upload(self, content: bytes, path: str, overwrite: bool = True) -> StorageFile:
+        """Writes a file and returns its metadata. If `overwrite` is False and the
+        file exists, an error is raised."""
+
+    def upload_file(
+        self, file: BinaryIO, path: str, overwrite: bool = True
+    ) -> StorageFile:
+        """Writes the content of a binary file, from its current position, and returns
+        its metadata. Backends that support it read the file in chunks, so that large
+        files are never loaded in memory.
+
+        Parameters
+        ----------
+        file : BinaryIO
+            The file, e.g. a local file opened with `open(..., "rb")` or a `BytesIO`.
+        path : str
+            The path to write the file to.
+        overwrite : bool (default: True)
+            If False and the file exists, an error is raised (see `upload`).
+
+        Returns
+        -------
+        StorageFile
+            The metadata of the file.
+        """
+        return self.upload(file.read(), path, overwrite)
+
+    def upload_many(
+        self, files: list[tuple[bytes, str]], overwrite: bool = True
+    ) -> list[StorageFile | None]:
+        """Writes many files, e.g. a batch of small photos, and returns their metadata.
+
+        Parameters
+        ----------
+        files : list[tuple[bytes, str]]
+            The content and the path of each file.
+        overwrite : bool (default: True)
+            If False, the files that exist are not overwritten (see `upload`).
+
+        Returns
+        -------
+        list[StorageFile or None]
+            The metadata of each file, in the same order. Backends that commit the
+            files together (see `DropboxBackend.upload_many`) return None for the
+            files that failed, e.g. because another file is at the same path and
+            `overwrite` is False.
+        """
+        return [self.upload(content, path, overwrite) for content, path in files]
+
+    def delete(self, path: str):
+        """Deletes a file. If it does not exist, an error is raised."""
+        raise NotImplementedError(f"{type(self).__name__} does not support deleting.")
+
+    def local_path(self, path: str) -> str | None:
+        """Returns the local path of a file, if it can be read directly from the local
+        filesystem, else None. Files with a local path are not cached."""
+        return None
+
+
+def _parse_dropbox_folder_content(folder_content, deleted_paths=None):
+    files_list = []
+
+    files = folder_content.entries
+
+    for file in files:
+        if isinstance(file, dropbox.files.FolderMetadata):
+            metadata = {
+                "item_type": "folder",
+                "item_dropbox_id": file.id,
+                "item_name": file.name,
+                "item_abs_path": file.path_display,
+                # 'client_modified': file.client_modified,
+                # 'server_modified': file.server_modified
+            }
+            files_list.append(metadata)
+        elif isinstance(file, dropbox.files.FileMetadata):
+            metadata = {
+                "item_type": "file",
+                "item_dropbox_id": file.id,
+                "item_name": file.name,
+                "item_abs_path": file.path_display,
+                # identifies the content: copies of a file have the same hash
+                "item_content_hash": file.content_hash,
+                "item_size": file.size,
+                "item_rev": file.rev,
+                # 'client_modified': file.client_modified,
+                # 'server_modified': file.server_modified
+            }
+            files_list.append(metadata)
+        elif (
+            isinstance(file, dropbox.files.DeletedMetadata)
+            and deleted_paths is not None
+        ):
+            deleted_paths.append(file.path_display)
+
+    return files_list
+
+
+def _as_storage_file(metadata) -> StorageFile:
+    return StorageFile(
+        metadata.path_display, metadata.content_hash, metadata.size, metadata.rev
+    )
+
+
+class DropboxBackend(StorageBackend):
+    """Reads and writes files on Dropbox.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox
+        The Dropbox app instance, e.g. from `dropbox_connect`.
+    """
+
+    def __init__(self, dropbox_app):
+        self.dropbox_app = dropbox_app
+
+    def list_folder_with_cursor(
+        self, path: str, recursive: bool = False
+    ) -> tuple[list[dict], str]:
+        dbx_folder_contents = self.dropbox_app.files_list_folder(
+            path, recursive=recursive
+        )
+        files_list = _parse_dropbox_folder_content(dbx_folder_contents)
+
+        while dbx_folder_contents.has_more:
+            dbx_folder_contents = self.dropbox_app.files_list_folder_continue(
+                dbx_folder_contents.cursor
+            )
+            files_list += _parse_dropbox_folder_content(dbx_folder_contents)
+
+        return files_list, dbx_folder_contents.cursor
+
+    def list_folder_changes(self, cursor: str) -> tuple[list[dict], list[str], str]:
+        files_list, deleted_paths = [], []
+
+        has_more = True
+        while has_more:
+            dbx_folder_contents = self.dropbox_app.files_list_folder_continue(cursor)
+            files_list += _parse_dropbox_folder_content(
+                dbx_folder_contents, deleted_paths
+            )
+            cursor, has_more = dbx_folder_contents.cursor, dbx_folder_contents.has_more
+
+        return files_list, deleted_paths, cursor
+
+    def get_latest_cursor(self, path: str, recursive: bool = False) -> str:
+        return self.dropbox_app.files_list_folder_get_latest_cursor(
+            path, recursive=recursive
+        ).cursor
+
+    def wait_for_changes(
+        self, cursor: str, timeout: int = 30
+    ) -> tuple[bool, float | None]:
+        # long polling: Dropbox answers as soon as something changes
+        result = self.dropbox_app.files_list_folder_longpoll(cursor, timeout=timeout)
+        return result.changes, result.backoff
+
+    def get_metadata(self, path: str) -> StorageFile:
+        return _as_storage_file(self.dropbox_app.files_get_metadata(path))
+
+    def download(self, path: str) -> tuple[StorageFile, bytes]:
+        metadata, response = self.dropbox_app.files_download(path)
+        with response:
+            return _as_storage_file(metadata), response.content
+
+    def download_to_file(self, local_path: str, path: str) -> StorageFile:
+        return _as_storage_file(
+            self.dropbox_app.files_download_to_file(local_path, path)
+        )
+
+    def upload(self, content: bytes, path: str, overwrite: bool = True) -> StorageFile:
+        if len(content) > DROPBOX_UPLOAD_CHUNK_SIZE:
+            with BytesIO(content) as file:
+                return self.upload_file(file, path, overwrite)
+
+        mode = WriteMode.overwrite if overwrite else WriteMode.add
+        return _as_storage_file(self.dropbox_app.files_upload(content, path, mode=mode))
+
+    def delete(self, path: str):
+        self.dropbox_app.files_delete_v2(path)
+
+    def _upload_session(self, file: BinaryIO) -> UploadSessionCursor:
+        # uploads the file in chunks to a new upload session, and closes it. Chunks
+        # are retried on transient errors (imported here: `_parallel` depends on
+        # this module)
+        from ._parallel import dropbox_call_with_retry
+
+        start = file.tell()
+        session_id, offset = None, 0
+
+        while True:
+            chunk = file.read(DROPBOX_UPLOAD_CHUNK_SIZE)
+            close = len(chunk) < DROPBOX_UPLOAD_CHUNK_SIZE
+
+            if session_id is None:
+                session_id = dropbox_call_with_retry(
+                    self.dropbox_app.files_upload_session_start, chunk, close=close
+                ).session_id
+            else:
+                try:
+                    dropbox_call_with_retry(
+                        self.dropbox_app.files_upload_session_append_v2,
+                        chunk,
+                        UploadSessionCursor(session_id, offset),
+                        close=close,
+                    )
+                except ApiError as error:
+                    correct_offset = _correct_offset(error)
+                    if correct_offset is None:
+                        raise
+                    # a retried chunk had been received, only its answer was lost
+                    if not (close and correct_offset == offset + len(chunk)):
+                        offset = correct_offset
+                        file.seek(start + offset)
+                        continue
+
+            offset += len(chunk)
+            if close:
+                return UploadSessionCursor(session_id, offset)
+
+    def upload_file(
+        self, file: BinaryIO, path: str, overwrite: bool = True
+    ) -> StorageFile:
+        from ._parallel import dropbox_call_with_retry
+
+        start = file.tell()
+        size = file.seek(0, os.SEEK_END) - start
+        file.seek(start)
+
+        if size <= DROPBOX_UPLOAD_CHUNK_SIZE:
+            return self.upload(file.read(), path, overwrite)
+
+        mode = WriteMode.overwrite if overwrite else WriteMode.add
+        return _as_storage_file(
+            dropbox_call_with_retry(
+                self.dropbox_app.files_upload_session_finish,
+                b"",
+                self._upload_session(file),
+                CommitInfo(path, mode=mode),
+            )
+        )
+
+    def upload_many(
+        self, files: list[tuple[bytes, str]], overwrite: bool = True
+    ) -> list[StorageFile | None]:
+        # one upload session per file, committed together: concurrent single uploads
+        # to the same folder contend for its lock and fail with
+        # `too_many_write_operations`. A batch has at most 1000 files.
+        mode = WriteMode.overwrite if overwrite else WriteMode.add
+
+        entries = []
+        for content, path in files:
+            with BytesIO(content) as file:
+                cursor = self._upload_session(file)
+            entries.append(UploadSessionFinishArg(cursor, CommitInfo(path, mode=mode)))
+
+        # the batch is committed synchronously: there is no job to poll
+        result = self.dropbox_app.files_upload_session_finish_batch_v2(entries)
+
+        return [
+            _as_storage_file(entry.get_success()) if entry.is_success() else None
+            for entry in result.entries
+        ]
+
+
+def _correct_offset(error: ApiError) -> int | None:
+    # the offset Dropbox expects, if the upload session is at another offset
+    lookup_error = error.error
+    if getattr(lookup_error, "is_incorrect_offset", lambda: False)():
+        return lookup_error.get_incorrect_offset().correct_offset
+    return None
+
+
+def dropbox_content_hash(local_path: str) -> str:
+    """Computes the Dropbox content hash of a local file: the SHA-256 of the
+    concatenated SHA-256 of its 4 MiB blocks."""
+    block_hashes = hashlib.sha256()
+
+    with open(local_path, "rb") as local_file:
+        for block in iter(lambda: local_file.read(_HASH_BLOCK_SIZE), b""):
+            block_hashes.update(hashlib.sha256(block).digest())
+
+    return block_hashes.hexdigest()
+
+
+class LocalBackend(StorageBackend):
+    """Reads and writes files in a local folder with the same layout as Dropbox, e.g.
+    the file `/k2/raw_photos/index.csv` is `{root_dir}/k2/raw_photos/index.csv`.
+
+    Parameters
+    ----------
+    root_dir : str
+        The local folder that mirrors the root of Dropbox.
+    hash_contents : bool (default: False)
+        If True, the content hash of the files is the Dropbox content hash (see
+        `dropbox_content_hash`), so that copies of a file have the same hash. It reads
+        every listed file: by default, the content of a file is identified by its
+        size and modification time.
+    poll_interval : float (default: 1.0)
+        How often `wait_for_changes` checks the folder for changes, in seconds.
+    """
+
+    def __init__(
+        self, root_dir: str, hash_contents: bool = False, poll_interval: float = 1.0
+    ):
+        self.root_dir = os.path.abspath(root_dir)
+        self.hash_contents = hash_contents
+        self.poll_interval = poll_interval
+
+    def local_path(self, path: str) -> str:
+        local_path = os.path.normpath(os.path.join(self.root_dir, path.lstrip("/")))
+        if os.path.commonpath([self.root_dir, local_path]) != self.root_dir:
+            raise ValueError(f"{path} is outside of the storage root.")
+        return local_path
+
+    def _storage_file(self, path: str, stat: os.stat_result) -> StorageFile:
+        rev = f"{stat.st_size:x}{stat.st_mtime_ns:x}"
+        if self.hash_contents:
+            content_hash = dropbox_content_hash(self.local_path(path))
+        else:
+            content_hash = hashlib.sha256(f"{path}:{rev}".encode()).hexdigest()
+        return StorageFile(path, content_hash, stat.st_size, rev)
+
+    def list_folder_with_cursor(
+        self, path: str, recursive: bool = False
+    ) -> tuple[list[dict], None]:
+        files_list = []
+
+        with os.scandir(self.local_path(path)) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                item_path = f"{path.rstrip('/')}/{entry.name}"
+                if entry.is_dir():
+                    files_list.append(
+                        {
+                            "item_type": "folder",
+                            "item_dropbox_id": item_path,
+                            "item_name": entry.name,
+                            "item_abs_path": item_path,
+                        }
+                    )
+                elif entry.is_file():
+                    storage_file = self._storage_file(item_path, entry.stat())
+                    files_list.append(
+                        {
+                            "item_type": "file",
+                            "item_dropbox_id": item_path,
+                            "item_name": entry.name,
+                            "item_abs_path": item_path,
+                            "item_content_hash": storage_file.content_hash,
+                            "item_size": storage_file.size,
+                            "item_rev": storage_file.rev,
+                        }
+                    )
+
+        if recursive:
+            # the contents of the subfolders follow the contents of the folder
+            for record in list(files_list):
+                if record["item_type"] == "folder":
+                    files_list += self.list_folder_with_cursor(
+                        record["item_abs_path"], recursive=True
+                    )[0]
+
+        return files_list, None
+
+    def _fingerprint(self, path: str, recursive: bool) -> str:
+        # the names, sizes and modification times of the contents of the folder
+        fingerprint = hashlib.sha256()
+        local_path = self.local_path(path)
+
+        for folder, folders, files in os.walk(local_path):
+            folders.sort()
+            for name in sorted(folders + files):
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    # removed while walking: the next check will not see it
+                    continue
+                fingerprint.update(
+                    f"{folder}/{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode()
+                )
+            if not recursive:
+                break
+
+        return fingerprint.hexdigest()
+
+    def get_latest_cursor(self, path: str, recursive: bool = False) -> str:
+        return json.dumps(
+            {
+                "path": path,
+                "recursive": recursive,
+                "fingerprint": self._fingerprint(path, recursive),
+            }
+        )
+
+    def wait_for_changes(self, cursor: str, timeout: int = 30) -> tuple[bool, None]:
+        state = json.loads(cursor)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if (
+                self._fingerprint(state["path"], state["recursive"])
+                != state["fingerprint"]
+            ):
+                return True, None
+            if time.monotonic() >= deadline:
+                return False, None
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+
+    def get_metadata(self, path: str) -> StorageFile:
+        return self._storage_file(path, os.stat(self.local_path(path)))
+
+    def download(self, path: str) -> tuple[StorageFile, bytes]:
+        with open(self.local_path(path), "rb") as local_file:
+            content = local_file.read()
+        return self.get_metadata(path), content
+
+    def download_to_file(self, local_path: str, path: str) -> StorageFile:
+        shutil.copyfile(self.local_path(path), local_path)
+        return self.get_metadata(path)
+
+    def upload(self, content: bytes, path: str, overwrite: bool = True) -> StorageFile:
+        with BytesIO(content) as file:
+            return self.upload_file(file, path, overwrite)
+
+    def upload_file(
+        self, file: BinaryIO, path: str, overwrite: bool = True
+    ) -> StorageFile:
+        local_path = self.local_path(path)
+        if not overwrite and os.path.exists(local_path):
+            raise FileExistsError(f"{path} already exists.")
+
+        folder = os.path.dirname(local_path)
+        os.makedirs(folder, exist_ok=True)
+
+        # write to a temporary file first, so that readers never see partial files
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=folder)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temporary_file:
+                shutil.copyfileobj(file, temporary_file)
+            os.replace(temporary_path, local_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        return self.get_metadata(path)
+
+    def delete(self, path: str):
+        os.remove(self.local_path(path))
+
+
+def as_storage_backend(storage) -> StorageBackend:
+    """Returns the storage backend itself, or wraps a Dropbox app in a
+    `DropboxBackend`."""
+    if isinstance(storage, StorageBackend):
+        return storage
+    return DropboxBackend(storage)
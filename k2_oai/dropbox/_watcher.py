@@ -0,0 +1,143 @@
+"""
+Watches Dropbox folders for changes in the background, to invalidate cached listings
+and dataframes only when something changed.
+
+Each watched folder has a version, which is incremented whenever Dropbox notifies a
+change (through long polling, see `StorageBackend.wait_for_changes`). Caches keyed by
+the version of a folder stay valid, with no Dropbox calls, until its contents change.
+"""
+
+from __future__ import annotations
+
+import random
+import threading
+from typing import Callable, Iterable
+
+from ._storage import as_storage_backend
+
+__all__ = [
+    "FolderWatcher",
+]
+
+
+class FolderWatcher:
+    """Watches folders for changes, with one background thread per folder.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox or StorageBackend
+        The Dropbox app instance, or a storage backend that supports waiting for
+        changes, e.g. a `LocalBackend` in tests.
+    paths : Iterable[str]
+        The folders to watch, with their subfolders.
+    timeout : int (default: 120)
+        The maximum time each request waits for changes, in seconds (between 30 and
+        480 on Dropbox). Changes are notified as soon as they happen regardless.
+    on_change : Callable[[str], None] or None (default: None)
+        Called with the watched folder after each change, e.g. to clear a cache.
+    """
+
+    def __init__(
+        self,
+        dropbox_app,
+        paths: Iterable[str],
+        timeout: int = 120,
+        on_change: Callable[[str], None] | None = None,
+    ):
+        self.storage = as_storage_backend(dropbox_app)
+        self.paths = [path.rstrip("/") for path in paths]
+        self.timeout = timeout
+        self.on_change = on_change
+
+        self._versions = {path: 0 for path in self.paths}
+        self._changed = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self) -> FolderWatcher:
+        """Starts watching the folders in background threads."""
+        if not self._threads:
+            self._threads = [
+                threading.Thread(
+                    target=self._watch,
+                    args=(path,),
+                    name=f"FolderWatcher-{path}",
+                    daemon=True,
+                )
+                for path in self.paths
+            ]
+            for thread in self._threads:
+                thread.start()
+        return self
+
+    def stop(self):
+        """Stops watching the folders. The threads exit after their pending request."""
+        self._stopped.set()
+
+    def _watched_path(self, path: str) -> str | None:
+        path = path.rstrip("/").lower()
+        for watched_path in self.paths:
+            if path == watched_path.lower() or path.startswith(
+                f"{watched_path.lower()}/"
+            ):
+                return watched_path
+        return None
+
+    def is_watching(self, path: str) -> bool:
+        """Whether the folder, or one of the folders it is in, is watched."""
+        return self._watched_path(path) is not None
+
+    def version(self, path: str) -> int | None:
+        """The number of changes notified in the watched folder that contains `path`,
+        or None if it is not watched."""
+        watched_path = self._watched_path(path)
+        if watched_path is None:
+            return None
+        with self._changed:
+            return self._versions[watched_path]
+
+    def wait_for_change(self, path: str, version: int, timeout: float = None) -> bool:
+        """Waits until the version of the folder is greater than `version`, or until
+        the timeout. Returns whether it changed."""
+        watched_path = self._watched_path(path)
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self._versions[watched_path] > version, timeout
+            )
+
+    def _notify(self, path: str):
+        with self._changed:
+            self._versions[path] += 1
+            self._changed.notify_all()
+        if self.on_change is not None:
+            self.on_change(path)
+
+    def _watch(self, path: str):
+        cursor = None
+        retries = 0
+
+        while not self._stopped.is_set():
+            try:
+                if cursor is None:
+                    cursor = self.storage.get_latest_cursor(path, recursive=True)
+                    if retries > 0:
+                        # changes may have been missed while reconnecting
+                        self._notify(path)
+                    retries = 0
+
+                has_changed, backoff = self.storage.wait_for_changes(
+                    cursor, self.timeout
+                )
+                if has_changed:
+                    # take the new cursor before notifying: later changes are
+                    # notified again, earlier ones are seen by whoever reloads
+                    cursor = self.storage.get_latest_cursor(path, recursive=True)
+                    self._notify(path)
+                if backoff:
+                    self._stopped.wait(backoff)
+
+            except Exception:
+                # e.g. a dropped connection or an expired cursor: start over
+                cursor = None
+                retries += 1
+                self._stopped.wait(random.uniform(0, min(60, 2**retries)))
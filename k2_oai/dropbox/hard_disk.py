@@ -1,22 +1,284 @@
 """
 Function(s) to load data from the hard disk to the Dropbox "database".
+
+The photos of a local folder are ingested in a photos folder of
+`DROPBOX_RAW_PHOTOS_ROOT` in three steps:
+
+1. The manifest lists the local photos with their size and Dropbox content hash (see
+   `build_ingest_manifest`). Hashes are reused from the previous manifest of the
+   folder for the photos whose size and modification time did not change.
+2. The photos already on Dropbox with the same content hash, as listed by Dropbox, are
+   skipped. The photos with the name of another photo on Dropbox, whatever the case,
+   are reported as conflicts, and not uploaded. A progress file records the photos of
+   each committed batch: if the ingest stops midway, the next one reports the photos
+   that Dropbox confirms as uploaded, and uploads the others again. It is deleted when
+   the ingest completes.
+3. The other photos are uploaded in batches of upload sessions (see
+   `StorageBackend.upload_many`), several batches at once. Finally, the index of the
+   folder, `index-{photos_folder}.csv`, is written to `DROPBOX_RAW_PHOTOS_ROOT` (see
+   `dbx_load_photo_list`).
+
+The manifest and the progress file are kept in `INGEST_DIR`.
 """
 
+from __future__ import annotations
+
 import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+from dropbox.exceptions import ApiError
+from pandas import DataFrame
+
+from k2_oai.dropbox import (
+    DROPBOX_CACHE_DIR,
+    DROPBOX_MAX_WORKERS,
+    DROPBOX_RAW_PHOTOS_ROOT,
+    as_storage_backend,
+    dropbox_content_hash,
+    dropbox_listdir,
+    dropbox_map_concurrently,
+)
 
-from k2_oai.dropbox import dropbox_upload_file_to
+__all__ = [
+    "INGEST_DIR",
+    "INGEST_BATCH_SIZE",
+    "INGEST_BATCH_BYTES",
+    "build_ingest_manifest",
+    "ingest_photos",
+    "upload_hard_disk_data",
+]
 
 _HARD_DISK_PATH = "/Volumes/Elements/Big_Size_Images_2"
 
+INGEST_DIR = os.path.join(DROPBOX_CACHE_DIR, "ingest")
+# the maximum number of photos and of bytes uploaded in each batch
+INGEST_BATCH_SIZE = 100
+INGEST_BATCH_BYTES = 64 * 1024 * 1024
+
+_MANIFEST_COLUMNS = ["item_name", "local_path", "item_size", "mtime_ns"]
+_INDEX_COLUMNS = ["item_name", "item_content_hash", "item_size"]
+
+
+def _is_photo(entry: os.DirEntry) -> bool:
+    # e.g. `Thumbs.db` and `.DS_Store` are not photos
+    return (
+        entry.is_file()
+        and not entry.name.startswith(".")
+        and "Thumbs" not in entry.name
+    )
+
+
+def build_ingest_manifest(
+    local_dir: str,
+    previous_manifest: DataFrame | None = None,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+) -> DataFrame:
+    """Lists the photos in a local folder, with their size and Dropbox content hash.
+
+    Parameters
+    ----------
+    local_dir : str
+        The local folder of the photos. Subfolders are ignored.
+    previous_manifest : DataFrame or None (default: None)
+        The manifest of a previous ingest of the folder: the hashes of the photos
+        whose size and modification time did not change are not computed again.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The number of photos hashed concurrently.
+
+    Returns
+    -------
+    DataFrame
+        The photos, sorted by `item_name`, with their `local_path`, `item_size`,
+        `mtime_ns` and `item_content_hash`.
+    """
+    photos = []
+    for entry in os.scandir(local_dir):
+        if _is_photo(entry):
+            stat = entry.stat()
+            photos.append((entry.name, entry.path, stat.st_size, stat.st_mtime_ns))
+
+    manifest = pd.DataFrame.from_records(photos, columns=_MANIFEST_COLUMNS)
+    manifest = manifest.sort_values("item_name", ignore_index=True)
+
+    if previous_manifest is not None and not previous_manifest.empty:
+        manifest = manifest.merge(
+            previous_manifest[
+                ["item_name", "item_size", "mtime_ns", "item_content_hash"]
+            ],
+            on=["item_name", "item_size", "mtime_ns"],
+            how="left",
+        )
+    else:
+        manifest["item_content_hash"] = None
+
+    to_hash = manifest.item_content_hash.isna()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        manifest.loc[to_hash, "item_content_hash"] = list(
+            executor.map(dropbox_content_hash, manifest.loc[to_hash, "local_path"])
+        )
+
+    return manifest
+
+
+def _remote_photos(dropbox_app, dropbox_path: str) -> DataFrame:
+    try:
+        contents = dropbox_listdir(dropbox_path, dropbox_app)
+    except (ApiError, FileNotFoundError):
+        # the photos folder does not exist yet
+        return pd.DataFrame(columns=_INDEX_COLUMNS)
+
+    if contents.empty:
+        return pd.DataFrame(columns=_INDEX_COLUMNS)
+    return contents.loc[contents.item_type == "file", _INDEX_COLUMNS]
+
+
+def _load_progress(progress_file: str) -> DataFrame:
+    try:
+        return pd.read_csv(progress_file, names=["item_name", "item_content_hash"])
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return pd.DataFrame(columns=["item_name", "item_content_hash"])
+
+
+def _photo_keys(photos: DataFrame) -> pd.MultiIndex:
+    # Dropbox paths are case-insensitive: `A.png` and `a.png` are the same photo
+    return pd.MultiIndex.from_arrays(
+        [photos.item_name.str.lower(), photos.item_content_hash]
+    )
+
+
+def _batches(photos: DataFrame, batch_size: int, batch_bytes: int):
+    batch, size = [], 0
+    for photo in photos.itertuples(index=False):
+        if batch and (len(batch) == batch_size or size + photo.item_size > batch_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(photo)
+        size += photo.item_size
+    if batch:
+        yield batch
+
+
+def ingest_photos(
+    dropbox_app,
+    local_dir: str,
+    photos_folder: str,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+    batch_size: int = INGEST_BATCH_SIZE,
+    batch_bytes: int = INGEST_BATCH_BYTES,
+    ingest_dir: str = INGEST_DIR,
+) -> DataFrame:
+    """Uploads the photos of a local folder to a photos folder on Dropbox, skipping
+    the photos that are already there, and writes the index of the folder.
+
+    If the ingest stops, e.g. because of a crash or of an error that is not transient,
+    running it again resumes it: only the photos that were not uploaded are uploaded.
+
+    Parameters
+    ----------
+    dropbox_app : Dropbox or StorageBackend
+        The Dropbox app instance. Local backends only recognize the photos already
+        there if they hash their contents (see `LocalBackend`).
+    local_dir : str
+        The local folder of the photos, e.g. on a hard disk.
+    photos_folder : str
+        The name of the photos folder, in `DROPBOX_RAW_PHOTOS_ROOT`.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The number of batches uploaded concurrently.
+    batch_size : int (default: INGEST_BATCH_SIZE)
+        The maximum number of photos in each batch, at most 1000.
+    batch_bytes : int (default: INGEST_BATCH_BYTES)
+        The maximum size of each batch, in bytes. A larger photo has its own batch.
+    ingest_dir : str (default: INGEST_DIR)
+        The local folder of the manifests and of the progress files.
+
+    Returns
+    -------
+    DataFrame
+        The manifest, with the `status` of each photo: "skipped" if it was already on
+        Dropbox, "uploaded" (also by a previous ingest that stopped), "failed", or
+        "conflict" if another photo with the same name is on Dropbox. Failed photos
+        are uploaded by the next ingest; conflicts are never overwritten, and must be
+        renamed or removed by hand.
+    """
+    storage = as_storage_backend(dropbox_app)
+    dropbox_path = f"{DROPBOX_RAW_PHOTOS_ROOT}/{photos_folder}"
+
+    os.makedirs(ingest_dir, exist_ok=True)
+    manifest_file = os.path.join(ingest_dir, f"{photos_folder}-manifest.csv")
+    progress_file = os.path.join(ingest_dir, f"{photos_folder}-uploaded.csv")
+
+    previous_manifest = (
+        pd.read_csv(manifest_file) if os.path.exists(manifest_file) else None
+    )
+    manifest = build_ingest_manifest(local_dir, previous_manifest, max_workers)
+    manifest.to_csv(manifest_file, index=False)
+
+    # the listing is authoritative: photos with the same name and content hash are
+    # already ingested, whatever the progress file says
+    remote_photos = _remote_photos(storage, dropbox_path)
+    photo_keys = _photo_keys(manifest)
+    is_ingested = photo_keys.isin(_photo_keys(remote_photos))
+    # photos with the same name and another content are not overwritten
+    is_conflict = ~is_ingested & manifest.item_name.str.lower().isin(
+        remote_photos.item_name.str.lower()
+    )
+    # the photos uploaded by a previous ingest that stopped midway, if Dropbox has them
+    is_resumed = is_ingested & photo_keys.isin(
+        _photo_keys(_load_progress(progress_file))
+    )
+
+    manifest["status"] = "skipped"
+    manifest.loc[is_resumed, "status"] = "uploaded"
+    manifest.loc[~is_ingested, "status"] = "failed"
+    manifest.loc[is_conflict, "status"] = "conflict"
+    uploaded = []
+
+    def upload_batch(batch):
+        files = []
+        for photo in batch:
+            with open(photo.local_path, "rb") as photo_file:
+                files.append((photo_file.read(), f"{dropbox_path}/{photo.item_name}"))
+        # same-content photos are no conflict: retried batches do not fail
+        return storage.upload_many(files, overwrite=False)
+
+    batches = _batches(
+        manifest.loc[manifest.status == "failed"], batch_size, batch_bytes
+    )
+    with open(progress_file, "a") as progress:
+        for batch, results in dropbox_map_concurrently(
+            upload_batch, batches, max_workers
+        ):
+            for photo, result in zip(batch, results):
+                if result is not None:
+                    progress.write(f"{photo.item_name},{result.content_hash}\n")
+                    uploaded.append((photo.item_name, result.content_hash, result.size))
+            progress.flush()
+
+    uploaded = pd.DataFrame.from_records(uploaded, columns=_INDEX_COLUMNS)
+    manifest.loc[manifest.item_name.isin(uploaded.item_name), "status"] = "uploaded"
+
+    index = (
+        pd.concat([remote_photos, uploaded])
+        .drop_duplicates("item_name", keep="last")
+        .sort_values("item_name", ignore_index=True)
+    )
+    with BytesIO() as buffer:
+        index.to_csv(buffer, index=False)
+        storage.upload(
+            buffer.getvalue(), f"{DROPBOX_RAW_PHOTOS_ROOT}/index-{photos_folder}.csv"
+        )
+
+    # the next ingest starts from the listing
+    os.remove(progress_file)
+
+    return manifest
+
 
-def upload_hard_disk_data(dropbox_app, hard_disk_path=None):
+def upload_hard_disk_data(dropbox_app, hard_disk_path=None, *, photos_folder):
+    """Ingests all the photos of the hard disk into `photos_folder` (see
+    `ingest_photos`), and returns the manifest: e.g. `manifest.status.value_counts()`
+    summarizes the ingest."""
     hd_path = hard_disk_path or _HARD_DISK_PATH
-    photo_list = os.listdir(hd_path)
-    for photo in photo_list[5000:10000]:
-        if "Thumbs" not in photo:
-            print(photo)
-            dropbox_upload_file_to(
-                dropbox_app,
-                os.path.join(hd_path, photo),
-                f"/k2/raw_photos/large_photos-5K_10K/{photo}",
-            )
+    return ingest_photos(dropbox_app, hd_path, photos_folder)
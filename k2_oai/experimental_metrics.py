@@ -8,7 +8,12 @@ import numpy as np
 from matplotlib import pyplot as plt
 from numpy import ndarray
 
-from k2_oai.utils import _compute_rotation_matrix, experimental_parse_str_as_array
+from k2_oai.utils import (
+    compute_crop_transform,
+    split_polygons,
+    stack_polygons,
+    transform_polygons_to_crop,
+)
 
 
 def surface_absolute_error(
@@ -16,48 +21,30 @@ def surface_absolute_error(
     roof_coordinates: str | ndarray,
     obstacle_coordinates: str | ndarray | list[str] | list[ndarray],
     label_coord: ndarray,
+    roof_geometry=None,
 ):
     # TODO: add docstring
     """ """
 
-    if isinstance(roof_coordinates, (str, ndarray)):
-        roof_coordinates: ndarray = experimental_parse_str_as_array(
-            roof_coordinates, sort_coordinates=True
-        )
-    else:
+    if not isinstance(roof_coordinates, (str, ndarray)):
         raise TypeError(
             f"Expected a string or a numpy array, but got {type(roof_coordinates)}"
         )
 
-    _, rotation_matrix = _compute_rotation_matrix(roof_coordinates)
-
-    black_background = np.zeros(input_image.shape, np.uint8)
-
-    if isinstance(obstacle_coordinates, list):
-        obstacle_list: list[ndarray] = [
-            experimental_parse_str_as_array(coordinates, sort_coordinates=True)
-            for coordinates in obstacle_coordinates
-        ]
-    elif isinstance(obstacle_coordinates, (str, ndarray)):
-        obstacle_list: list[ndarray] = [
-            experimental_parse_str_as_array(obstacle_coordinates, sort_coordinates=True)
-        ]
-    else:
+    if not isinstance(obstacle_coordinates, (list, str, ndarray)):
         raise TypeError(
             f"Expected a string or a numpy array, but got {type(obstacle_coordinates)}"
         )
 
-    for obstacle in obstacle_list:
-        pts = []
-        for obstacle_coordinate in obstacle:
-            obstacle_coordinate.append(1)
-            coord_ext = np.array(obstacle_coordinate)
-            pts_rot = np.matmul(rotation_matrix, coord_ext)
-
-            pts.append(pts_rot.tolist())
+    transform, crop_size = compute_crop_transform(roof_coordinates, roof_geometry)
+    vertices, offsets = stack_polygons(obstacle_coordinates)
+    cropped_vertices = transform_polygons_to_crop(
+        vertices, offsets, transform, crop_size
+    )
 
-        pts_ar = np.subtract(np.array(pts), np.array(roof_coordinates[0])).astype(int)
-        im_draw = cv.fillConvexPoly(black_background, pts_ar, (255, 255, 255), 1)
+    im_draw = np.zeros(input_image.shape, np.uint8)
+    for obstacle in split_polygons(cropped_vertices, offsets):
+        im_draw = cv.fillConvexPoly(im_draw, obstacle, (255, 255, 255), 1)
 
     im_result = np.zeros(input_image.shape, np.uint8)
     for label in label_coord:
@@ -0,0 +1,226 @@
+"""
+Predicts the hyperparameters of the obstacle detection pipeline from cheap features of
+the cropped roof, i.e. its masked greyscale histogram, the variance of the histogram
+and the size of the roof.
+
+The predictor is a k-nearest neighbours model trained offline on the hyperparameters
+annotations (either written by hand in the dashboard or by the automatic tuner in
+`k2_oai.hyperparameter_tuning`). Predicting a single roof takes microseconds, so it can
+be used to pre-fill the dashboard and as default for batch runs.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+import cv2 as cv
+import numpy as np
+from numpy import ndarray
+from pandas import DataFrame
+
+__all__ = [
+    "DEFAULT_HYPERPARAMETERS",
+    "compute_roof_features",
+    "HyperparametersPredictor",
+]
+
+# the hyperparameters used when no predictor was trained yet, with the same keys of the
+# hyperparameters annotations
+DEFAULT_HYPERPARAMETERS = {
+    "sigma": 1,
+    "filtering_method": "Bilateral",
+    "binarization_method": "Simple",
+    "blocksize": None,
+    "tolerance": None,
+}
+
+_HISTOGRAM_BINS = 16
+
+
+def compute_roof_features(roof: ndarray) -> ndarray:
+    """Computes the features used to predict the hyperparameters of a roof.
+
+    Parameters
+    ----------
+    roof : ndarray
+        The cropped roof (BGRA), as returned by `rotate_and_crop_roof`.
+
+    Returns
+    -------
+    ndarray
+        The normalized histogram of the roof's first channel (masked by the alpha
+        channel) in 16 bins, then the log-variance of the full histogram, the log-size
+        of the roof and its aspect ratio. The roof must be cropped from the full-size
+        photo: a photo decoded at a reduced scale has a narrower histogram.
+    """
+    histogram = cv.calcHist([roof], [0], roof[:, :, 3], [256], [0, 256]).ravel()
+    roof_size = histogram.sum()
+
+    coarse_histogram = (histogram / max(roof_size, 1)).reshape(_HISTOGRAM_BINS, -1)
+
+    return np.concatenate(
+        [
+            coarse_histogram.sum(axis=1),
+            [
+                np.log1p(np.var(histogram)),
+                np.log1p(roof_size),
+                roof.shape[0] / max(roof.shape[1], 1),
+            ],
+        ]
+    ).astype(np.float32)
+
+
+def _most_common(codes: ndarray) -> int:
+    return int(np.argmax(np.bincount(codes)))
+
+
+def _closest_odd_integer(value: float) -> int:
+    return max(int(value) // 2 * 2 + 1, 1)
+
+
+class HyperparametersPredictor:
+    """K-nearest neighbours model that suggests the hyperparameters of a roof.
+
+    Parameters
+    ----------
+    n_neighbors : int (default: 5)
+        The number of neighbours used for the prediction.
+    """
+
+    def __init__(self, n_neighbors: int = 5):
+        if n_neighbors < 1:
+            raise ValueError("`n_neighbors` must be a positive integer.")
+        self.n_neighbors = n_neighbors
+
+    def fit(
+        self, features: ndarray, annotations: DataFrame
+    ) -> HyperparametersPredictor:
+        """Fits the model.
+
+        Parameters
+        ----------
+        features : ndarray
+            The features of the annotated roofs, one row per roof, as returned by
+            `compute_roof_features`.
+        annotations : DataFrame
+            The hyperparameters annotations, in the same order of `features`.
+
+        Returns
+        -------
+        HyperparametersPredictor
+            The fitted model.
+        """
+        if len(features) != len(annotations) or len(features) == 0:
+            raise ValueError(
+                "Features and annotations must have the same, non-zero length"
+            )
+
+        self._mean = features.mean(axis=0)
+        self._scale = np.where(features.std(axis=0) > 0, features.std(axis=0), 1.0)
+        self._features = ((features - self._mean) / self._scale).astype(np.float32)
+
+        self._sigma = annotations.sigma.to_numpy(dtype=np.float32)
+        # categorical hyperparameters are stored as integer codes
+        self._filtering_methods, self._filtering_method = np.unique(
+            annotations.filtering_method.to_numpy(dtype=str), return_inverse=True
+        )
+        self._binarization_methods, self._binarization_method = np.unique(
+            annotations.binarization_method.to_numpy(dtype=str), return_inverse=True
+        )
+        self._blocksize = annotations.blocksize.fillna(-1).to_numpy(dtype=np.float32)
+        self._tolerance = annotations.tolerance.fillna(-1).to_numpy(dtype=np.float32)
+
+        return self
+
+    def predict(self, features: ndarray) -> dict[str, Any]:
+        """Suggests the hyperparameters for a single roof.
+
+        Parameters
+        ----------
+        features : ndarray
+            The features of the roof, as returned by `compute_roof_features`.
+
+        Returns
+        -------
+        dict[str, Any]
+            The hyperparameters, with the same keys and values of the hyperparameters
+            annotations: `sigma`, `filtering_method`, `binarization_method`,
+            `blocksize` and `tolerance`.
+        """
+        query = (features - self._mean) / self._scale
+        distances = np.square(self._features - query).sum(axis=1)
+
+        k = min(self.n_neighbors, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+
+        binarization_code = _most_common(self._binarization_method[nearest])
+        binarization_method = str(self._binarization_methods[binarization_code])
+        filtering_code = _most_common(self._filtering_method[nearest])
+
+        # the closest neighbour with the same binarization method
+        closest = nearest[self._binarization_method[nearest] == binarization_code][0]
+
+        return {
+            "sigma": _closest_odd_integer(np.median(self._sigma[nearest])),
+            "filtering_method": str(self._filtering_methods[filtering_code]),
+            "binarization_method": binarization_method,
+            "blocksize": int(self._blocksize[closest])
+            if binarization_method == "Adaptive"
+            else None,
+            "tolerance": int(self._tolerance[closest])
+            if binarization_method == "Composite"
+            else None,
+        }
+
+    def save(self, file):
+        """Saves the model as a `.npz` file.
+
+        Parameters
+        ----------
+        file : str or file-like
+            The file to save the model to.
+        """
+        np.savez(
+            file,
+            n_neighbors=self.n_neighbors,
+            mean=self._mean,
+            scale=self._scale,
+            features=self._features,
+            sigma=self._sigma,
+            filtering_methods=self._filtering_methods,
+            filtering_method=self._filtering_method,
+            binarization_methods=self._binarization_methods,
+            binarization_method=self._binarization_method,
+            blocksize=self._blocksize,
+            tolerance=self._tolerance,
+        )
+
+    @classmethod
+    def load(cls, file) -> HyperparametersPredictor:
+        """Loads a model saved with `save`.
+
+        Parameters
+        ----------
+        file : str or file-like
+            The `.npz` file to load the model from.
+
+        Returns
+        -------
+        HyperparametersPredictor
+            The fitted model.
+        """
+        with np.load(file) as arrays:
+            predictor = cls(int(arrays["n_neighbors"]))
+            predictor._mean = arrays["mean"]
+            predictor._scale = arrays["scale"]
+            predictor._features = arrays["features"]
+            predictor._sigma = arrays["sigma"]
+            predictor._filtering_methods = arrays["filtering_methods"]
+            predictor._filtering_method = arrays["filtering_method"]
+            predictor._binarization_methods = arrays["binarization_methods"]
+            predictor._binarization_method = arrays["binarization_method"]
+            predictor._blocksize = arrays["blocksize"]
+            predictor._tolerance = arrays["tolerance"]
+
+        return predictor
@@ -0,0 +1,303 @@
+"""
+Automatically tunes the hyperparameters of the obstacle detection pipeline, using the
+obstacles labelled in the database as ground truth.
+
+The candidates are ranked with successive halving[1]: all the candidates are scored on
+a small number of roofs, then only the best fraction is scored on more roofs, and so
+on until either a single candidate is left or the budget is exhausted. The budget can
+be expressed as a number of evaluations or as wall-clock time (in seconds).
+
+Tuning can be done per roof (i.e. passing a single roof) or per stratum of roofs,
+e.g. all the roofs with the same zoom level and continent.
+
+The output of the filtering step, which is the most expensive one, is shared among all
+the candidates with the same filtering method and sigma.
+
+References
+----------
+.. [1]
+    Jamieson, K., & Talwalkar, A. (2016). Non-stochastic best arm identification and
+    hyperparameter optimization. https://arxiv.org/abs/1502.07943
+"""
+
+from __future__ import annotations
+
+import itertools
+import math
+import time
+from typing import Any, Sequence
+
+import numpy as np
+from numpy import ndarray
+
+from k2_oai.obstacle_detection import (
+    binarization_step,
+    filtering_step,
+    morphological_opening_step,
+)
+from k2_oai.utils import draw_obstacles_mask_on_cropped_roof, rotate_and_crop_roof
+
+__all__ = [
+    "BINARIZATION_METHODS",
+    "make_candidates",
+    "make_tuning_sample",
+    "score_hyperparameters",
+    "tune_hyperparameters",
+]
+
+# maps the names used in the annotations to the methods of the pipeline's steps
+BINARIZATION_METHODS = {"Simple": "s", "Adaptive": "a", "Composite": "c"}
+
+_DEFAULT_SIGMAS = (1, 3, 5, 7, 11, 15, 21, 31)
+_DEFAULT_FILTERING_METHODS = ("Bilateral", "Gaussian")
+_DEFAULT_BLOCKSIZES = (-1, 11, 31, 51, 101, 201)
+_DEFAULT_TOLERANCES = (-1, 5, 10, 20, 40, 80)
+
+
+def make_candidates(
+    sigmas=_DEFAULT_SIGMAS,
+    filtering_methods=_DEFAULT_FILTERING_METHODS,
+    binarization_methods=tuple(BINARIZATION_METHODS.keys()),
+    blocksizes=_DEFAULT_BLOCKSIZES,
+    tolerances=_DEFAULT_TOLERANCES,
+) -> list[dict[str, Any]]:
+    """Creates the grid of candidate hyperparameters. Each candidate is a dictionary
+    with the same keys as the hyperparameters annotations.
+
+    Parameters
+    ----------
+    sigmas : Iterable[int]
+        Sigma values of the filter. Must be positive, odd integers.
+    filtering_methods : Iterable[str]
+        Filtering methods, i.e. "Bilateral" and/or "Gaussian".
+    binarization_methods : Iterable[str]
+        Binarization methods, i.e. "Simple", "Adaptive" and/or "Composite".
+    blocksizes : Iterable[int]
+        Only used with adaptive binarization. Must be positive, odd integers or -1.
+    tolerances : Iterable[int]
+        Only used with composite binarization. Must be in [0, 255] or -1.
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        The candidates, sorted so that candidates sharing the same filtering step are
+        contiguous.
+    """
+    candidates = []
+
+    for filtering_method, sigma in itertools.product(filtering_methods, sigmas):
+        for binarization_method in binarization_methods:
+            if binarization_method == "Adaptive":
+                options = [(blocksize, None) for blocksize in blocksizes]
+            elif binarization_method == "Composite":
+                options = [(None, tolerance) for tolerance in tolerances]
+            else:
+                options = [(None, None)]
+
+            candidates += [
+                {
+                    "sigma": sigma,
+                    "filtering_method": filtering_method,
+                    "binarization_method": binarization_method,
+                    "blocksize": blocksize,
+                    "tolerance": tolerance,
+                }
+                for blocksize, tolerance in options
+            ]
+
+    return candidates
+
+
+def make_tuning_sample(
+    photo: ndarray,
+    roof_coordinates: str | ndarray,
+    obstacle_coordinates: list[str] | None,
+    roof_geometry=None,
+) -> tuple[ndarray, ndarray]:
+    """Crops the roof out of the photo and rasterizes its labelled obstacles.
+
+    Parameters
+    ----------
+    photo : ndarray
+        The satellite photo (BGR or greyscale).
+    roof_coordinates : str or ndarray
+        The coordinates of the roof in the photo.
+    obstacle_coordinates : list[str] or None
+        The coordinates of the labelled obstacles on the roof.
+    roof_geometry : Mapping or None (default: None)
+        The precomputed geometry of the roof, e.g. a row of the metadata.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The cropped roof (BGRA) and the mask of the labelled obstacles.
+    """
+    cropped_roof = rotate_and_crop_roof(photo, roof_coordinates, roof_geometry)
+    labels_mask = draw_obstacles_mask_on_cropped_roof(
+        cropped_roof, roof_coordinates, obstacle_coordinates, roof_geometry
+    )
+    return cropped_roof, labels_mask
+
+
+def _intersection_over_union(detected, labels, roof_mask) -> float:
+    detected = (detected > 0) & roof_mask
+    labels = (labels > 0) & roof_mask
+
+    union = np.count_nonzero(detected | labels)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(detected & labels) / union
+
+
+def score_hyperparameters(
+    filtered_roof: ndarray,
+    labels_mask: ndarray,
+    candidate: dict[str, Any],
+) -> float:
+    """Scores a candidate on a roof that was already filtered with the candidate's
+    filtering method and sigma, i.e. runs the binarization and morphological opening
+    steps and computes the intersection over union with the labelled obstacles.
+
+    Parameters
+    ----------
+    filtered_roof : ndarray
+        The output of the filtering step (BGRA).
+    labels_mask : ndarray
+        The mask of the labelled obstacles.
+    candidate : dict[str, Any]
+        The hyperparameters to score.
+
+    Returns
+    -------
+    float
+        The intersection over union, in [0, 1]. Higher is better.
+    """
+    binarized_roof = binarization_step(
+        filtered_roof,
+        method=BINARIZATION_METHODS[candidate["binarization_method"]],
+        adaptive_kernel_size=candidate["blocksize"],
+        composite_tolerance=candidate["tolerance"],
+    )
+    blurred_roof = morphological_opening_step(binarized_roof)
+
+    return _intersection_over_union(
+        blurred_roof, labels_mask, filtered_roof[:, :, 3] > 0
+    )
+
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+def tune_hyperparameters(
+    samples: Sequence[tuple[ndarray, ndarray]],
+    candidates: list[dict[str, Any]] | None = None,
+    max_evaluations: int | None = None,
+    time_budget: float | None = None,
+    eta: int = 3,
+    start_time: float | None = None,
+) -> tuple[dict[str, Any], float]:
+    """Finds the best hyperparameters for a roof or a stratum of roofs with successive
+    halving. At every rung, the surviving candidates are scored on `eta` times more
+    roofs than the previous rung, and only the best `1 / eta` of them is kept.
+
+    Parameters
+    ----------
+    samples : Sequence[tuple[ndarray, ndarray]]
+        The roofs to tune the hyperparameters on, as returned by `make_tuning_sample`.
+        Pass a single sample to tune the hyperparameters of a single roof. The samples
+        are accessed in order, each rung reaching further: a lazy sequence can load
+        them on demand, so that the roofs beyond the last rung are never loaded.
+    candidates : list[dict[str, Any]] or None (default: None)
+        The candidates to choose from. If None, uses `make_candidates()`.
+    max_evaluations : int or None (default: None)
+        The maximum number of (candidate, roof) evaluations. If None, there is no limit.
+    time_budget : float or None (default: None)
+        The maximum wall-clock time, in seconds. If None, there is no limit.
+    eta : int (default: 3)
+        The reduction factor of successive halving. Must be greater than 1.
+    start_time : float or None (default: None)
+        The `time.monotonic()` at which the time budget started, e.g. before loading
+        the samples. If None, it starts now.
+
+    Returns
+    -------
+    tuple[dict[str, Any], float]
+        The best candidate and its mean score on the roofs it was evaluated on.
+    """
+    if not samples:
+        raise ValueError("At least one sample is required to tune hyperparameters.")
+    if eta < 2:
+        raise ValueError("`eta` must be an integer greater than 1.")
+
+    candidates = candidates or make_candidates()
+    if start_time is None:
+        start_time = time.monotonic()
+    deadline = None if time_budget is None else start_time + time_budget
+    evaluations = 0
+
+    # scores[candidate index][sample index]
+    scores: list[dict[int, float]] = [{} for _ in candidates]
+
+    def _evaluate(candidate_ids, sample_ids):
+        nonlocal evaluations
+
+        for sample_id in sample_ids:
+            roof, labels_mask = samples[sample_id]
+            # reuse the filtering step across candidates: they are sorted by filter
+            filtered_roofs = {}
+
+            for candidate_id in candidate_ids:
+                if sample_id in scores[candidate_id]:
+                    continue
+                if max_evaluations is not None and evaluations >= max_evaluations:
+                    raise _BudgetExhausted
+                if deadline is not None and time.monotonic() > deadline:
+                    raise _BudgetExhausted
+
+                candidate = candidates[candidate_id]
+                filter_key = (candidate["filtering_method"], candidate["sigma"])
+                if filter_key not in filtered_roofs:
+                    filtered_roofs[filter_key] = filtering_step(
+                        roof.copy(),
+                        sigma=candidate["sigma"],
+                        method=candidate["filtering_method"].lower(),
+                    )
+
+                scores[candidate_id][sample_id] = score_hyperparameters(
+                    filtered_roofs[filter_key], labels_mask, candidate
+                )
+                evaluations += 1
+
+    survivors = list(range(len(candidates)))
+    num_samples = 1
+
+    try:
+        while True:
+            _evaluate(survivors, range(num_samples))
+
+            if len(survivors) == 1 or num_samples == len(samples):
+                break
+
+            survivors = sorted(
+                survivors,
+                key=lambda c: np.mean([scores[c][s] for s in range(num_samples)]),
+                reverse=True,
+            )[: math.ceil(len(survivors) / eta)]
+            # keep survivors sorted by filter, to reuse the filtering step
+            survivors.sort()
+            num_samples = min(num_samples * eta, len(samples))
+    except _BudgetExhausted:
+        pass
+
+    evaluated = [c for c in range(len(candidates)) if scores[c]]
+    if not evaluated:
+        raise ValueError("The budget does not allow to evaluate any candidate.")
+
+    # prefer the candidates that were evaluated on most roofs, then the best scores
+    best = max(
+        evaluated,
+        key=lambda c: (len(scores[c]), np.mean(list(scores[c].values()))),
+    )
+
+    return candidates[best], float(np.mean(list(scores[best].values())))
@@ -5,8 +5,20 @@ modules, e.g. crop the roof out of the satellite image and detect the obstacles
 
 from __future__ import annotations
 
+from typing import Any, Iterable, Iterator
+
+from dropbox.exceptions import ApiError
 from numpy.core.multiarray import ndarray
 
+from k2_oai.data.catalog import PhotoCatalog
+from k2_oai.data.load import dbx_load_hyperparameters_predictor, dbx_load_photos
+from k2_oai.data.store import MetadataStore
+from k2_oai.dropbox import DROPBOX_MAX_WORKERS
+from k2_oai.hyperparameter_prediction import (
+    DEFAULT_HYPERPARAMETERS,
+    compute_roof_features,
+)
+from k2_oai.hyperparameter_tuning import BINARIZATION_METHODS
 from k2_oai.obstacle_detection import (
     binarization_step,
     detect_obstacles,
@@ -15,15 +27,18 @@ from k2_oai.obstacle_detection import (
 )
 from k2_oai.utils import rotate_and_crop_roof
 
-__all__ = ["obstacle_detection_pipeline"]
+__all__ = [
+    "obstacle_detection_pipeline",
+    "dbx_obstacle_detection_pipeline",
+]
 
 
 def obstacle_detection_pipeline(
     satellite_image: ndarray,
     roof_px_coordinates: str | ndarray,
-    filtering_sigma: int,
-    filter_method: str = "b",
-    binarization_method: str = "s",
+    filtering_sigma: int | None = None,
+    filter_method: str | None = None,
+    binarization_method: str | None = None,
     binarization_kernel: int | None = None,
     binarization_tolerance: int | None = None,
     binarization_constant: int = 0,
@@ -31,6 +46,8 @@ def obstacle_detection_pipeline(
     obstacle_minimum_area: int | None = 0,
     obstacle_boundary_type: str = "box",
     trim_edges: bool = False,
+    hyperparameters_predictor=None,
+    roof_geometry=None,
 ):
     """Takes in a greyscale image of a roof and returns the same image, coloured (BGR),
     where obstacles have been tagged.
@@ -42,17 +59,21 @@ def obstacle_detection_pipeline(
     roof_px_coordinates : str or ndarray
         The coordinates of the roof in the satellite image. If it's string, then is
         parsed as ndarray.
-    filtering_sigma : int
-        The sigma value of the filter. It must be a positive, odd integer.
-    filter_method : { "b", "bilateral", "g", "gaussian" }, default: "b".
+    filtering_sigma : int or None, default: None.
+        The sigma value of the filter. It must be a positive, odd integer. If None,
+        it is predicted with `hyperparameters_predictor` or defaults to the one in
+        `DEFAULT_HYPERPARAMETERS`.
+    filter_method : { "b", "bilateral", "g", "gaussian" } or None, default: None.
         The type of filter to apply as first step of the pipeline. Can either be
-        "bilateral" (equivalent to "b", default) or "gaussian" (equivalent to "g").
-    binarization_method : { "s", "simple", "a", "adaptive", "c", "composite" },
-        (default: "s").
+        "bilateral" (equivalent to "b") or "gaussian" (equivalent to "g"). If None,
+        it is predicted with `hyperparameters_predictor` or defaults to "b".
+    binarization_method : { "s", "simple", "a", "adaptive", "c", "composite" }
+        or None, (default: None).
         The method to use for binarization. Can be either:
         - "s" or "simple"
         - "a" or "adaptive"
         - "c" or "composite"
+        If None, it is predicted with `hyperparameters_predictor` or defaults to "s".
     binarization_kernel : int or None, default: None.
         Only used in adaptive thresholding. The size of the kernel for binarization.
         Must be a positive, odd number. If None, then defaults to 0,001 times the size
@@ -76,6 +97,12 @@ def obstacle_detection_pipeline(
         (height or width), divided by 10 and then rounded up.
     trim_edges : bool, default: False
         Whether to pad the image to remove edges. Defaults to False.
+    hyperparameters_predictor : HyperparametersPredictor or None, default: None.
+        If not None, it is used to predict the hyperparameters of the filtering and
+        binarization steps that are left to None.
+    roof_geometry : Mapping or None, default: None.
+        The precomputed geometry of the roof, e.g. a row of the metadata. If None, it
+        is computed from `roof_px_coordinates`.
 
     Returns
     -------
@@ -86,15 +113,32 @@ def obstacle_detection_pipeline(
     """
 
     # crop the roof from the image using the coordinates
-    cropped_roof: ndarray = rotate_and_crop_roof(satellite_image, roof_px_coordinates)
+    cropped_roof: ndarray = rotate_and_crop_roof(
+        satellite_image, roof_px_coordinates, roof_geometry
+    )
+
+    # fill the missing hyperparameters with the predicted ones
+    if hyperparameters_predictor is not None:
+        predicted = hyperparameters_predictor.predict(
+            compute_roof_features(cropped_roof)
+        )
+        filtering_sigma = filtering_sigma or predicted["sigma"]
+        filter_method = filter_method or predicted["filtering_method"].lower()
+        if binarization_method is None:
+            binarization_method = BINARIZATION_METHODS[predicted["binarization_method"]]
+            binarization_kernel = binarization_kernel or predicted["blocksize"]
+            binarization_tolerance = binarization_tolerance or predicted["tolerance"]
+
+    if filtering_sigma is None:
+        filtering_sigma = DEFAULT_HYPERPARAMETERS["sigma"]
 
     # filtering steps
     filtered_roof: ndarray = filtering_step(
-        input_image=cropped_roof, sigma=filtering_sigma, method=filter_method
+        input_image=cropped_roof, sigma=filtering_sigma, method=filter_method or "b"
     )
     binarized_roof: ndarray = binarization_step(
         filtered_roof,
-        method=binarization_method,
+        method=binarization_method or "s",
         adaptive_kernel_size=binarization_kernel,
         adaptive_constant=binarization_constant,
         composite_tolerance=binarization_tolerance,
@@ -117,3 +161,79 @@ def obstacle_detection_pipeline(
         min_area=obstacle_minimum_area,
         padding_percentage=padding,
     )
+
+
+def dbx_obstacle_detection_pipeline(
+    roof_ids: Iterable,
+    metadata: MetadataStore,
+    dropbox_folder: str,
+    dropbox_app,
+    hyperparameters_predictor="auto",
+    catalog: PhotoCatalog | None = None,
+    max_workers: int = DROPBOX_MAX_WORKERS,
+    **pipeline_kwargs: Any,
+) -> Iterator[tuple[Any, list]]:
+    """Detects the obstacles on many roofs, loading their photos from Dropbox
+    concurrently (see `dbx_load_photos`). Each photo is loaded once, also if it has
+    many of the roofs.
+
+    Parameters
+    ----------
+    roof_ids : Iterable
+        The roofs to detect the obstacles on.
+    metadata : MetadataStore
+        The metadata of the roofs.
+    dropbox_folder : str
+        The Dropbox folder of the photos.
+    dropbox_app : Dropbox
+        The Dropbox app instance.
+    hyperparameters_predictor : HyperparametersPredictor, "auto" or None
+        (default: "auto").
+        Predicts the hyperparameters that are not in `pipeline_kwargs` (see
+        `obstacle_detection_pipeline`). If "auto", it is loaded once with
+        `dbx_load_hyperparameters_predictor`; if None, or if no predictor was trained
+        yet, the hyperparameters default to `DEFAULT_HYPERPARAMETERS`.
+    catalog : PhotoCatalog or None (default: None)
+        If not None, loads the canonical copy of each photo.
+    max_workers : int (default: DROPBOX_MAX_WORKERS)
+        The maximum number of photos downloaded and decoded at the same time.
+    **pipeline_kwargs
+        The other parameters of `obstacle_detection_pipeline`, e.g.
+        `obstacle_boundary_type`.
+
+    Yields
+    ------
+    tuple[Any, list]
+        Each roof and the coordinates of the obstacles detected on it, as returned by
+        `obstacle_detection_pipeline`, in the order the photos are loaded: e.g. to
+        export them with `stack_detected_obstacles`.
+    """
+    if hyperparameters_predictor == "auto":
+        try:
+            hyperparameters_predictor = dbx_load_hyperparameters_predictor(dropbox_app)
+        except ApiError:
+            # no predictor was trained yet
+            hyperparameters_predictor = None
+
+    roofs_by_photo: dict[str, list] = {}
+    for roof_id in roof_ids:
+        photo_path = f"{dropbox_folder}/{metadata.get_image_url(roof_id)}"
+        roofs_by_photo.setdefault(photo_path, []).append(roof_id)
+
+    for photo_path, photo in dbx_load_photos(
+        roofs_by_photo,
+        dropbox_app,
+        bgr_only=True,
+        catalog=catalog,
+        max_workers=max_workers,
+    ):
+        for roof_id in roofs_by_photo[photo_path]:
+            roof_px_coordinates, _ = metadata.get_coordinates(roof_id)
+            *_, obstacles_coordinates = obstacle_detection_pipeline(
+                photo,
+                roof_px_coordinates,
+                hyperparameters_predictor=hyperparameters_predictor,
+                roof_geometry=metadata.get_geometry(roof_id),
+                **pipeline_kwargs,
+            )
+            yield roof_id, obstacles_coordinates
@@ -0,0 +1,380 @@
+"""
+Vectorized geometry of roofs and obstacles, e.g. maps the pixel coordinates of the
+obstacles in the satellite photo into the coordinates of the rotated and cropped roof.
+
+Sets of polygons are stored as ragged arrays: all the vertices are stacked in a single
+(N, 2) array, and an array of M + 1 offsets delimits the M polygons, i.e. the vertices
+of the i-th polygon are `vertices[offsets[i] : offsets[i + 1]]`.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from numpy import ndarray
+
+from k2_oai.utils._parsers import parse_str_as_coordinates
+
+__all__ = [
+    "ROOF_GEOMETRY_COLUMNS",
+    "stack_polygons",
+    "split_polygons",
+    "take_polygons",
+    "compute_roofs_geometry",
+    "compute_ragged_roofs_geometry",
+    "crop_transforms_from_geometry",
+    "invert_affine_transforms",
+    "scale_coordinates",
+    "compute_crop_transform",
+    "transform_polygons_to_crop",
+]
+
+# the geometry of the crop of each roof:
+# - the angle (degrees) the photo is rotated by, around the crop origin;
+# - the origin of the crop (top-left corner) in the photo;
+# - the size of the crop;
+# - the number of vertices of the roof: only roofs with 4 vertices are rotated.
+ROOF_GEOMETRY_COLUMNS = {
+    "roof_rotation_angle": "float64",
+    "roof_crop_x": "int32",
+    "roof_crop_y": "int32",
+    "roof_crop_width": "int32",
+    "roof_crop_height": "int32",
+    "roof_num_vertices": "int32",
+}
+
+
+def stack_polygons(polygons: str | ndarray | list) -> tuple[ndarray, ndarray]:
+    """Stacks polygons into a ragged array.
+
+    Parameters
+    ----------
+    polygons : str or ndarray or list[str] or list[ndarray]
+        The polygons, either as strings of coordinates or as arrays of shape (n, 2).
+        A single string or array is treated as a single polygon.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The (N, 2) array of vertices (int32) and the (M + 1) array of offsets.
+    """
+    if isinstance(polygons, (str, ndarray)):
+        polygons = [polygons]
+
+    arrays = [
+        parse_str_as_coordinates(polygon).reshape(-1, 2)
+        if isinstance(polygon, str)
+        else np.asarray(polygon).reshape(-1, 2)
+        for polygon in polygons
+    ]
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(array) for array in arrays], out=offsets[1:])
+
+    if not arrays:
+        return np.empty((0, 2), dtype=np.int32), offsets
+    return np.concatenate(arrays).astype(np.int32, copy=False), offsets
+
+
+def split_polygons(vertices: ndarray, offsets: ndarray) -> list[ndarray]:
+    """Splits a ragged array into a list of polygons, e.g. to draw them with OpenCV.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) array of vertices.
+    offsets : ndarray
+        The (M + 1) array of offsets.
+
+    Returns
+    -------
+    list[ndarray]
+        The M polygons, as views on `vertices`.
+    """
+    return np.split(vertices, offsets[1:-1])
+
+
+def take_polygons(
+    vertices: ndarray, offsets: ndarray, indices: ndarray
+) -> tuple[ndarray, ndarray]:
+    """Selects some polygons of a ragged array, e.g. to drop the polygons not in use.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) array of vertices.
+    offsets : ndarray
+        The (M + 1) array of offsets.
+    indices : ndarray
+        The indices of the polygons to select.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The vertices and the offsets of the selected polygons, in the order of
+        `indices`.
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    num_vertices = np.diff(offsets)[indices]
+
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(num_vertices, out=new_offsets[1:])
+
+    # the position of each vertex in `vertices`
+    shifts = np.repeat(offsets[:-1][indices] - new_offsets[:-1], num_vertices)
+    return vertices[np.arange(new_offsets[-1]) + shifts], new_offsets
+
+
+def compute_roofs_geometry(roof_coordinates) -> dict[str, ndarray]:
+    """Computes the geometry of the crop of many roofs at once, i.e. the same
+    quantities computed by `rotate_and_crop_roof`.
+
+    Parameters
+    ----------
+    roof_coordinates : Iterable[str] or Iterable[ndarray]
+        The coordinates of the roofs.
+
+    Returns
+    -------
+    dict[str, ndarray]
+        The arrays of the geometry, one for each of the `ROOF_GEOMETRY_COLUMNS`.
+    """
+    return compute_ragged_roofs_geometry(*stack_polygons(list(roof_coordinates)))
+
+
+def compute_ragged_roofs_geometry(
+    vertices: ndarray, offsets: ndarray
+) -> dict[str, ndarray]:
+    """Same as `compute_roofs_geometry`, for roofs that are already parsed into a
+    ragged array.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) array of vertices.
+    offsets : ndarray
+        The (M + 1) array of offsets.
+
+    Returns
+    -------
+    dict[str, ndarray]
+        The arrays of the geometry, one for each of the `ROOF_GEOMETRY_COLUMNS`.
+    """
+    num_vertices = np.diff(offsets)
+
+    if np.any(num_vertices == 0):
+        raise ValueError("All roofs must have at least one vertex.")
+
+    # polygonal roofs: the crop is the bounding box of the roof
+    crop_origin = np.minimum.reduceat(vertices, offsets[:-1], axis=0)
+    crop_size = np.maximum.reduceat(vertices, offsets[:-1], axis=0) - crop_origin
+    rotation_angle = np.zeros(len(num_vertices))
+
+    # rectangular roofs: sort the vertices (by x, then y) and rotate around the first
+    is_rectangular = num_vertices == 4
+    rectangles = vertices[offsets[:-1][is_rectangular, None] + np.arange(4)]
+    order = np.lexsort((rectangles[:, :, 1], rectangles[:, :, 0]), axis=-1)
+    rectangles = np.take_along_axis(rectangles, order[:, :, None], axis=1)
+
+    first_side = rectangles[:, 1] - rectangles[:, 0]
+    second_side = rectangles[:, 2] - rectangles[:, 0]
+    theta = np.mod(np.arctan2(first_side[:, 0], first_side[:, 1]), np.pi / 2)
+
+    first_length = np.linalg.norm(first_side, axis=1).astype(int)
+    second_length = np.linalg.norm(second_side, axis=1).astype(int)
+    is_vertical = first_side[:, 1] > 0
+
+    rotation_angle[is_rectangular] = -theta * 180 / np.pi
+    crop_origin[is_rectangular] = rectangles[:, 0]
+    crop_size[is_rectangular] = np.column_stack(
+        [
+            np.where(is_vertical, second_length, first_length),
+            np.where(is_vertical, first_length, second_length),
+        ]
+    )
+
+    geometry = {
+        "roof_rotation_angle": rotation_angle,
+        "roof_crop_x": crop_origin[:, 0],
+        "roof_crop_y": crop_origin[:, 1],
+        "roof_crop_width": crop_size[:, 0],
+        "roof_crop_height": crop_size[:, 1],
+        "roof_num_vertices": num_vertices,
+    }
+
+    return {
+        column: geometry[column].astype(dtype)
+        for column, dtype in ROOF_GEOMETRY_COLUMNS.items()
+    }
+
+
+def crop_transforms_from_geometry(geometry) -> tuple[ndarray, ndarray]:
+    """Computes the affine transformations from the coordinates of the satellite photos
+    to the coordinates of the cropped roofs, from their precomputed geometry.
+
+    Parameters
+    ----------
+    geometry : Mapping
+        The geometry of one or many roofs, e.g. a row of the metadata or the output of
+        `compute_roofs_geometry`.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The (R, 2, 3) transformation matrices and the (R, 2) sizes of the crops, as
+        (width, height).
+    """
+    angle = np.radians(np.asarray(geometry["roof_rotation_angle"], float).reshape(-1))
+    crop_x = np.asarray(geometry["roof_crop_x"], float).reshape(-1)
+    crop_y = np.asarray(geometry["roof_crop_y"], float).reshape(-1)
+
+    # same as cv.getRotationMatrix2D around the crop origin, followed by a translation
+    # of the crop origin to (0, 0)
+    alpha, beta = np.cos(angle), np.sin(angle)
+
+    transforms = np.empty((len(angle), 2, 3))
+    transforms[:, 0, 0], transforms[:, 0, 1] = alpha, beta
+    transforms[:, 1, 0], transforms[:, 1, 1] = -beta, alpha
+    transforms[:, 0, 2] = (1 - alpha) * crop_x - beta * crop_y - crop_x
+    transforms[:, 1, 2] = beta * crop_x + (1 - alpha) * crop_y - crop_y
+
+    crop_sizes = np.column_stack(
+        [
+            np.asarray(geometry["roof_crop_width"], int).reshape(-1),
+            np.asarray(geometry["roof_crop_height"], int).reshape(-1),
+        ]
+    )
+
+    return transforms, crop_sizes
+
+
+def invert_affine_transforms(transforms: ndarray) -> ndarray:
+    """Inverts affine transformations, e.g. to map the coordinates of the cropped roofs
+    back to the coordinates of the satellite photos.
+
+    Parameters
+    ----------
+    transforms : ndarray
+        A (2, 3) matrix or an (R, 2, 3) array of matrices.
+
+    Returns
+    -------
+    ndarray
+        The inverse transformations, with the same shape.
+    """
+    transforms = np.asarray(transforms, dtype=np.float64)
+    linear = np.linalg.inv(transforms[..., :2])
+    translation = -np.einsum("...ij,...j->...i", linear, transforms[..., 2])
+
+    return np.concatenate([linear, translation[..., None]], axis=-1)
+
+
+def scale_coordinates(coordinates, scale: int):
+    """Maps pixel coordinates to a photo decoded at a reduced scale (see
+    `read_image_from_bytestring`): the pixel (x, y) of the photo is the pixel
+    (x // scale, y // scale) of the reduced photo.
+
+    Parameters
+    ----------
+    coordinates : ndarray or list[ndarray]
+        The (n, 2) integer coordinates of a polygon, or a list of polygons.
+    scale : int
+        The factor the photo is reduced by.
+
+    Returns
+    -------
+    ndarray or list[ndarray]
+        The coordinates in the reduced photo, with the same structure.
+    """
+    if isinstance(coordinates, list):
+        return [scale_coordinates(polygon, scale) for polygon in coordinates]
+    return np.asarray(coordinates) // scale
+
+
+def compute_crop_transform(
+    roof_coordinates: str | ndarray, roof_geometry=None
+) -> tuple[ndarray, ndarray]:
+    """Computes the affine transformation from the coordinates of the satellite photo
+    to the coordinates of the roof cropped with `rotate_and_crop_roof`.
+
+    Parameters
+    ----------
+    roof_coordinates : str or ndarray
+        Roof coordinates, either as string or list of lists of integers.
+    roof_geometry : Mapping or None (default: None)
+        The precomputed geometry of the roof, e.g. a row of the metadata. If None,
+        it is computed from `roof_coordinates`.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The (2, 3) affine transformation matrix and the size of the crop, as
+        (width, height).
+    """
+    if roof_geometry is None:
+        roof_geometry = compute_roofs_geometry([roof_coordinates])
+
+    transforms, crop_sizes = crop_transforms_from_geometry(roof_geometry)
+
+    return transforms[0], crop_sizes[0]
+
+
+def transform_polygons_to_crop(
+    vertices: ndarray,
+    offsets: ndarray,
+    transforms: ndarray,
+    crop_sizes: ndarray | None = None,
+    roof_index: ndarray | None = None,
+    clip: bool = True,
+) -> ndarray:
+    """Maps a ragged array of polygons into the coordinates of the cropped roofs, with
+    a single (batched) matrix multiplication.
+
+    Parameters
+    ----------
+    vertices : ndarray
+        The (N, 2) array of vertices, in the coordinates of the satellite photos.
+    offsets : ndarray
+        The (M + 1) array of offsets.
+    transforms : ndarray
+        The affine transformations of the roofs, as returned by
+        `compute_crop_transform`: either a single (2, 3) matrix, or an (R, 2, 3) array
+        for R roofs.
+    crop_sizes : ndarray or None (default: None)
+        The sizes of the crops, as (width, height): either a single pair or an (R, 2)
+        array. Only required if `clip` is True.
+    roof_index : ndarray or None (default: None)
+        The (M,) array with the index of the roof each polygon belongs to, i.e. of its
+        transformation in `transforms`. If None, all polygons belong to the first roof.
+    clip : bool (default: True)
+        Whether to clip the vertices to the boundaries of the crop.
+
+    Returns
+    -------
+    ndarray
+        The (N, 2) array of vertices (int32), in the coordinates of the cropped roofs.
+        The offsets are unchanged.
+    """
+    transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 2, 3)
+
+    if len(transforms) == 1:
+        transformed = vertices @ transforms[0, :, :2].T + transforms[0, :, 2]
+        vertex_roof_index = np.zeros(len(vertices), dtype=np.intp)
+    else:
+        if roof_index is None:
+            raise ValueError("`roof_index` is required with more than one transform.")
+        vertex_roof_index = np.repeat(roof_index, np.diff(offsets))
+        vertex_transforms = transforms[vertex_roof_index]
+        transformed = (
+            np.einsum("nij,nj->ni", vertex_transforms[:, :, :2], vertices)
+            + vertex_transforms[:, :, 2]
+        )
+
+    transformed = transformed.astype(np.int32)
+
+    if clip:
+        if crop_sizes is None:
+            raise ValueError("`crop_sizes` is required to clip the polygons.")
+        crop_sizes = np.asarray(crop_sizes).reshape(-1, 2)
+        np.clip(transformed, 0, crop_sizes[vertex_roof_index] - 1, out=transformed)
+
+    return transformed
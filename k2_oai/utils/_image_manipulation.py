@@ -10,20 +10,52 @@ import cv2 as cv
 import numpy as np
 from numpy import ndarray
 
+from k2_oai.utils._geometry import (
+    compute_crop_transform,
+    compute_roofs_geometry,
+    crop_transforms_from_geometry,
+    split_polygons,
+    stack_polygons,
+    transform_polygons_to_crop,
+)
 from k2_oai.utils._parsers import parse_str_as_coordinates
 
 __all__ = [
+    "PHOTO_SCALES",
+    "PREVIEW_SCALE",
     "read_image_from_bytestring",
+    "read_photo_from_bytestring",
     "pad_image",
     "draw_labels_on_cropped_roof",
     "draw_labels_on_photo",
+    "draw_obstacles_mask_on_cropped_roof",
     "rotate_and_crop_roof",
 ]
 
 
+# the factors photos can be reduced by when decoded, and the flags of the decoder: JPEG
+# photos are decoded directly at the reduced size, other formats are resized
+PHOTO_SCALES = (1, 2, 4, 8)
+# the scale of the photos that are only shown whole, and of coarse passes over photos
+PREVIEW_SCALE = 4
+_COLOR_FLAGS = {
+    1: cv.IMREAD_COLOR,
+    2: cv.IMREAD_REDUCED_COLOR_2,
+    4: cv.IMREAD_REDUCED_COLOR_4,
+    8: cv.IMREAD_REDUCED_COLOR_8,
+}
+_GREYSCALE_FLAGS = {
+    1: cv.IMREAD_GRAYSCALE,
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
 def read_image_from_bytestring(
     bytestring_image: bytes,
     as_greyscale: bool = True,
+    scale: int = 1,
 ) -> ndarray:
     """Reads the bytestring and returns it as a numpy array.
     This passage is necessary because the API sends a file that is transferred
@@ -35,17 +67,61 @@ def read_image_from_bytestring(
         The bytestring of the image.
     as_greyscale : bool
         If True, the image is converted to greyscale. The default is True.
+    scale : int (default: 1)
+        The factor the image is reduced by, one of `PHOTO_SCALES`. Pixel coordinates
+        must be reduced as well (see `scale_coordinates`).
 
     Returns
     -------
     ndarray
         The image as a numpy array.
     """
-    image_array: ndarray = np.fromstring(bytestring_image, np.uint8)
+    if scale not in PHOTO_SCALES:
+        raise ValueError(f"`scale` must be one of {PHOTO_SCALES}, not {scale}")
+
+    image_array: ndarray = np.frombuffer(bytestring_image, np.uint8)
 
     if as_greyscale:
-        return cv.imdecode(image_array, cv.IMREAD_GRAYSCALE)
-    return cv.imdecode(image_array, cv.IMREAD_COLOR)
+        return cv.imdecode(image_array, _GREYSCALE_FLAGS[scale])
+    return cv.imdecode(image_array, _COLOR_FLAGS[scale])
+
+
+def read_photo_from_bytestring(
+    bytestring_image: bytes,
+    bgr_only: bool = False,
+    greyscale_only: bool = False,
+    scale: int = 1,
+) -> ndarray | tuple[ndarray, ndarray]:
+    """Decodes a photo, in BGR and/or in greyscale. The photo is decoded only once:
+    the greyscale photo is converted from the BGR one.
+
+    Parameters
+    ----------
+    bytestring_image : bytes
+        The encoded photo, e.g. the content of a .png file.
+    bgr_only : bool (default: False)
+        If True, only returns the BGR photo.
+    greyscale_only : bool (default: False)
+        If True, only returns the greyscale photo.
+    scale : int (default: 1)
+        The factor the photo is reduced by (see `read_image_from_bytestring`).
+
+    Returns
+    -------
+    ndarray or tuple[ndarray, ndarray]
+        The BGR photo, the greyscale photo, or both.
+    """
+    if greyscale_only and bgr_only:
+        raise ValueError("`bgr_only` and `greyscale_only` cannot be both True")
+
+    if greyscale_only:
+        return read_image_from_bytestring(bytestring_image, True, scale)
+
+    bgr_image = read_image_from_bytestring(bytestring_image, False, scale)
+    if bgr_only:
+        return bgr_image
+
+    return bgr_image, cv.cvtColor(bgr_image, cv.COLOR_BGR2GRAY)
 
 
 def pad_image(
@@ -124,6 +200,7 @@ def draw_labels_on_cropped_roof(
     cropped_roof: ndarray,
     roof_coordinates: str | ndarray,
     obstacle_coordinates: str | list[str] | None,
+    roof_geometry=None,
 ) -> ndarray:
     """Draws roof and obstacle labels on the input image from their coordinates.
 
@@ -135,6 +212,9 @@ def draw_labels_on_cropped_roof(
         Roof coordinates, either as string or list of lists of integers.
     obstacle_coordinates : str or ndarray or None (default: None)
         Obstacle coordinates. Can be None if there are no obstacles. Defaults to None.
+    roof_geometry : Mapping or None (default: None)
+        The precomputed geometry of the roof. If None, it is computed from
+        `roof_coordinates`.
 
     Returns
     -------
@@ -146,62 +226,75 @@ def draw_labels_on_cropped_roof(
     if obstacle_coordinates is None:
         return target_image
 
-    coord = parse_str_as_coordinates(
-        roof_coordinates, dtype="int32", sort_coordinates=True
+    transform, _ = compute_crop_transform(roof_coordinates, roof_geometry)
+    vertices, offsets = stack_polygons(obstacle_coordinates)
+    cropped_vertices = transform_polygons_to_crop(
+        vertices, offsets, transform, clip=False
     )
 
-    # rectangular roof
-    if len(coord) == 4:
-        rotation_matrix = _compute_rotation_matrix(coord)
-        center = coord[0]
-
-        for obst in obstacle_coordinates:
-            points_obs: np.array = parse_str_as_coordinates(obst)
-            obst_vertex = len(points_obs)
-            pts1 = np.hstack((points_obs, np.ones((obst_vertex, 1))))
-            pts_rotated = np.matmul(rotation_matrix, np.transpose(pts1))
-            offset = np.transpose(np.tile(center, (obst_vertex, 1)))
-            pts_new = np.subtract(pts_rotated, offset).astype(int)
-
-            pts_new = np.transpose(pts_new)
-            cv.polylines(
-                target_image, [pts_new], True, (255, 0, 0, 255), 1, lineType=cv.LINE_4
-            )
-
-    # polygonal roof
-    else:
-        for obst in obstacle_coordinates:
-            points: np.array = parse_str_as_coordinates(obst).reshape((-1, 1, 2))
-
-            top_left = np.min(coord, axis=0)
-            points_list = []
-            for pts in points:
-                points_list.append(np.subtract(pts, top_left))
-
-            points_offset = np.array(points_list).reshape((-1, 1, 2))
-            cv.polylines(
-                target_image,
-                [points_offset],
-                True,
-                (255, 0, 0, 255),
-                1,
-                lineType=cv.LINE_4,
-            )
+    cv.polylines(
+        target_image,
+        split_polygons(cropped_vertices, offsets),
+        True,
+        (255, 0, 0, 255),
+        1,
+        lineType=cv.LINE_4,
+    )
 
     return target_image
 
 
-def _compute_rotation_matrix(coordinates):
-    diff = np.subtract(coordinates[1], coordinates[0])
-    theta = np.mod(np.arctan2(diff[0], diff[1]), np.pi / 2)
-    center = coordinates[0]
+def draw_obstacles_mask_on_cropped_roof(
+    cropped_roof: ndarray,
+    roof_coordinates: str | ndarray,
+    obstacle_coordinates: str | list[str] | None,
+    roof_geometry=None,
+) -> ndarray:
+    """Draws the labelled obstacles as filled polygons on a black mask with the same
+    height and width of the cropped roof. Uses the same transformations as
+    `draw_labels_on_cropped_roof`, so that the mask matches the drawn labels.
+
+    Parameters
+    ----------
+    cropped_roof : ndarray
+        The cropped roof, as returned by `rotate_and_crop_roof`.
+    roof_coordinates : str or ndarray
+        Roof coordinates, either as string or list of lists of integers.
+    obstacle_coordinates : str or ndarray or None (default: None)
+        Obstacle coordinates. Can be None if there are no obstacles. Defaults to None.
+    roof_geometry : Mapping or None (default: None)
+        The precomputed geometry of the roof. If None, it is computed from
+        `roof_coordinates`.
 
-    return cv.getRotationMatrix2D(
-        (int(center[0]), int(center[1])), -theta * 180 / np.pi, 1
+    Returns
+    -------
+    ndarray
+        A greyscale mask, where obstacles are white (255) and the rest is black (0).
+    """
+    mask = np.zeros(cropped_roof.shape[0:2], dtype=np.uint8)
+
+    if obstacle_coordinates is None:
+        return mask
+
+    transform, _ = compute_crop_transform(roof_coordinates, roof_geometry)
+    vertices, offsets = stack_polygons(obstacle_coordinates)
+    cropped_vertices = transform_polygons_to_crop(
+        vertices, offsets, transform, clip=False
     )
 
+    cv.fillPoly(mask, split_polygons(cropped_vertices, offsets), 255)
+
+    return mask
 
-def rotate_and_crop_roof(input_image: ndarray, roof_coordinates: str) -> ndarray:
+
+def _first_value(roof_geometry, column: str) -> int:
+    # the geometry is either a row of the metadata or a dict of arrays
+    return int(np.asarray(roof_geometry[column]).reshape(-1)[0])
+
+
+def rotate_and_crop_roof(
+    input_image: ndarray, roof_coordinates: str | ndarray, roof_geometry=None
+) -> ndarray:
     """Rotates the input image to make the roof sides parallel to the image,
     then crops it.
 
@@ -209,66 +302,66 @@ def rotate_and_crop_roof(input_image: ndarray, roof_coordinates: str) -> ndarray
     ----------
     input_image : ndarray
         The input image.
-    roof_coordinates : str
+    roof_coordinates : str or ndarray
         Roof coordinates: if string, it is parsed as a string of coordinates
         (i.e. a list of list of integers: [[x1, y1], [x2, y2], ...]).
+    roof_geometry : Mapping or None (default: None)
+        The precomputed geometry of the roof (see `compute_roofs_geometry`), e.g. a row
+        of the metadata. If None, it is computed from `roof_coordinates`.
 
     Returns
     -------
     ndarray
         The rotated and cropped roof.
     """
-    # dont'change dtype
-    coord = parse_str_as_coordinates(
-        roof_coordinates, dtype="int32", sort_coordinates=True
-    )
+    if roof_geometry is None:
+        roof_geometry = compute_roofs_geometry([roof_coordinates])
 
-    if len(input_image.shape) < 3:
-        im_alpha = cv.cvtColor(input_image, cv.COLOR_GRAY2BGRA)
-    else:
-        im_alpha = cv.cvtColor(input_image, cv.COLOR_BGR2BGRA)
+    transforms, crop_sizes = crop_transforms_from_geometry(roof_geometry)
+    crop_width, crop_height = crop_sizes[0]
+
+    # rectangular roofs: rotate and crop in a single step
+    if _first_value(roof_geometry, "roof_num_vertices") == 4:
 
-    # rectangular roofs
-    if len(coord) == 4:
-        rotation_matrix = _compute_rotation_matrix(coord)
+        if len(input_image.shape) < 3:
+            im_alpha = cv.cvtColor(input_image, cv.COLOR_GRAY2BGRA)
+        else:
+            im_alpha = cv.cvtColor(input_image, cv.COLOR_BGR2BGRA)
 
-        im_affine = cv.warpAffine(
+        return cv.warpAffine(
             im_alpha,
-            rotation_matrix,
-            (im_alpha.shape[0] * 2, im_alpha.shape[1] * 2),
-            cv.INTER_LINEAR,
-            cv.BORDER_CONSTANT,
+            transforms[0],
+            (int(crop_width), int(crop_height)),
+            flags=cv.INTER_NEAREST,
+            borderMode=cv.BORDER_CONSTANT,
         )
 
-        diff = np.subtract(coord[1], coord[0])
-
-        if diff[1] > 0:
-            dist_y = np.linalg.norm(coord[1] - coord[0]).astype(int)
-            dist_x = np.linalg.norm(coord[2] - coord[0]).astype(int)
-        else:
-            dist_y = np.linalg.norm(coord[2] - coord[0]).astype(int)
-            dist_x = np.linalg.norm(coord[1] - coord[0]).astype(int)
-
-        return im_affine[
-            coord[0][1] : coord[0][1] + dist_y, coord[0][0] : coord[0][0] + dist_x, :
+    # polygonal roofs: crop the bounding box, then mask what is outside the roof
+    top_left = np.array(
+        [
+            _first_value(roof_geometry, "roof_crop_x"),
+            _first_value(roof_geometry, "roof_crop_y"),
         ]
+    )
 
-    # polygonal roofs
-    else:
-        coord = parse_str_as_coordinates(
-            roof_coordinates, dtype="int32", sort_coordinates=False
-        )
-        mask = np.zeros(input_image.shape[0:2], dtype="uint8")
+    cropped_image = input_image[
+        top_left[1] : top_left[1] + crop_height, top_left[0] : top_left[0] + crop_width
+    ]
 
-        pts = np.array(coord, np.int32).reshape((-1, 1, 2))
+    if len(input_image.shape) < 3:
+        im_alpha = cv.cvtColor(cropped_image, cv.COLOR_GRAY2BGRA)
+    else:
+        im_alpha = cv.cvtColor(cropped_image, cv.COLOR_BGR2BGRA)
 
-        cv.fillConvexPoly(mask, pts, (255, 255, 255))
+    coord = parse_str_as_coordinates(
+        roof_coordinates, dtype="int32", sort_coordinates=False
+    )
+    pts = (coord - top_left).astype(np.int32).reshape((-1, 1, 2))
 
-        im_alpha[:, :, 3] = mask
+    # the bottom-right vertices lie out of the crop: OpenCV would clip the polygon
+    mask = np.zeros((im_alpha.shape[0] + 1, im_alpha.shape[1] + 1), dtype="uint8")
+    cv.fillConvexPoly(mask, pts, (255, 255, 255))
 
-        bot_right = np.max(pts, axis=0)
-        top_left = np.min(pts, axis=0)
+    im_alpha[:, :, 3] = mask[:-1, :-1]
 
-        return im_alpha[
-            top_left[0][1] : bot_right[0][1], top_left[0][0] : bot_right[0][0], :
-        ]
+    return im_alpha
@@ -8,12 +8,21 @@ from __future__ import annotations
 from ast import literal_eval
 
 import numpy as np
+import pandas as pd
 from numpy import ndarray
 
 __all__ = [
     "parse_str_as_coordinates",
+    "parse_coordinates_column",
 ]
 
+# integers, or floats such as "0.5" or "1e3", which are truncated like `np.int32` does
+_NUMBER = r"\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*"
+_POINT = rf"\s*\[{_NUMBER},{_NUMBER}\]\s*"
+# a (possibly empty) list of [x, y] points, e.g. "[[1, 2], [3, 4]]"
+_COORDINATES_PATTERN = rf"\s*\[(?:{_POINT}(?:,{_POINT})*)?\]\s*"
+_SEPARATORS = str.maketrans("[],", "   ")
+
 
 def parse_str_as_coordinates(
     string: str, dtype=np.int32, sort_coordinates: bool = False
@@ -21,8 +30,9 @@ def parse_str_as_coordinates(
     """Parses a string of coordinates into a list of lists of strings.
     Parameters
     ----------
-    string : str
-        A string of coordinates.
+    string : str or ndarray
+        A string of coordinates. If it is already an array, it is returned as is
+        (sorted and cast to `dtype`, if required).
     dtype: numpy dtype (default = np.int32)
         The datatype of the numpy array to be returned.
     sort_coordinates: bool (default = False)
@@ -33,13 +43,60 @@ def parse_str_as_coordinates(
         A list of lists of integers, denoting pixel coordinates, i.e.
         [[x1, y1], [x2, y2], ...].
     """
-    if not isinstance(string, str):
+    if isinstance(string, ndarray):
+        parsed_string = sorted(string.tolist()) if sort_coordinates else string
+    elif isinstance(string, str):
+        parsed_string = (
+            sorted(literal_eval(string)) if sort_coordinates else literal_eval(string)
+        )
+    else:
         raise TypeError(f"{type(string)} is not a valid type.")
 
-    parsed_string = (
-        sorted(literal_eval(string)) if sort_coordinates else literal_eval(string)
-    )
-
     if dtype:
         return np.array(parsed_string, dtype=dtype)
     return np.array(parsed_string)
+
+
+def parse_coordinates_column(column) -> tuple[ndarray, ndarray, ndarray]:
+    """Parses a whole column of strings of coordinates at once, into a ragged array:
+    all the points are stacked in a single (N, 2) array, and an array of M + 1 offsets
+    delimits the M rows, i.e. the points of the i-th row are
+    `vertices[offsets[i] : offsets[i + 1]]`.
+
+    Parameters
+    ----------
+    column : Iterable[str]
+        The strings of coordinates, e.g. the `pixelCoordinates_roof` column of the
+        metadata. Repeated strings are better removed beforehand, e.g. with
+        `pd.factorize`.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray, ndarray]
+        The (N, 2) array of points (int32, float coordinates are truncated), the
+        (M + 1) array of offsets and the (M) boolean array of valid rows. Missing
+        values and malformed strings are not valid, and are parsed as rows with no
+        points.
+    """
+    strings = pd.Series(column, dtype=object)
+    is_string = strings.map(type).eq(str).to_numpy()
+
+    is_valid = is_string.copy()
+    is_valid[is_string] = (
+        strings[is_string].str.fullmatch(_COORDINATES_PATTERN).to_numpy(dtype=bool)
+    )
+    valid_strings = strings[is_valid]
+
+    num_points = np.zeros(len(strings), dtype=np.int64)
+    # every point, and the list itself, are closed by a bracket
+    num_points[is_valid] = [string.count("]") - 1 for string in valid_strings]
+
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(num_points, out=offsets[1:])
+
+    # strip the brackets and commas, then let numpy parse all the numbers in C
+    numbers = " ".join(valid_strings.tolist()).translate(_SEPARATORS)
+    vertices = np.fromstring(numbers, dtype=np.float64, sep=" ") if numbers else []
+
+    # truncated towards zero, as `parse_str_as_coordinates`
+    return np.asarray(vertices).astype(np.int32).reshape(-1, 2), offsets, is_valid
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# keep the caches and listings of the tests out of the user's cache, before k2_oai
+# reads the environment
+os.environ["K2_CACHE_DIR"] = tempfile.mkdtemp(prefix="k2_oai-tests-")
@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from k2_oai.data.annotations import (
+    merge_label_annotations,
+    read_label_annotations_snapshot,
+    write_label_annotations_snapshot,
+)
+
+
+def _checkpoint(rng, num_annotations, first_day):
+    days = rng.integers(first_day, first_day + 10, num_annotations)
+    return pd.DataFrame(
+        {
+            "roof_id": rng.integers(0, 100, num_annotations).astype(float),
+            "annotation_time": [f"2022_06_{day:02}-00_00_00" for day in days],
+            "annotation": rng.integers(0, 2, num_annotations),
+        }
+    )
+
+
+def _latest(checkpoints):
+    return (
+        pd.concat(checkpoints, ignore_index=True)
+        .sort_values(["roof_id", "annotation_time"], kind="stable")
+        .drop_duplicates("roof_id", keep="last")
+        .reset_index(drop=True)
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_merge_label_annotations_incrementally(seed):
+    rng = np.random.default_rng(seed)
+    checkpoints = [
+        _checkpoint(rng, rng.integers(0, 50), rng.integers(1, 15))
+        for _ in range(rng.integers(1, 5))
+    ]
+
+    snapshot = None
+    for checkpoint in checkpoints:
+        snapshot = merge_label_annotations(snapshot, checkpoint)
+
+    pd.testing.assert_frame_equal(snapshot, _latest(checkpoints), check_dtype=False)
+
+
+def test_merge_label_annotations_keeps_newer_snapshot():
+    snapshot = pd.DataFrame(
+        {
+            "roof_id": [1.0, 2.0, 3.0],
+            "annotation_time": ["2022_06_10", "2022_06_10", "2022_06_10"],
+            "annotation": [1, 1, 1],
+        }
+    )
+    checkpoint = pd.DataFrame(
+        {
+            "roof_id": [1.0, 2.0, 4.0, np.nan],
+            "annotation_time": ["2022_06_01", "2022_06_10", "2022_06_01", "2022_06_20"],
+            "annotation": [0, 0, 0, 0],
+        }
+    )
+
+    merged = merge_label_annotations(snapshot, checkpoint)
+
+    assert merged.roof_id.tolist() == [1.0, 2.0, 3.0, 4.0]
+    # older annotations do not replace the snapshot, ties are won by the checkpoint
+    assert merged.annotation.tolist() == [1, 0, 1, 0]
+
+
+def test_label_annotations_snapshot_round_trip():
+    snapshot = pd.DataFrame(
+        {"roof_id": [1.0, 2.0], "annotation_time": ["a", "b"], "annotation": [0, 1]}
+    )
+    checkpoints = {"2022_06-checkpoint-labels_annotations.csv": "0123abcd"}
+
+    with io.BytesIO() as buffer:
+        write_label_annotations_snapshot(snapshot, checkpoints, buffer)
+        buffer.seek(0)
+        read_snapshot, read_checkpoints = read_label_annotations_snapshot(buffer)
+
+    pd.testing.assert_frame_equal(read_snapshot, snapshot, check_dtype=False)
+    assert read_checkpoints == checkpoints
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from k2_oai.data.duplicates import find_near_duplicates, polygons_overlap
+
+
+def _ragged(polygons):
+    vertices = np.concatenate([np.asarray(p, dtype=np.float64) for p in polygons])
+    offsets = np.cumsum([0] + [len(p) for p in polygons])
+    return vertices, offsets
+
+
+def _square(x, y, size=10):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size]]
+
+
+def test_polygons_overlap():
+    l_shape = [[0, 0], [20, 0], [20, 10], [10, 10], [10, 20], [0, 20]]
+    vertices, offsets = _ragged(
+        [
+            _square(0, 0),
+            _square(0, 0),
+            _square(5, 0),
+            _square(20, 20),
+            _square(10, 0),
+            l_shape,
+            _square(10, 10),
+            # clockwise
+            _square(0, 0)[::-1],
+        ]
+    )
+
+    overlap = polygons_overlap(
+        vertices,
+        offsets,
+        [0, 0, 0, 0, 5, 5, 2],
+        [1, 2, 3, 4, 6, 0, 7],
+    )
+
+    np.testing.assert_allclose(
+        overlap,
+        [
+            1.0,
+            50 / 150,
+            0.0,
+            # touching edges
+            0.0,
+            # the square fills the notch of the L: their boxes overlap, not them
+            0.0,
+            100 / 300,
+            50 / 150,
+        ],
+        atol=1e-9,
+    )
+
+
+def test_polygons_overlap_is_symmetric():
+    rng = np.random.default_rng(0)
+    polygons = [
+        _square(x, y, size)
+        for x, y, size in zip(
+            rng.uniform(0, 30, 20), rng.uniform(0, 30, 20), rng.uniform(5, 20, 20)
+        )
+    ]
+    vertices, offsets = _ragged(polygons)
+    first, second = np.triu_indices(len(polygons), k=1)
+
+    np.testing.assert_allclose(
+        polygons_overlap(vertices, offsets, first, second),
+        polygons_overlap(vertices, offsets, second, first),
+    )
+
+
+@pytest.mark.parametrize("min_overlap", [0.5, 0.3])
+def test_find_near_duplicates(min_overlap):
+    vertices, offsets = _ragged(
+        [
+            _square(0, 0),
+            # shifted by a pixel: a duplicate of the first roof
+            _square(1, 0),
+            # far away
+            _square(500, 500),
+            _square(501, 501),
+            # overlaps the first roof by a third
+            _square(5, 0),
+        ]
+    )
+
+    canonical = find_near_duplicates(
+        vertices, offsets, cell_size=50.0, min_overlap=min_overlap
+    )
+
+    if min_overlap == 0.5:
+        np.testing.assert_array_equal(canonical, [0, 0, 2, 2, 4])
+    else:
+        np.testing.assert_array_equal(canonical, [0, 0, 2, 2, 0])
+
+
+def test_find_near_duplicates_groups_around_seeds():
+    # a row of roofs that overlap their neighbours: every roof overlaps its canonical
+    # roof directly, so the row does not collapse onto the first roof
+    vertices, offsets = _ragged([_square(4 * i, 0) for i in range(5)])
+
+    canonical = find_near_duplicates(vertices, offsets, min_overlap=0.4)
+
+    np.testing.assert_array_equal(canonical, [0, 0, 2, 2, 4])
+
+
+def test_find_near_duplicates_without_vertices():
+    vertices = np.asarray(_square(0, 0) + _square(0, 0), dtype=np.float64)
+    offsets = np.array([0, 4, 4, 8])
+
+    np.testing.assert_array_equal(find_near_duplicates(vertices, offsets), [0, 1, 0])
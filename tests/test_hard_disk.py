@@ -0,0 +1,104 @@
+import os
+
+import pandas as pd
+import pytest
+
+from k2_oai.dropbox import DROPBOX_RAW_PHOTOS_ROOT, LocalBackend
+from k2_oai.dropbox.hard_disk import ingest_photos
+
+
+@pytest.fixture
+def photos_dir(tmp_path):
+    photos_dir = tmp_path / "hard_disk"
+    os.makedirs(photos_dir)
+    for i in range(10):
+        (photos_dir / f"photo_{i}.png").write_bytes(os.urandom(100 + i))
+    (photos_dir / "Thumbs.db").write_bytes(b"not a photo")
+    return photos_dir
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalBackend(str(tmp_path / "dropbox"), hash_contents=True)
+
+
+def _remote_folder(storage, photos_folder):
+    return storage.local_path(f"{DROPBOX_RAW_PHOTOS_ROOT}/{photos_folder}")
+
+
+def test_ingest_photos(storage, photos_dir, tmp_path):
+    remote_folder = _remote_folder(storage, "folder")
+    os.makedirs(remote_folder)
+    # already on Dropbox, with another case
+    (photos_dir / "photo_0.png").rename(photos_dir / "PHOTO_0.png")
+    with open(os.path.join(remote_folder, "photo_0.png"), "wb") as remote_photo:
+        remote_photo.write((photos_dir / "PHOTO_0.png").read_bytes())
+    # another photo with the same name
+    with open(os.path.join(remote_folder, "photo_1.png"), "wb") as remote_photo:
+        remote_photo.write(b"another photo")
+
+    manifest = ingest_photos(
+        storage, str(photos_dir), "folder", ingest_dir=str(tmp_path / "ingest")
+    )
+
+    status = dict(zip(manifest.item_name, manifest.status))
+    assert status.pop("PHOTO_0.png") == "skipped"
+    assert status.pop("photo_1.png") == "conflict"
+    assert set(status.values()) == {"uploaded"}
+    assert sorted(os.listdir(remote_folder)) == sorted(
+        ["photo_0.png", "photo_1.png", *status]
+    )
+
+    index = pd.read_csv(
+        storage.local_path(f"{DROPBOX_RAW_PHOTOS_ROOT}/index-folder.csv")
+    )
+    assert len(index) == 10
+    with open(os.path.join(remote_folder, "photo_1.png"), "rb") as remote_photo:
+        assert remote_photo.read() == b"another photo"
+
+
+def test_ingest_photos_resumes(storage, photos_dir, tmp_path):
+    ingest_dir = str(tmp_path / "ingest")
+    upload_many = storage.upload_many
+    uploaded_batches = []
+
+    def crash_after_two_batches(files, overwrite=True):
+        if len(uploaded_batches) == 2:
+            raise RuntimeError("crash")
+        uploaded_batches.append([path for _, path in files])
+        return upload_many(files, overwrite)
+
+    storage.upload_many = crash_after_two_batches
+    with pytest.raises(RuntimeError):
+        ingest_photos(
+            storage,
+            str(photos_dir),
+            "folder",
+            max_workers=1,
+            batch_size=3,
+            ingest_dir=ingest_dir,
+        )
+    assert len(os.listdir(_remote_folder(storage, "folder"))) == 6
+    assert os.path.exists(os.path.join(ingest_dir, "folder-uploaded.csv"))
+
+    uploaded_batches.clear()
+    storage.upload_many = lambda files, overwrite=True: (
+        uploaded_batches.append([path for _, path in files])
+        or upload_many(files, overwrite)
+    )
+    manifest = ingest_photos(
+        storage, str(photos_dir), "folder", batch_size=3, ingest_dir=ingest_dir
+    )
+
+    # only the photos that were not uploaded are uploaded again, and the photos of
+    # the first ingest are reported as uploaded
+    assert sorted(
+        os.path.basename(path) for batch in uploaded_batches for path in batch
+    ) == [f"photo_{i}.png" for i in range(6, 10)]
+    assert (manifest.status == "uploaded").all()
+    assert len(os.listdir(_remote_folder(storage, "folder"))) == 10
+    assert not os.path.exists(os.path.join(ingest_dir, "folder-uploaded.csv"))
+
+    # the manifest is kept, and nothing is uploaded again
+    manifest = ingest_photos(storage, str(photos_dir), "folder", ingest_dir=ingest_dir)
+    assert (manifest.status == "skipped").all()
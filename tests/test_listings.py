@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+from k2_oai.dropbox import DropboxListings, LocalBackend
+
+
+class CursorBackend(LocalBackend):
+    """A local backend whose cursors are the listing they were taken after, to list
+    the changes since then like Dropbox does."""
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        # the folders listed in full, also the subfolders of recursive listings
+        self.full_listings = []
+
+    def list_folder_with_cursor(self, path, recursive=False):
+        self.full_listings.append(path)
+        records, _ = super().list_folder_with_cursor(path, recursive)
+        return records, json.dumps([path, recursive, records])
+
+    def list_folder_changes(self, cursor):
+        path, recursive, previous = json.loads(cursor)
+        records, _ = super().list_folder_with_cursor(path, recursive)
+
+        previous_paths = {record["item_abs_path"] for record in previous}
+        paths = {record["item_abs_path"] for record in records}
+        changed = [record for record in records if record not in previous]
+        deleted = sorted(previous_paths - paths)
+
+        return changed, deleted, json.dumps([path, recursive, records])
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "k2" / "photos"
+    os.makedirs(folder / "subfolder")
+    (folder / "a.png").write_bytes(b"a")
+    (folder / "subfolder" / "b.png").write_bytes(b"b")
+    return folder
+
+
+def _names(listing):
+    return sorted(listing.item_name)
+
+
+def test_listings_without_cursors(tmp_path, folder):
+    storage = LocalBackend(str(tmp_path))
+    listings = DropboxListings(str(tmp_path / "listings"))
+
+    assert _names(listings.listdir(storage, "/k2/photos")) == ["a.png", "subfolder"]
+
+    (folder / "c.png").write_bytes(b"c")
+    assert _names(listings.listdir(storage, "/k2/photos")) == [
+        "a.png",
+        "c.png",
+        "subfolder",
+    ]
+
+
+def test_listings_apply_changes(tmp_path, folder):
+    storage = CursorBackend(str(tmp_path))
+    listings_dir = str(tmp_path / "listings")
+    listings = DropboxListings(listings_dir)
+
+    assert _names(listings.listdir(storage, "/k2/photos", recursive=True)) == [
+        "a.png",
+        "b.png",
+        "subfolder",
+    ]
+
+    (folder / "c.png").write_bytes(b"c")
+    (folder / "a.png").write_bytes(b"changed")
+    os.remove(folder / "subfolder" / "b.png")
+    os.rmdir(folder / "subfolder")
+
+    listing = listings.listdir(storage, "/k2/photos", recursive=True)
+    assert _names(listing) == ["a.png", "c.png"]
+    assert listing.set_index("item_name").item_size["a.png"] == len(b"changed")
+    assert storage.full_listings.count("/k2/photos") == 1
+
+    # the listing is persisted: a new session only lists the changes
+    listing = DropboxListings(listings_dir).listdir(
+        storage, "/k2/photos", recursive=True
+    )
+    assert _names(listing) == ["a.png", "c.png"]
+    assert storage.full_listings.count("/k2/photos") == 1
+
+
+def test_listings_deleted_folder_contents(tmp_path, folder):
+    storage = CursorBackend(str(tmp_path))
+    listings = DropboxListings(str(tmp_path / "listings"))
+    listings.listdir(storage, "/k2/photos", recursive=True)
+
+    # Dropbox only reports the deleted folder, not its contents
+    storage.list_folder_changes = lambda cursor: ([], ["/k2/photos/SubFolder"], cursor)
+
+    assert _names(listings.listdir(storage, "/k2/photos", recursive=True)) == ["a.png"]
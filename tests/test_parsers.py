@@ -0,0 +1,38 @@
+import numpy as np
+
+from k2_oai.utils import parse_coordinates_column
+
+
+def test_parse_coordinates_column():
+    vertices, offsets, is_valid = parse_coordinates_column(
+        ["[[0, 0], [10, 0], [10, 10]]", "[[1.5, 2.9], [-3, 4e1]]"]
+    )
+
+    np.testing.assert_array_equal(offsets, [0, 3, 5])
+    np.testing.assert_array_equal(is_valid, [True, True])
+    # float coordinates are truncated
+    np.testing.assert_array_equal(
+        vertices, [[0, 0], [10, 0], [10, 10], [1, 2], [-3, 40]]
+    )
+
+
+def test_parse_coordinates_column_malformed_rows():
+    vertices, offsets, is_valid = parse_coordinates_column(
+        [
+            "[[0, 0], [1, 1]]",
+            None,
+            np.nan,
+            "[[0, 0], [1]]",
+            "[[0, 0], [1, a]]",
+            "not coordinates",
+            "[]",
+            "[[2, 2]]",
+        ]
+    )
+
+    np.testing.assert_array_equal(
+        is_valid, [True, False, False, False, False, False, True, True]
+    )
+    # malformed rows have no points, and do not shift the others
+    np.testing.assert_array_equal(offsets, [0, 2, 2, 2, 2, 2, 2, 2, 3])
+    np.testing.assert_array_equal(vertices, [[0, 0], [1, 1], [2, 2]])
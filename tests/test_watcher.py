@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from k2_oai.dropbox import FolderWatcher, LocalBackend
+
+
+@pytest.fixture
+def storage(tmp_path):
+    os.makedirs(tmp_path / "k2" / "photos" / "folder")
+    return LocalBackend(str(tmp_path), poll_interval=0.01)
+
+
+def test_folder_watcher_notifies_changes(storage, tmp_path):
+    changes = []
+    watcher = FolderWatcher(
+        storage, ["/k2/photos/"], timeout=1, on_change=changes.append
+    ).start()
+
+    try:
+        assert watcher.is_watching("/K2/photos/folder")
+        assert not watcher.is_watching("/k2/photos_other")
+        assert watcher.version("/k2/photos") == 0
+        # nothing changed
+        assert not watcher.wait_for_change("/k2/photos", 0, timeout=0.2)
+
+        (tmp_path / "k2" / "photos" / "folder" / "photo.png").write_bytes(b"photo")
+
+        assert watcher.wait_for_change("/k2/photos/folder", 0, timeout=5)
+        assert watcher.version("/k2/photos/folder/photo.png") >= 1
+        assert changes and set(changes) == {"/k2/photos"}
+    finally:
+        watcher.stop()
+
+
+def test_folder_watcher_unwatched_path(storage):
+    watcher = FolderWatcher(storage, ["/k2/photos"])
+
+    assert watcher.version("/k2/metadata") is None